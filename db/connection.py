@@ -0,0 +1,150 @@
+"""
+Connection management for the SQLite database.
+
+One long-lived writer connection (serialized by a lock) and a small pool of read-only
+connections, all in WAL mode so the MQTT writer and the HTTP readers don't block each other.
+Use get_database(db_file) everywhere instead of sqlite3.connect:
+
+    with get_database(db_file).read() as conn:
+        conn.execute("SELECT ...")
+
+    with get_database(db_file).write() as conn:
+        conn.execute("UPDATE ...")   # committed when the block exits, rolled back on error
+"""
+import pathlib
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DEFAULT_OPTIONS = {
+    "read_pool_size": 4,
+    "synchronous": "NORMAL",  # safe in WAL mode, only the last commits may be lost on power failure
+    "cache_size_kb": 8192,  # per connection
+    "mmap_size_mb": 128,
+    "busy_timeout_ms": 5000,
+}
+
+# how often a thread waiting for a reader connection checks whether the database was closed
+READER_WAIT_INTERVAL = 0.5
+
+
+class Database:
+
+    def __init__(self, db_file: str, options: dict = None):
+        self.db_file = db_file
+        self.options = dict(DEFAULT_OPTIONS)
+        self.options.update(options or {})
+
+        self._write_lock = threading.RLock()
+        self._writer = self._connect(read_only=False)
+        # WAL is persistent, it only has to be set once (by the writer)
+        mode = self._writer.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode.lower() != "wal":
+            print(f"[DB] Could not enable WAL mode, using '{mode}'")
+
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        if read_only:
+            # as_uri() escapes '?', '#' and '%' in the path
+            uri = pathlib.Path(self.db_file).resolve().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                   timeout=self.options["busy_timeout_ms"] / 1000.0)
+        else:
+            conn = sqlite3.connect(self.db_file, check_same_thread=False,
+                                   timeout=self.options["busy_timeout_ms"] / 1000.0)
+        conn.execute(f"PRAGMA synchronous={self.options['synchronous']}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.options['cache_size_kb'])}")
+        conn.execute(f"PRAGMA mmap_size={int(self.options['mmap_size_mb']) * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    @contextmanager
+    def write(self):
+        """Exclusive access to the writer connection, commits on success and rolls back on error."""
+        with self._write_lock:
+            if self._closed:
+                raise RuntimeError("Database is closed")
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    @contextmanager
+    def read(self):
+        """A read-only connection from the pool, returned to the pool when the block exits."""
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            # end any implicit read transaction so the connection does not pin an old WAL snapshot
+            if conn.in_transaction:
+                conn.rollback()
+            if self._closed:
+                conn.close()
+            else:
+                self._readers.put(conn)
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        if self._closed:
+            raise RuntimeError("Database is closed")
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._reader_lock:
+            if self._reader_count < self.options["read_pool_size"]:
+                self._reader_count += 1
+                return self._connect(read_only=True)
+        # pool exhausted, wait for a connection to be returned
+        while True:
+            try:
+                return self._readers.get(timeout=READER_WAIT_INTERVAL)
+            except queue.Empty:
+                if self._closed:
+                    raise RuntimeError("Database is closed")
+
+    def close(self):
+        with self._write_lock:
+            self._closed = True
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            # refresh the planner statistics for the indexes that were used (cheap, recommended before closing)
+            try:
+                self._writer.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                print(f"[DB] PRAGMA optimize failed: {e}")
+            self._writer.close()
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def open_database(db_file: str, options: dict = None) -> Database:
+    """Open (or return the already open) database, options are only used when opening."""
+    with _databases_lock:
+        if db_file not in _databases:
+            _databases[db_file] = Database(db_file, options)
+            print(f"[DB] Opened {db_file} (WAL, {_databases[db_file].options['read_pool_size']} reader connections)")
+        return _databases[db_file]
+
+
+def get_database(db_file: str) -> Database:
+    return open_database(db_file)
+
+
+def close_databases():
+    with _databases_lock:
+        for db in _databases.values():
+            db.close()
+        _databases.clear()
@@ -1,9 +1,28 @@
 import sqlite3
 import json
+import os
+import shutil
+from contextlib import closing
+import base64
 from datetime import datetime
+from io import BytesIO
 
-def run_migrations(db_file):
-    with sqlite3.connect(db_file) as conn:
+import numpy as np
+from PIL import Image
+
+from lib.meter_processing.digit_codec import encode_colored_digits, encode_th_digits
+
+# rows converted per transaction when migrating evaluation images to the binary format
+DIGIT_MIGRATION_CHUNK = 200
+
+INDEXES = {
+    "idx_history_name_id": "history (name, id)",
+    "idx_history_name_timestamp": "history (name, timestamp)",
+    "idx_evaluations_name_id": "evaluations (name, id)",
+}
+
+def run_migrations(db_file, convert_auto_vacuum: bool = False):
+    with closing(sqlite3.connect(db_file)) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
@@ -292,4 +311,148 @@ def run_migrations(db_file):
             ''')
             print("[MIGRATION] Added 'ha_frequency' column to 'watermeters' table")
 
-        conn.commit()
\ No newline at end of file
+        # add column bbox_polygon to watermeters table if it doesn't exist yet
+        # (the detected display polygon, the bounding box preview is rendered on request)
+        cursor.execute("PRAGMA table_info(watermeters)")
+        columns = [info[1] for info in cursor.fetchall()]
+        if 'bbox_polygon' not in columns:
+            cursor.execute('''
+                ALTER TABLE watermeters
+                ADD COLUMN bbox_polygon TEXT DEFAULT NULL
+            ''')
+            print("[MIGRATION] Added 'bbox_polygon' column to 'watermeters' table")
+
+        # add columns colored_digits_blob and th_digits_blob to evaluations table if they don't exist yet
+        # (binary digit images, see lib/meter_processing/digit_codec.py)
+        cursor.execute("PRAGMA table_info(evaluations)")
+        columns = [info[1] for info in cursor.fetchall()]
+        if 'colored_digits_blob' not in columns:
+            cursor.execute('''
+                ALTER TABLE evaluations
+                ADD COLUMN colored_digits_blob BLOB
+            ''')
+            cursor.execute('''
+                ALTER TABLE evaluations
+                ADD COLUMN th_digits_blob BLOB
+            ''')
+            print("[MIGRATION] Added 'colored_digits_blob' and 'th_digits_blob' columns to 'evaluations' table")
+
+        # add column roi_polygon to settings table if it doesn't exist yet
+        # (manually pinned display region, skips the detection, see lib/meter_processing/roi_cache.py)
+        cursor.execute("PRAGMA table_info(settings)")
+        columns = [info[1] for info in cursor.fetchall()]
+        if 'roi_polygon' not in columns:
+            cursor.execute('''
+                ALTER TABLE settings
+                ADD COLUMN roi_polygon TEXT DEFAULT NULL
+            ''')
+            print("[MIGRATION] Added 'roi_polygon' column to 'settings' table")
+
+        # add column model_variant to settings table if it doesn't exist yet
+        # (quantized / reduced input model exports, see lib/meter_processing/model_variants.py)
+        if 'model_variant' not in columns:
+            cursor.execute('''
+                ALTER TABLE settings
+                ADD COLUMN model_variant TEXT DEFAULT NULL
+            ''')
+            print("[MIGRATION] Added 'model_variant' column to 'settings' table")
+
+        # add composite indexes for the per-meter lookups (latest entries, pagination, retention)
+        # tests/test_query_plans.py (and tools/check_query_plans.py) verify that the hot queries use them
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexes = [row[0] for row in cursor.fetchall()]
+        for index_name, definition in INDEXES.items():
+            if index_name not in indexes:
+                cursor.execute(f"CREATE INDEX {index_name} ON {definition}")
+                print(f"[MIGRATION] Added index '{index_name}'")
+
+        conn.commit()
+
+        migrate_digit_images(conn)
+
+        # Let the retention job return freed pages to the file system with PRAGMA incremental_vacuum.
+        # New databases are created with it (schema.py). On an existing database the mode only changes
+        # with a VACUUM, which rewrites the whole file, so it is opt-in (retention.convert_auto_vacuum).
+        if convert_auto_vacuum:
+            enable_incremental_vacuum(conn, db_file)
+
+
+def enable_incremental_vacuum(conn, db_file):
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] == 2:
+        return
+
+    # VACUUM writes a copy of the database (temp file and WAL), about twice its size may be needed
+    page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+    page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+    needed = 2 * page_count * page_size
+    free = shutil.disk_usage(os.path.dirname(os.path.abspath(db_file))).free
+    if free < needed:
+        print(f"[MIGRATION] Not enabling incremental auto_vacuum: the one-time VACUUM needs about {needed // 2 ** 20} MB "
+              f"of free disk space, {free // 2 ** 20} MB available")
+        return
+
+    print(f"[MIGRATION] Enabling incremental auto_vacuum (one-time VACUUM of {page_count * page_size // 2 ** 20} MB, this may take a while)")
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute("VACUUM")
+    print("[MIGRATION] Enabled incremental auto_vacuum")
+
+
+def _decode_legacy_images(images_json, mode):
+    images = []
+    for image_b64 in json.loads(images_json):
+        image = Image.open(BytesIO(base64.b64decode(image_b64))).convert(mode)
+        images.append(np.array(image))
+    return images
+
+
+# Convert the digit images of evaluations from json arrays of base64 PNGs to the binary format.
+# Runs in chunks with a commit after each one, so multi-GB databases are not converted in a single
+# transaction, and an interrupted migration continues on the next start.
+# The inverted thresholded digits are dropped, they are derived on read.
+def migrate_digit_images(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM evaluations WHERE colored_digits IS NOT NULL OR th_digits IS NOT NULL")
+    total = cursor.fetchone()[0]
+    if total == 0:
+        return
+
+    print(f"[MIGRATION] Converting digit images of {total} evaluations to binary format")
+    last_id = 0
+    converted = 0
+    failed = 0
+    while True:
+        cursor.execute('''
+            SELECT id, colored_digits, th_digits FROM evaluations
+            WHERE id > ? AND (colored_digits IS NOT NULL OR th_digits IS NOT NULL)
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, DIGIT_MIGRATION_CHUNK))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        for row_id, colored_json, th_json in rows:
+            last_id = row_id
+            try:
+                colored_blob = encode_colored_digits(_decode_legacy_images(colored_json, "RGB")) if colored_json else None
+                th_blob = encode_th_digits(_decode_legacy_images(th_json, "L")) if th_json else None
+            except Exception as e:
+                # keep the row as it is, it is still readable through the legacy columns
+                print(f"[MIGRATION] Could not convert digit images of evaluation {row_id}: {e}")
+                failed += 1
+                continue
+
+            cursor.execute('''
+                UPDATE evaluations
+                SET colored_digits_blob = ?, th_digits_blob = ?,
+                    colored_digits = NULL, th_digits = NULL, th_digits_inverted = NULL
+                WHERE id = ?
+            ''', (colored_blob, th_blob, row_id))
+            converted += 1
+
+        conn.commit()
+        print(f"[MIGRATION] Converted digit images of {converted}/{total} evaluations")
+
+    print(f"[MIGRATION] Completed digit image conversion ({converted} converted, {failed} failed)")
\ No newline at end of file
@@ -0,0 +1,81 @@
+import sqlite3
+from contextlib import closing
+
+
+# Create the tables of a fresh database, changes to existing databases are done in migrations.py
+def create_tables(db_file):
+    with closing(sqlite3.connect(db_file)) as conn:
+        cursor = conn.cursor()
+        # only has an effect on a new, empty database (see migrations.py for existing ones)
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS watermeters (
+                        name TEXT PRIMARY KEY,
+                        picture_number INTEGER,
+                        wifi_rssi INTEGER,
+                        picture_format TEXT,
+                        picture_timestamp TEXT,
+                        picture_width INTEGER,
+                        picture_height INTEGER,
+                        picture_length INTEGER,
+                        picture_data TEXT,
+                        setup BOOLEAN DEFAULT 0,
+                        picture_data_bbox BLOB,
+                        source_type TEXT DEFAULT 'mqtt',
+                        ha_entity_camera TEXT DEFAULT NULL,
+                        ha_entity_led TEXT DEFAULT NULL,
+                        ha_frequency INTEGER DEFAULT 600,
+                        bbox_polygon TEXT DEFAULT NULL
+                    )
+                ''')
+        cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS settings (
+                        name TEXT PRIMARY KEY,
+                        threshold_low INTEGER,
+                        threshold_high INTEGER,
+                        threshold_last_low INTEGER,
+                        threshold_last_high INTEGER,
+                        islanding_padding INTEGER,
+                        segments INTEGER,
+                        rotated_180 BOOLEAN,
+                        shrink_last_3 BOOLEAN,
+                        extended_last_digit BOOLEAN,
+                        max_flow_rate FLOAT,
+                        conf_threshold REAL DEFAULT NULL,
+                        roi_polygon TEXT DEFAULT NULL,
+                        model_variant TEXT DEFAULT NULL,
+                        FOREIGN KEY(name) REFERENCES watermeters(name)
+                    )
+                ''')
+        # Add evaluations table
+        cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS evaluations (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT NOT NULL,
+                        colored_digits TEXT,
+                        th_digits TEXT,
+                        predictions TEXT,
+                        timestamp DATETIME,
+                        result INTEGER,
+                        total_confidence REAL,
+                        outdated BOOLEAN DEFAULT 0,
+                        denied_digits TEXT,
+                        th_digits_inverted TEXT,
+                        colored_digits_blob BLOB,
+                        th_digits_blob BLOB,
+                        FOREIGN KEY(name) REFERENCES watermeters(name)
+                    )
+                ''')
+        cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS history (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT NOT NULL,
+                        value INTEGER,
+                        confidence REAL,
+                        target_brightness REAL,
+                        timestamp TEXT,
+                        manual BOOLEAN,
+                        FOREIGN KEY(name) REFERENCES watermeters(name)
+                    )
+                ''')
+        conn.commit()
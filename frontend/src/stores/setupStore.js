@@ -121,6 +121,14 @@ export const useSetupStore = defineStore('setup', () => {
         const url = `api/watermeters/${meterId}/evaluations/sample/-1`;
         const response = await apiService.post(url);
 
+        if (response.status === 503) {
+          // the server is busy with live frames, wait as told and request this sample again
+          const retryAfter = parseInt(response.headers.get('Retry-After') || '1', 10);
+          await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+          offset--;
+          continue;
+        }
+
         if (response.ok) {
           const result = await response.json();
 
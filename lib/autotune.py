@@ -0,0 +1,140 @@
+"""
+Benchmarks the execution profiles on this host and records the fastest one.
+
+    python run.py --autotune
+
+Every profile gets a fresh MeterPredictor (ROI and prediction caches off, so every frame runs the
+full detector and classifier) and processes the stored pictures of the meters with as many threads
+as there are pipeline workers, like the MQTT pipeline does. The profile with the highest frame
+rate is written to autotune.json next to the database and used with inference.execution_profile
+"auto".
+"""
+import base64
+import gc
+import json
+import os
+import pathlib
+import platform
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from lib.meter_processing.execution_profiles import PROFILES, autotune_path
+from lib.meter_processing.frame import Frame
+from lib.meter_processing.meter_processing import MeterPredictor
+
+# settings of meters that are not set up yet (same as the defaults of new meters)
+_DEFAULT_SETUP = (7, False, False, False, 0, 100, 0, 100, 20)
+
+
+def load_sample_frames(db_file: str, limit: int = 16):
+    """(picture bytes, setup) of the stored latest pictures, setup = segments, rotation and thresholds."""
+    if not os.path.exists(db_file):
+        return []
+    # as_uri() escapes '?', '#' and '%' in the path
+    uri = pathlib.Path(db_file).resolve().as_uri() + "?mode=ro"
+    with closing(sqlite3.connect(uri, uri=True)) as conn:
+        rows = conn.execute('''
+            SELECT w.picture_data, s.segments, s.rotated_180, s.extended_last_digit, s.shrink_last_3,
+                   s.threshold_low, s.threshold_high, s.threshold_last_low, s.threshold_last_high, s.islanding_padding
+            FROM watermeters w LEFT JOIN settings s ON s.name = w.name
+            WHERE w.picture_data IS NOT NULL
+            LIMIT ?
+        ''', (limit,)).fetchall()
+    samples = []
+    for row in rows:
+        setup = tuple(_DEFAULT_SETUP[i] if value is None else value for i, value in enumerate(row[1:]))
+        samples.append((base64.b64decode(row[0]), setup))
+    return samples
+
+
+def synthetic_frames(count: int = 4):
+    """Noise pictures of camera size, only the detector is measured with these (nothing is found)."""
+    rng = np.random.default_rng(0)
+    samples = []
+    for _ in range(count):
+        img = rng.integers(0, 255, (960, 1280, 3), dtype=np.uint8)
+        ok, encoded = cv2.imencode(".jpg", img)
+        samples.append((encoded.tobytes(), _DEFAULT_SETUP))
+    return samples
+
+
+def _process(predictor: MeterPredictor, picture: bytes, setup):
+    segments, rotated_180, extended_last_digit, shrink_last_3, low, high, last_low, last_high, padding = setup
+    start = time.perf_counter()
+    frame = Frame.from_bytes("autotune", "", picture)
+    digits, _, _ = predictor.extract_display_and_segment(frame, segments, rotated_180, extended_last_digit, shrink_last_3)
+    if digits:
+        th_digits = predictor.apply_thresholds(digits, [low, high], [last_low, last_high], padding)
+        predictor.predict_digits(th_digits)
+    return time.perf_counter() - start
+
+
+def benchmark_profile(name: str, options: dict, samples, workers: int, rounds: int):
+    options = dict(options, execution_profile=name, execution_overrides={}, roi_cache=False, prediction_cache=False)
+    predictor = MeterPredictor(options)
+    try:
+        # warm up (arena allocation, memory patterns, thread pools)
+        for picture, setup in samples:
+            _process(predictor, picture, setup)
+
+        jobs = samples * rounds
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            latencies = list(executor.map(lambda sample: _process(predictor, *sample), jobs))
+        elapsed = time.perf_counter() - start
+    finally:
+        predictor.close()
+        del predictor
+        gc.collect()
+
+    latencies_ms = np.array(latencies) * 1000.0
+    return {
+        "frames_per_s": round(len(jobs) / elapsed, 2),
+        "latency_p50_ms": round(float(np.percentile(latencies_ms, 50)), 1),
+        "latency_p95_ms": round(float(np.percentile(latencies_ms, 95)), 1),
+    }
+
+
+def run_autotune(config, rounds: int = 5) -> int:
+    samples = load_sample_frames(config['dbfile'])
+    if samples:
+        print(f"[Autotune] Using {len(samples)} stored picture(s)")
+    else:
+        print("[Autotune] No stored pictures found, using synthetic frames (detector only)")
+        samples = synthetic_frames()
+
+    workers = max(1, int(config.get('pipeline', {}).get('workers', 2)))
+    options = config.get('inference', {})
+    results = {}
+    for name in PROFILES:
+        print(f"[Autotune] Benchmarking profile '{name}' ({len(samples) * rounds} frames, {workers} worker(s))...")
+        try:
+            results[name] = benchmark_profile(name, options, samples, workers, rounds)
+        except Exception as e:
+            print(f"[Autotune] Profile '{name}' failed: {e}")
+            continue
+        print(f"[Autotune] {name}: {results[name]}")
+
+    if not results:
+        print("[Autotune] No profile could be benchmarked")
+        return 1
+
+    best = max(results, key=lambda name: results[name]["frames_per_s"])
+    path = autotune_path(config)
+    with open(path, 'w') as f:
+        json.dump({
+            "profile": best,
+            "timestamp": datetime.now().isoformat(),
+            "host": {"machine": platform.machine(), "cpus": os.cpu_count(), "workers": workers},
+            "results": results,
+        }, f, indent=2)
+    print(f"[Autotune] Fastest profile: '{best}', recorded in {path}")
+    if options.get('execution_profile', 'low-memory') != 'auto':
+        print("[Autotune] Set inference.execution_profile to \"auto\" to use it")
+    return 0
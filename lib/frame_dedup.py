@@ -0,0 +1,110 @@
+import hashlib
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+# Early drop of frames that were already processed.
+# Exact repeats (a device resending after a reconnect, the retained message replayed on subscribe)
+# are recognized on the network thread by picture number and a hash of the base64 payload,
+# before anything is decoded. Optionally, pictures that look the same as the last evaluated one
+# (static scene, nothing consumed) skip detection and classification on the worker.
+
+# thumbnail for the near duplicate check (width, height), compared after blurring
+_THUMB_SIZE = (80, 60)
+
+
+def payload_hash(data_b64: str) -> bytes:
+    return hashlib.blake2b(data_b64.encode('ascii', 'ignore'), digest_size=16).digest()
+
+
+def picture_thumbnail(frame) -> np.ndarray:
+    """Small blurred greyscale version of the picture, from the cheapest reduced decode."""
+    grey = cv2.cvtColor(frame.reduced(8), cv2.COLOR_RGB2GRAY)
+    thumb = cv2.resize(grey, _THUMB_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.GaussianBlur(thumb, (3, 3), 0)
+
+
+class FrameDeduplicator:
+
+    def __init__(self, options: dict = None):
+        options = options or {}
+        self.enabled = options.get('enabled', True)
+        # number of recent pictures per meter an exact repeat is recognized against
+        self.window = max(1, int(options.get('window', 8)))
+        self.near_duplicate = options.get('near_duplicate', False)
+        # largest difference of a thumbnail pixel (0-255) that still counts as the same scene
+        self.near_duplicate_max_diff = options.get('near_duplicate_max_diff', 12)
+        # evaluate at least every n-th frame even if the scene looks static
+        self.near_duplicate_max_skip = options.get('near_duplicate_max_skip', 10)
+
+        self._recent = {}  # name -> deque of (picture_number, payload hash)
+        self._thumbnails = {}  # name -> (thumbnail of the last evaluated picture, frames skipped since)
+        self._lock = threading.Lock()
+
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+
+    def seed(self, rows):
+        """Remember the stored pictures (name, picture_number, picture_data), so replays after a restart are dropped too."""
+        with self._lock:
+            for name, picture_number, data_b64 in rows:
+                if data_b64:
+                    self._recent.setdefault(name, deque(maxlen=self.window)).append((picture_number, payload_hash(data_b64)))
+
+    def is_duplicate(self, name: str, picture_number, data_b64: str) -> bool:
+        """
+        True if the same picture number with the same content was seen recently, otherwise it is remembered.
+        The same content under a new picture number is a new reading (e.g. of a meter that does not move),
+        it is left to the near duplicate check. Runs on the network thread before the base64 decode.
+        """
+        if not self.enabled:
+            return False
+        key = (picture_number, payload_hash(data_b64))
+        with self._lock:
+            recent = self._recent.setdefault(name, deque(maxlen=self.window))
+            if key in recent:
+                self.exact_duplicates += 1
+                print(f"[Dedup ({name})] Dropping replayed picture {picture_number}")
+                return True
+            recent.append(key)
+            return False
+
+    def forget(self, name: str, data_b64: str):
+        """Undo is_duplicate for a picture that could not be queued, so a resend is processed."""
+        digest = payload_hash(data_b64)
+        with self._lock:
+            recent = self._recent.get(name)
+            if recent and recent[-1][1] == digest:
+                recent.pop()
+
+    def is_static(self, name: str, frame) -> bool:
+        """
+        Near duplicate check on the worker: True if the picture looks like the last evaluated one.
+        The reference is only replaced by evaluated pictures, so a slow drift still triggers an evaluation.
+        """
+        if not (self.enabled and self.near_duplicate):
+            return False
+        thumb = picture_thumbnail(frame)
+        with self._lock:
+            last = self._thumbnails.get(name)
+            if last is not None and last[0].shape == thumb.shape and last[1] < self.near_duplicate_max_skip:
+                diff = int(cv2.absdiff(last[0], thumb).max())
+                if diff <= self.near_duplicate_max_diff:
+                    self._thumbnails[name] = (last[0], last[1] + 1)
+                    self.near_duplicates += 1
+                    return True
+            self._thumbnails[name] = (thumb, 0)
+            return False
+
+    def invalidate(self, name: str):
+        with self._lock:
+            self._recent.pop(name, None)
+            self._thumbnails.pop(name, None)
+
+    def stats(self):
+        return {
+            "exact_duplicates": self.exact_duplicates,
+            "near_duplicates": self.near_duplicates,
+        }
@@ -0,0 +1,217 @@
+import threading
+import time
+import traceback
+from collections import deque
+
+from lib import metrics
+
+# Hand-off between the MQTT network thread and the inference worker threads.
+# One queue per meter, meters are served round-robin, frames of a meter in order and never in parallel.
+# A newer frame supersedes the queued ones of its meter, except those needed to keep processed
+# pictures at most continuity_gap seconds apart. Frames older than the deadline are skipped.
+# on_discard(name, data) is called for every accepted frame that is dropped without being processed.
+# With the "defer" overflow policy a frame that does not fit is rejected without being dropped, the caller
+# keeps it (e.g. in the ingest spool) and submits it again when on_space() is called.
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "defer")
+
+
+class FramePipeline:
+
+    def __init__(self, process_fn, workers: int = 2, queue_size: int = 64, overflow: str = "drop_oldest",
+                 coalesce: bool = True, deadline: float = 300.0, continuity_gap: float = 600.0, on_discard=None, on_space=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of {OVERFLOW_POLICIES}")
+        self.process_fn = process_fn
+        self.worker_count = max(1, int(workers))
+        self.queue_size = max(1, int(queue_size))
+        self.overflow = overflow
+        self.coalesce = coalesce
+        self.deadline = deadline or None
+        self.continuity_gap = continuity_gap or None
+        self.on_discard = on_discard
+        self.on_space = on_space
+
+        # name -> deque of (data, enqueued at (monotonic), picture time (epoch seconds))
+        self._queues = {}
+        # meters with queued frames that are not being processed, in round-robin order
+        self._ready = deque()
+        self._busy = set()  # names of meters currently being processed
+        # picture time of the last frame of each meter handed to a worker
+        self._last_picture_time = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._running = False
+
+        self.dropped = 0
+        self.deferred = 0
+        self.superseded = 0
+        self.expired = 0
+        self.processed = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self.worker_count):
+            thread = threading.Thread(target=self._worker, name=f"pipeline-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"[Pipeline] Started {self.worker_count} worker(s), queue size {self.queue_size}, overflow policy '{self.overflow}', "
+              f"latest-wins {'on' if self.coalesce else 'off'}, deadline {self.deadline}s, continuity gap {self.continuity_gap}s")
+
+    def stop(self, timeout: float = 5.0):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def depth(self) -> int:
+        with self._cond:
+            return self._size
+
+    def depth_by_meter(self):
+        """{(name,): queued frames} for the queue depth gauge."""
+        with self._cond:
+            return {(name,): len(queue) for name, queue in self._queues.items() if queue}
+
+    def submit(self, name: str, data, picture_time: float = None) -> bool:
+        """
+        Enqueue a frame without blocking. Returns False if the frame was dropped (or deferred).
+        picture_time (epoch seconds of the picture timestamp) is used for the history continuity,
+        the arrival time if it is not known.
+        """
+        with self._cond:
+            if picture_time is None:
+                picture_time = time.time()
+            queue = self._queues.get(name)
+            if queue is None:
+                queue = self._queues[name] = deque()
+            if self.coalesce and queue:
+                self._supersede(name, queue, picture_time)
+
+            if self._size >= self.queue_size:
+                if self.overflow == "defer":
+                    self.deferred += 1
+                    return False
+                self.dropped += 1
+                if self.overflow == "drop_newest":
+                    print(f"[Pipeline] Queue full, dropping new frame of {name}")
+                    metrics.REJECTIONS.inc(name, "queue_full")
+                    return False
+                old_name = self._drop_oldest()
+                print(f"[Pipeline] Queue full, dropping oldest frame of {old_name}")
+                metrics.REJECTIONS.inc(old_name, "queue_full")
+
+            queue.append((data, time.monotonic(), picture_time))
+            self._size += 1
+            if len(queue) == 1 and name not in self._busy:
+                self._ready.append(name)
+            self._cond.notify()
+            return True
+
+    # Drop the queued frames of a meter that a frame taken at picture_time makes redundant.
+    # A frame is kept if dropping it would leave more than continuity_gap seconds between the
+    # last frame handed to a worker (or the previous kept frame) and the next one.
+    def _supersede(self, name, queue, picture_time):
+        previous = self._last_picture_time.get(name)
+        items = list(queue)
+        following = [item[2] for item in items[1:]] + [picture_time]
+        kept = []
+        for item, next_time in zip(items, following):
+            if self.continuity_gap and previous is not None and next_time - previous > self.continuity_gap:
+                kept.append(item)
+                previous = item[2]
+            else:
+                self.superseded += 1
+                metrics.REJECTIONS.inc(name, "superseded")
+                self._discard(name, item)
+        if len(kept) != len(items):
+            self._size -= len(items) - len(kept)
+            queue.clear()
+            queue.extend(kept)
+            if not queue and name in self._ready:
+                self._ready.remove(name)
+
+    def _drop_oldest(self):
+        name = min((queue[0][1], name) for name, queue in self._queues.items() if queue)[1]
+        queue = self._queues[name]
+        self._discard(name, queue.popleft())
+        self._size -= 1
+        if not queue and name in self._ready:
+            self._ready.remove(name)
+        return name
+
+    def _discard(self, name, item):
+        if self.on_discard is not None:
+            try:
+                self.on_discard(name, item[0])
+            except Exception as e:
+                print(f"[Pipeline] Error discarding frame of {name}: {e}")
+
+    # Take the next frame of the next meter in round-robin order, skipping frames past the deadline.
+    def _next_item(self):
+        now = time.monotonic()
+        while self._ready:
+            name = self._ready.popleft()
+            queue = self._queues[name]
+            while queue:
+                item = queue.popleft()
+                self._size -= 1
+                if self.deadline and now - item[1] > self.deadline:
+                    self.expired += 1
+                    metrics.REJECTIONS.inc(name, "deadline")
+                    self._discard(name, item)
+                    print(f"[Pipeline] Skipping frame of {name}, waited {now - item[1]:.0f}s (deadline {self.deadline:.0f}s)")
+                    continue
+                self._busy.add(name)
+                self._last_picture_time[name] = item[2]
+                return name, item
+            del self._queues[name]
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                item = None
+                size = self._size
+                while self._running:
+                    item = self._next_item()
+                    # a frame was taken or frames past the deadline were skipped
+                    if item is not None or self._size < size:
+                        break
+                    self._cond.wait()
+                    size = self._size
+                if item is None and not self._running:
+                    return
+
+            # there is room in the queue again for frames the caller had to defer
+            if self.on_space is not None:
+                try:
+                    self.on_space()
+                except Exception as e:
+                    print(f"[Pipeline] Error refilling the queue: {e}")
+            if item is None:
+                continue
+            name, (data, _, _) = item
+
+            try:
+                self.process_fn(data)
+            except Exception as e:
+                print(f"[Pipeline] Error processing frame of {name}: {e}")
+                traceback.print_exc()
+            finally:
+                with self._cond:
+                    self._busy.discard(name)
+                    self.processed += 1
+                    # frames of this meter that arrived meanwhile, behind the meters that are already waiting
+                    queue = self._queues.get(name)
+                    if queue:
+                        self._ready.append(name)
+                    elif queue is not None:
+                        del self._queues[name]
+                    self._cond.notify_all()
@@ -1,35 +1,42 @@
 import base64
-import sqlite3
 import json
 
 from PIL import Image
 from io import BytesIO
 import numpy as np
 
-from lib.history_correction import correct_value
+from db.connection import get_database
+from lib import metrics
+from lib.history_correction import correct_value_from_history
+from lib.meter_processing.frame import Frame
+from lib.meter_processing.digit_codec import encode_colored_digits, encode_th_digits, decode_colored_digits
+from lib.meter_processing.image_encoding import encode_threshold_base64, bbox_info_json
 
 def reevaluate_digits(db_file: str, name: str, meter_preditor, config, offset: int = None):
-    with sqlite3.connect(db_file) as conn:
+    with get_database(db_file).read() as conn:
         cursor = conn.cursor()
 
         # Get eval from the database - either by offset or last
         if offset == -1:
             cursor.execute('''
-                SELECT colored_digits FROM evaluations
-                WHERE name = ?
-                ORDER BY RANDOM()
-                LIMIT 1
+                SELECT colored_digits_blob, colored_digits FROM evaluations
+                WHERE id = (
+                    SELECT id FROM evaluations
+                    WHERE name = ?
+                    ORDER BY RANDOM()
+                    LIMIT 1
+                )
             ''', (name,))
         elif offset is not None:
             cursor.execute('''
-                SELECT colored_digits FROM evaluations
+                SELECT colored_digits_blob, colored_digits FROM evaluations
                 WHERE name = ?
                 ORDER BY id DESC
                 LIMIT 1 OFFSET ?
             ''', (name, offset))
         else:
             cursor.execute('''
-                SELECT colored_digits FROM evaluations
+                SELECT colored_digits_blob, colored_digits FROM evaluations
                 WHERE name = ?
                 ORDER BY id DESC
                 LIMIT 1
@@ -39,14 +46,15 @@ def reevaluate_digits(db_file: str, name: str, meter_preditor, config, offset: i
             print(f"[ExampleSet ({name})] No evaluations found for {name}")
             return {"error": "No evaluations found"}
 
-        # parse the eval (json)
-        raw_images = json.loads(row[0])
-        # convert to np arrays (from base64)
-        digits = []
-        for raw_image in raw_images:
-            image_data = base64.b64decode(raw_image)
-            image = Image.open(BytesIO(image_data))
-            digits.append(np.array(image))
+        if row[0] is not None:
+            digits = decode_colored_digits(row[0])
+        else:
+            # not yet migrated row: json array of base64 PNGs
+            digits = []
+            for raw_image in json.loads(row[1]):
+                image_data = base64.b64decode(raw_image)
+                image = Image.open(BytesIO(image_data))
+                digits.append(np.array(image))
 
         # Get current settings for the watermeter
         cursor.execute('''
@@ -75,195 +83,237 @@ def reevaluate_digits(db_file: str, name: str, meter_preditor, config, offset: i
             print(f"[Eval ({name})] No thresholds found for {name}")
             return {"error": "No thresholds found"}
         else:
-            processed, digits, digits_inverted = meter_preditor.apply_thresholds(digits, thresholds, thresholds_last, islanding_padding)
+            digits = meter_preditor.apply_thresholds(digits, thresholds, thresholds_last, islanding_padding)
             prediction = meter_preditor.predict_digits(digits)
 
         return {
-            "processed_images": digits_inverted,
+            "processed_images": [encode_threshold_base64(digit, invert=True) for digit in digits],
             "predictions": prediction
         }
 
 
 
 
+# Settings of a meter that has no settings row yet (same as the defaults inserted for new meters)
+DEFAULT_SETTINGS = (0, 100, 0, 100, 20, 7, False, False, 1.0, False, None, None, None)
+
+# Loads everything an evaluation needs from the database: setup state, settings and the last two history entries.
+# setup is None if the watermeter does not exist yet.
+def load_evaluation_context(cursor, name: str):
+    cursor.execute("SELECT setup FROM watermeters WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    setup = (row[0] == 1) if row else None
+
+    cursor.execute('''
+               SELECT threshold_low, threshold_high, threshold_last_low, threshold_last_high, islanding_padding,
+                segments, shrink_last_3, extended_last_digit, max_flow_rate, rotated_180, conf_threshold, roi_polygon, model_variant
+               FROM settings
+               WHERE name = ?
+           ''', (name,))
+    settings = cursor.fetchone() or DEFAULT_SETTINGS
+
+    # value, timestamp, confidence for the correction, target_brightness of the last entry for the detection
+    cursor.execute("SELECT value, timestamp, confidence, target_brightness FROM history WHERE name = ? ORDER BY id DESC LIMIT 2", (name,))
+    history = cursor.fetchall()
+
+    return {
+        "setup": setup,
+        "settings": settings,
+        "history": history,
+        "target_brightness": history[0][3] if history else None
+    }
+
+# Runs detection, thresholding, classification and the history correction on a decoded frame.
+# Does not touch the database, returns None if no display was found.
+def evaluate_picture(frame: Frame, context, meter_preditor, config):
+    name = frame.name
+    timestamp = frame.timestamp
+    settings = context["settings"]
+    thresholds = [settings[0], settings[1]]
+    thresholds_last = [settings[2], settings[3]]
+    islanding_padding = settings[4]
+    segments = settings[5]
+    shrink_last_3 = settings[6]
+    extended_last_digit = settings[7]
+    max_flow_rate = settings[8]
+    rotated_180 = settings[9]
+    conf_threshold = settings[10] if settings[10] else 0.0
+    pinned_polygon = json.loads(settings[11]) if settings[11] else None
+    model_variant = settings[12]
+
+    def extract(polygon):
+        return meter_preditor.extract_display_and_segment(frame, segments=segments, shrink_last_3=shrink_last_3,
+                                                          extended_last_digit=extended_last_digit, rotated_180=rotated_180,
+                                                          target_brightness=context["target_brightness"], polygon=polygon,
+                                                          variant=model_variant)
+
+    # Use the pinned or cached display region if possible, YOLO only runs if there is none or it does not match anymore
+    roi_cache = meter_preditor.roi_cache
+    roi_key = (bool(rotated_180), frame.size)
+    cached_polygon = None if pinned_polygon else roi_cache.get(name, roi_key)
+    digits, target_brightness, obb_coords = extract(pinned_polygon or cached_polygon)
+    if cached_polygon is not None and not roi_cache.verify(name, digits):
+        cached_polygon = None
+        digits, target_brightness, obb_coords = extract(None)
+    if pinned_polygon is None and cached_polygon is None and digits:
+        roi_cache.store(name, roi_key, obb_coords, digits)
+
+    if not digits or len(digits) == 0:
+        print(f"[Eval ({name})] No result found")
+        metrics.REJECTIONS.inc(name, "no_display")
+        return None
+
+    # Apply thresholds and extract the digits
+    th_digits = []
+    prediction = []
+    if len(thresholds) == 0:
+        print(f"[Eval ({name})] No thresholds found for {name}")
+    else:
+        with metrics.time_stage("threshold", name):
+            th_digits = meter_preditor.apply_thresholds(digits, thresholds, thresholds_last, islanding_padding)
+        with metrics.time_stage("classify", name):
+            prediction = meter_preditor.predict_digits(th_digits, name=name, variant=model_variant)
+        if cached_polygon is not None:
+            roi_cache.check_confidence(name, prediction)
+
+    # check for each digit if its highest conf is above conf_threshold, otherwise mark it as denied
+    denied_digits = []
+    for digit_predictions in prediction:
+        if len(digit_predictions) == 0 or digit_predictions[0][1]*100 < conf_threshold:
+            denied_digits.append(True)
+        else:
+            denied_digits.append(False)
+    if any(denied_digits):
+        metrics.DENIED_DIGITS.inc(name, amount=sum(denied_digits))
+
+    # If the setup is finished, try to correct the value
+    value = None
+    confidence = 0
+    if context["setup"]:
+        with metrics.time_stage("correct_value", name):
+            r = correct_value_from_history(context["history"], name, [digits, th_digits, prediction, timestamp, denied_digits], allow_negative_correction=config["allow_negative_correction"], max_flow_rate=max_flow_rate)
+        if r is not None:
+            value, confidence = r
+        else:
+            metrics.REJECTIONS.inc(name, "correction_rejected")
+
+    return {
+        "timestamp": timestamp,
+        "target_brightness": target_brightness,
+        # Images stored with the evaluation in binary form (see digit_codec.py)
+        "colored_blob": encode_colored_digits(digits),
+        "th_blob": encode_th_digits(th_digits),
+        "prediction": prediction,
+        "denied_digits": denied_digits,
+        "value": value,
+        "confidence": confidence,
+        # Only the polygon is stored, the bounding box preview is rendered when requested
+        "bbox_info": bbox_info_json(obb_coords, rotated_180)
+    }
+
+# Writes the result of evaluate_picture (history entry, evaluation, display polygon).
+# Must be called with the cursor of an open write transaction.
+def save_evaluation(cursor, name: str, evaluation, config, skip_setup_overwriting = True):
+    value = evaluation["value"]
+    confidence = evaluation["confidence"]
+    timestamp = evaluation["timestamp"]
+    prediction = evaluation["prediction"]
+
+    if value is not None:
+        cursor.execute('''
+            INSERT INTO history (name, value, confidence, target_brightness, timestamp, manual)
+            VALUES (?,?,?,?,?,?)
+        ''', (
+            name,
+            value,
+            confidence,
+            evaluation["target_brightness"],
+            timestamp,
+            False
+        ))
+
+    # find id of last evaluation
+    cursor.execute('''
+        SELECT id FROM evaluations
+        WHERE name = ?
+        ORDER BY id DESC
+        LIMIT 1
+    ''', (name,))
+    row = cursor.fetchone()
+
+    if not skip_setup_overwriting and row is not None:
+        eval_id = row[0]
+
+        # replace the last evaluation if setup is not finished instead of adding a new one
+        cursor.execute('''
+                       UPDATE evaluations
+                       SET colored_digits = NULL,
+                           th_digits = NULL,
+                           th_digits_inverted = NULL,
+                           colored_digits_blob = ?,
+                           th_digits_blob = ?,
+                           predictions = ?,
+                           timestamp = ?,
+                           result = ?,
+                           total_confidence = ?
+                       WHERE name = ? AND id = ?
+                       ''', (
+                           evaluation["colored_blob"],
+                           evaluation["th_blob"],
+                           json.dumps(prediction) if prediction is not None else None,
+                           timestamp if isinstance(timestamp, str) and timestamp.strip() else None,
+                           value if value is not None else None,
+                           float(confidence) if confidence is not None else None,
+                           name,
+                           eval_id
+                       ))
+    else:
+        cursor.execute('''
+                       INSERT INTO evaluations
+                       (name, colored_digits_blob, th_digits_blob, predictions, timestamp, result, total_confidence, denied_digits)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                       ''', (
+                           name,
+                           evaluation["colored_blob"],
+                           evaluation["th_blob"],
+                           json.dumps(prediction) if prediction is not None else None,
+                           timestamp if isinstance(timestamp, str) and timestamp.strip() else None,
+                           value if value is not None else None,
+                           float(confidence) if confidence is not None else None,
+                           json.dumps(evaluation["denied_digits"])
+                       ))
+
+    # the bounding box preview is rendered from the polygon when requested
+    cursor.execute("UPDATE watermeters SET picture_data_bbox = NULL, bbox_polygon = ? WHERE name = ?", (evaluation["bbox_info"], name))
+
 # This file reevaluates the latest picture of a watermeter and saves the result in the database.
 def reevaluate_latest_picture(db_file: str, name:str, meter_preditor, config, publish: bool = False, skip_setup_overwriting = True, mqtt_client = None):
-    with sqlite3.connect(db_file) as conn:
+    db = get_database(db_file)
+    with db.read() as conn:
         cursor = conn.cursor()
 
         # get latest image from watermeter
-        cursor.execute("SELECT picture_data, picture_timestamp, setup FROM watermeters WHERE name = ? ORDER BY picture_number DESC LIMIT 1", (name,))
+        cursor.execute("SELECT picture_data, picture_timestamp FROM watermeters WHERE name = ? ORDER BY picture_number DESC LIMIT 1", (name,))
         row = cursor.fetchone()
         if not row:
-            conn.commit()
             print(f"[Eval ({name})] No picture found for {name}")
             return None
-        image_data = base64.b64decode(row[0])
-        timestamp = row[1]
-        setup = row[2] == 1
+        context = load_evaluation_context(cursor, name)
 
-        # Get current settings for the watermeter
-        cursor.execute('''
-                   SELECT threshold_low, threshold_high, threshold_last_low, threshold_last_high, islanding_padding,
-                    segments, shrink_last_3, extended_last_digit, max_flow_rate, rotated_180, conf_threshold
-                   FROM settings
-                   WHERE name = ?
-               ''', (name,))
-        settings = cursor.fetchone()
-        thresholds = [settings[0], settings[1]]
-        thresholds_last = [settings[2], settings[3]]
-        islanding_padding = settings[4]
-        segments = settings[5]
-        shrink_last_3 = settings[6]
-        extended_last_digit = settings[7]
-        max_flow_rate = settings[8]
-        rotated_180 = settings[9]
-        conf_threshold = settings[10] if settings[10] else 0.0
-
-        # Get the target_brightness from the last history entry
-        cursor.execute("SELECT target_brightness FROM history WHERE name = ? ORDER BY ROWID DESC LIMIT 1", (name,))
-        row = cursor.fetchone()
-        target_brightness = None
-        if row:
-            target_brightness = row[0]
-        conn.commit()
-        image = Image.open(BytesIO(image_data))
-
-        # Use the meter predictor to extract the digits from the image
-        result, digits, target_brightness, boundingboxed_image = meter_preditor.extract_display_and_segment(image, segments=segments, shrink_last_3=shrink_last_3,
-                                                                  extended_last_digit=extended_last_digit, rotated_180=rotated_180, target_brightness=target_brightness)
-
-        if not result or len(result) == 0:
-            print(f"[Eval ({name})] No result found")
-            return None
+    # Inference runs without holding any connection
+    frame = Frame.from_base64(name, row[1], row[0])
+    evaluation = evaluate_picture(frame, context, meter_preditor, config)
+    if evaluation is None:
+        return None
 
-        # Apply thresholds and extract the digits
-        processed = []
-        prediction = []
-        digits_inverted = []
-        if len(thresholds) == 0:
-            print(f"[Eval ({name})] No thresholds found for {name}")
-        else:
-            processed, digits, digits_inverted = meter_preditor.apply_thresholds(digits, thresholds, thresholds_last, islanding_padding)
-            prediction = meter_preditor.predict_digits(digits)
+    with db.write() as conn:
+        save_evaluation(conn.cursor(), name, evaluation, config, skip_setup_overwriting)
 
-        # check for each digit if its highest conf is above conf_threshold, otherwise mark it as denied
-        denied_digits = []
-        for digit_predictions in prediction:
-            if len(digit_predictions) == 0 or digit_predictions[0][1]*100 < conf_threshold:
-                denied_digits.append(True)
-            else:
-                denied_digits.append(False)
-
-        # If the setup is finished, try to correct the value and save the result
-        value = None
-        confidence = 0
-        if setup:
-            r = correct_value(db_file, name, [result, processed, prediction, timestamp, denied_digits], allow_negative_correction=config["allow_negative_correction"], max_flow_rate=max_flow_rate)
-            if r is not None:
-                value, confidence = r
-                cursor.execute('''
-                    INSERT INTO history (name, value, confidence, target_brightness, timestamp, manual)
-                    VALUES (?,?,?,?,?,?)
-                ''', (
-                    name,
-                    value,
-                    confidence,
-                    target_brightness,
-                    timestamp,
-                    False
-                ))
-
-                # remove old entries (keep 30)
-                cursor.execute('''
-                    DELETE FROM history
-                    WHERE name = ?
-                    AND ROWID NOT IN (
-                        SELECT ROWID
-                        FROM history
-                        WHERE name = ?
-                        ORDER BY ROWID DESC
-                        LIMIT ?
-                    )
-                ''', (name, name, config['max_history']))
-
-                if publish and mqtt_client:
-                    publish_value(mqtt_client, config, name, value)
-
-        curser = cursor.execute('''
-            SELECT COUNT(*) FROM evaluations  
-            WHERE name = ?
-        ''', (name,))
-        count = curser.fetchone()[0]
-
-
-        if not skip_setup_overwriting and count > 0:
-            # find id of last evaluation
-            cursor.execute('''
-                SELECT id FROM evaluations
-                WHERE name = ?
-                ORDER BY id DESC
-                LIMIT 1
-            ''', (name,))
-            row = cursor.fetchone()
-            eval_id = row[0]
-
-            # replace the last evaluation if setup is not finished instead of adding a new one
-            cursor.execute('''
-                           UPDATE evaluations
-                           SET colored_digits = ?,
-                               th_digits = ?,
-                               predictions = ?,
-                               timestamp = ?,
-                               result = ?,
-                               total_confidence = ?,
-                               th_digits_inverted = ?
-                           WHERE name = ? AND id = ?
-                           ''', (
-                               json.dumps(result) if result is not None else None,
-                               json.dumps(processed) if processed is not None else None,
-                               json.dumps(prediction) if prediction is not None else None,
-                               timestamp if isinstance(timestamp, str) and timestamp.strip() else None,
-                               value if value is not None else None,
-                               float(confidence) if confidence is not None else None,
-                               json.dumps(digits_inverted),
-                               name,
-                               eval_id
-                           ))
-        else:
-            cursor.execute('''
-                           INSERT INTO evaluations
-                           (name, colored_digits, th_digits, predictions, timestamp, result, total_confidence, denied_digits, th_digits_inverted)
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                           ''', (
-                               name,
-                               json.dumps(result) if result is not None else None,
-                               json.dumps(processed) if processed is not None else None,
-                               json.dumps(prediction) if prediction is not None else None,
-                               timestamp if isinstance(timestamp, str) and timestamp.strip() else None,
-                               value if value is not None else None,
-                               float(confidence) if confidence is not None else None,
-                               json.dumps(denied_digits),
-                               json.dumps(digits_inverted)
-                           ))
-
-        # remove old evaluations
-        cursor.execute('''
-                   DELETE FROM evaluations
-                   WHERE name = ?
-                   AND ROWID NOT IN (
-                       SELECT ROWID
-                       FROM evaluations
-                       WHERE name = ?
-                       ORDER BY ROWID DESC
-                       LIMIT ?
-                   )
-               ''', (name, name, config['max_evals']))
+    if evaluation["value"] is not None and publish and mqtt_client:
+        publish_value(mqtt_client, config, name, evaluation["value"])
 
-        conn.commit()
-
-        print(f"[Eval ({name})] Prediction saved")
-        return target_brightness, confidence, boundingboxed_image
+    print(f"[Eval ({name})] Prediction saved")
+    return evaluation["target_brightness"], evaluation["confidence"], evaluation["bbox_info"]
 
 # Function to publish the value to the MQTT broker, compatible with Home Assistant
 def publish_value(mqtt_client, config, name, value):
@@ -272,7 +322,8 @@ def publish_value(mqtt_client, config, name, value):
     dict = {
         "value": int(value) / 1000.0,
     }
-    mqtt_client.publish(topic, json.dumps(dict), qos=1, retain=True)
+    with metrics.time_stage("mqtt_publish", name):
+        mqtt_client.publish(topic, json.dumps(dict), qos=1, retain=True)
     print(f"[Eval/MQTT ({name})] Value published ({value} m³)")
 
 # Function to publish the registration to the MQTT broker, compatible with Home Assistant
@@ -297,9 +348,9 @@ def publish_registration(mqtt_client, config, name, type):
     mqtt_client.publish(topic, json.dumps(dict), qos=1, retain=True)
     print(f"[Eval/MQTT ({name})] HA compatible Registration published")
 
-# Function to add a history entry to the database, removing old entries
+# Function to add a history entry to the database (old entries are removed by the retention job)
 def add_history_entry(db_file: str, name: str, value: int, confidence:int, target_brightness: float, timestamp: str, config, manual: bool = False):
-    with sqlite3.connect(db_file) as conn:
+    with get_database(db_file).write() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO history (name, value, confidence, target_brightness, timestamp, manual)
@@ -313,18 +364,4 @@ def add_history_entry(db_file: str, name: str, value: int, confidence:int, targe
             manual
         ))
 
-        # remove old entries (keep 30)
-        cursor.execute('''
-            DELETE FROM history
-            WHERE name = ?
-            AND ROWID NOT IN (
-                SELECT ROWID
-                FROM history
-                WHERE name = ?
-                ORDER BY ROWID DESC
-                LIMIT ?
-            )
-        ''', (name, name, config['max_history']))
-
-        conn.commit()
         print(f"[Eval ({name})] History entry added")
\ No newline at end of file
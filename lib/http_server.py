@@ -1,5 +1,6 @@
 import json
 import os
+from contextlib import contextmanager
 from io import BytesIO
 import shutil
 import tempfile
@@ -18,11 +19,16 @@ from typing import List, Optional
 import aiohttp
 
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import JSONResponse, FileResponse, StreamingResponse
+from starlette.responses import JSONResponse, FileResponse, StreamingResponse, PlainTextResponse
 
+from db.connection import get_database
+from lib import metrics
 from lib.functions import reevaluate_latest_picture, add_history_entry, reevaluate_digits
+from lib.inference_pool import get_inference_pool
+from lib.inference_scheduler import get_inference_scheduler, SchedulerSaturated
 from lib.meter_processing.meter_processing import MeterPredictor
-from lib.model_singleton import get_meter_predictor
+from lib.meter_processing.image_encoding import encode_threshold_base64, stored_digits_base64, render_bbox_base64
+from lib.model_singleton import get_meter_predictor, loaded_meter_predictor
 from lib.global_alerts import get_alerts, add_alert
 
 
@@ -32,16 +38,40 @@ from lib.global_alerts import get_alerts, add_alert
 def prepare_setup_app(config, lifespan):
     app = FastAPI(lifespan=lifespan)
     SECRET_KEY = config['secret_key']
-    db_connection = lambda: sqlite3.connect(config['dbfile'])
+    database = lambda: get_database(config['dbfile'])
 
     # Warn user if secret key is not changed
     if config['secret_key'] == "change_me" and config['enable_auth']:
         add_alert("authentication", "Please change the secret key in the configuration file!")
 
     # Get singleton instance of meter predictor (shared with MQTT handler)
-    meter_preditor = get_meter_predictor()
-
-    print("[HTTP] Using shared meter predictor singleton instance.")
+    # In process mode the live frames are evaluated by the inference workers, the models are only
+    # loaded in this process when a setup request needs them.
+    predictor = lambda: get_meter_predictor(config)
+    if get_inference_pool() is None:
+        predictor()
+        print("[HTTP] Using shared meter predictor singleton instance.")
+    else:
+        print("[HTTP] Process mode, the meter predictor is loaded on the first setup request.")
+
+    # Cached display regions / predictions of a meter are stale after its settings changed
+    def invalidate_caches(name: str, predictions: bool = True):
+        loaded = loaded_meter_predictor()
+        if loaded is not None:
+            loaded.roi_cache.invalidate(name)
+            if predictions:
+                loaded.prediction_cache.invalidate(name)
+
+    # Setup requests and sample benchmarks share the predictor with the live MQTT frames, see inference_scheduler.py
+    scheduler = get_inference_scheduler(config)
+
+    @contextmanager
+    def inference_slot(priority_class: str, name: str = None):
+        try:
+            with scheduler.slot(priority_class, name):
+                yield
+        except SchedulerSaturated as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
     # CORS Konfiguration
     app.add_middleware(
@@ -109,6 +139,12 @@ def prepare_setup_app(config, lifespan):
         max_flow_rate: float
         conf_threshold: Optional[float] = None
 
+    class RoiRequest(BaseModel):
+        polygon: Optional[List[float]] = None
+
+    class ModelVariantRequest(BaseModel):
+        variant: Optional[str] = None
+
     class EvalRequest(BaseModel):
         eval: str
 
@@ -133,17 +169,25 @@ def prepare_setup_app(config, lifespan):
         # allow alnum, dash and underscore; replace others with _
         return re.sub(r"[^A-Za-z0-9_-]", "_", name)
 
+    # Digit images are stored in binary form (see digit_codec.py), rows that could not be
+    # migrated still have the json arrays of base64 PNGs
+    def _digit_images(blob, legacy_json, kind):
+        if blob is not None:
+            return stored_digits_base64(blob, kind)
+        return json.loads(legacy_json) if legacy_json else None
+
     @app.get("/api/discovery", dependencies=[Depends(authenticate)])
     def get_discovery():
-        cursor = db_connection().cursor()
-        cursor.execute("SELECT name, picture_timestamp, wifi_rssi FROM watermeters WHERE setup = 0")
-        return {
-            "watermeters": [row for row in cursor.fetchall()],
-            "capabilities": {
-                "mqtt": True,
-                "ha": config["is_ha"],
+        with database().read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name, picture_timestamp, wifi_rssi FROM watermeters WHERE setup = 0")
+            return {
+                "watermeters": [row for row in cursor.fetchall()],
+                "capabilities": {
+                    "mqtt": True,
+                    "ha": config["is_ha"],
+                }
             }
-        }
 
     @app.post("/api/dataset/upload", dependencies=[Depends(authenticate)])
     def upload_dataset(payload: DatasetUpload):
@@ -278,7 +322,9 @@ def prepare_setup_app(config, lifespan):
             image = np.array(image)
 
             # Apply threshold with the passed values
-            base64r, digits = meter_preditor.apply_threshold(image, threshold_low, threshold_high, islanding_padding, invert=invert)
+            with inference_slot("interactive"):
+                digit = predictor().apply_threshold(image, threshold_low, threshold_high, islanding_padding)
+            base64r = encode_threshold_base64(digit, invert=invert)
 
             # Return the result
             return {"base64": base64r}
@@ -293,6 +339,21 @@ def prepare_setup_app(config, lifespan):
         del tconfig['secret_key']
         return tconfig
 
+    @app.get("/api/metrics", dependencies=[Depends(authenticate)])
+    def get_metrics():
+        """Pipeline stage timings, counters and gauges in the Prometheus text format (see lib/metrics.py)."""
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.get("/api/inference/stats", dependencies=[Depends(authenticate)])
+    def get_inference_stats():
+        # not loaded in process mode until a setup request needed it
+        loaded = loaded_meter_predictor()
+        return {
+            "roi_cache": loaded.roi_cache.stats() if loaded else None,
+            "prediction_cache": loaded.prediction_cache.stats() if loaded else None,
+            "scheduler": scheduler.stats()
+        }
+
     @app.get("/api/ha/entities", dependencies=[Depends(authenticate)])
     async def get_ha_entities(entity_type: Optional[str] = None):
         """
@@ -342,62 +403,72 @@ def prepare_setup_app(config, lifespan):
 
     @app.get("/api/watermeters", dependencies=[Depends(authenticate)])
     def get_watermeters():
-        cursor = db_connection().cursor()
-        cursor.execute("""
-            SELECT 
-                w.name, 
-                w.picture_timestamp, 
-                w.wifi_rssi,
-                (SELECT value FROM history h WHERE h.name = w.name ORDER BY timestamp DESC LIMIT 1),
-                (SELECT th_digits_inverted FROM evaluations e WHERE e.name = w.name ORDER BY id DESC LIMIT 1)
-            FROM watermeters w 
-            WHERE w.setup = 1
-        """)
-
-        result = []
-        for row in cursor.fetchall():
-            th_digits = json.loads(row[4]) if row[4] else None
-            result.append((row[0], row[1], row[2], row[3], th_digits))
-
-        return {"watermeters": result}
+        with database().read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT 
+                    w.name, 
+                    w.picture_timestamp, 
+                    w.wifi_rssi,
+                    (SELECT value FROM history h WHERE h.name = w.name ORDER BY timestamp DESC LIMIT 1),
+                    e.th_digits_blob,
+                    e.th_digits_inverted
+                FROM watermeters w 
+                LEFT JOIN evaluations e ON e.id = (SELECT id FROM evaluations WHERE name = w.name ORDER BY id DESC LIMIT 1)
+                WHERE w.setup = 1
+            """)
+
+            result = []
+            for row in cursor.fetchall():
+                th_digits = _digit_images(row[4], row[5], 'th_inverted')
+                result.append((row[0], row[1], row[2], row[3], th_digits))
+
+            return {"watermeters": result}
 
     @app.post("/api/setup/{name}/finish", dependencies=[Depends(authenticate)])
     def post_setup_finished(name: str, data: SetupData):
-        db = db_connection()
-        cursor = db.cursor()
-        cursor.execute("UPDATE watermeters SET setup = 1 WHERE name = ?", (name,))
-        db.commit()
-        target_brightness, confidence, _ = reevaluate_latest_picture(config['dbfile'], name, meter_preditor, config, skip_setup_overwriting=False)
+        # the slot is taken first, a busy scheduler leaves the meter in setup mode
+        with inference_slot("interactive", name):
+            with database().write() as conn:
+                conn.execute("UPDATE watermeters SET setup = 1 WHERE name = ?", (name,))
+            target_brightness, confidence, _ = reevaluate_latest_picture(config['dbfile'], name, predictor(), config, skip_setup_overwriting=False)
         add_history_entry(config['dbfile'], name, data.value, 1, target_brightness, data.timestamp, config, manual=True)
 
         # clear evaluations
-        cursor = db.cursor()
-        cursor.execute("UPDATE evaluations SET outdated = true WHERE name = ?", (name,))
-        db.commit()
+        with database().write() as conn:
+            conn.execute("UPDATE evaluations SET outdated = true WHERE name = ?", (name,))
 
         return {"message": "Setup completed"}
 
     @app.post("/api/setup/{name}/enable", dependencies=[Depends(authenticate)])
     def post_setup_enable(name: str):
-        db = db_connection()
-        cursor = db.cursor()
-        cursor.execute("UPDATE watermeters SET setup = 0 WHERE name = ?", (name,))
-        db.commit()
-        return {"message": "Setup completed"}
+        with database().write() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE watermeters SET setup = 0 WHERE name = ?", (name,))
+            return {"message": "Setup completed"}
 
     @app.get("/api/watermeters/{name}/history", dependencies=[Depends(authenticate)])
     def get_watermeter_history(name: str):
-        cursor = db_connection().cursor()
-        cursor.execute("SELECT value, timestamp, confidence, manual FROM history WHERE name = ?", (name,))
-        return {"history": [row for row in cursor.fetchall()]}
+        with database().read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value, timestamp, confidence, manual FROM history WHERE name = ? ORDER BY id", (name,))
+            return {"history": [row for row in cursor.fetchall()]}
 
     @app.get("/api/watermeters/{name}", dependencies=[Depends(authenticate)])
     def get_watermeter(name: str):
-        cursor = db_connection().cursor()
-        cursor.execute("SELECT * FROM watermeters WHERE name = ?", (name,))
-        row = cursor.fetchone()
+        with database().read() as conn:
+            row = conn.execute("""
+                SELECT name, picture_number, wifi_rssi, picture_format, picture_timestamp, picture_width,
+                       picture_height, picture_length, picture_data, picture_data_bbox, bbox_polygon
+                FROM watermeters WHERE name = ?
+            """, (name,)).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Watermeter not found")
+
+        # render the bounding box preview only when requested (cached per picture)
+        data_bbox = row[9]
+        if data_bbox is None and row[8] and row[10]:
+            data_bbox = render_bbox_base64(row[8], row[10], cache_key=(row[0], row[1], row[4]))
         # check for dataset presence under configured output root for this meter
         out_root = config.get('output_dataset', '/data/output_dataset')
         meter_root = os.path.join(out_root, _sanitize_name(name))
@@ -419,46 +490,45 @@ def prepare_setup_app(config, lifespan):
                 "height": row[6],
                 "length": row[7],
                 "data": row[8],
-                "data_bbox": row[10]
+                "data_bbox": data_bbox
             },
             "dataset_present": dataset_present
         }
 
     @app.delete("/api/watermeters/{name}", dependencies=[Depends(authenticate)])
     def delete_watermeter(name: str):
-        db = db_connection()
-        cursor = db.cursor()
-        cursor.execute("DELETE FROM watermeters WHERE name = ?", (name,))
-        cursor.execute("DELETE FROM evaluations WHERE name = ?", (name,))
-        cursor.execute("DELETE FROM history WHERE name = ?", (name,))
-        cursor.execute("DELETE FROM settings WHERE name = ?", (name,))
-        db.commit()
+        with database().write() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM watermeters WHERE name = ?", (name,))
+            cursor.execute("DELETE FROM evaluations WHERE name = ?", (name,))
+            cursor.execute("DELETE FROM history WHERE name = ?", (name,))
+            cursor.execute("DELETE FROM settings WHERE name = ?", (name,))
+        invalidate_caches(name)
         return {"message": "Watermeter deleted", "name": name}
 
     @app.post("/api/setup", dependencies=[Depends(authenticate)])
     def setup_watermeter(config: ConfigRequest):
-        db = db_connection()
-        cursor = db.cursor()
-        cursor.execute(
-            """
-            INSERT INTO watermeters (name, picture_number, wifi_rssi, picture_format, 
-            picture_timestamp, picture_width, picture_height, picture_length, picture_data, setup) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
-            """,
-            (
-                config.name,
-                config.picture_number,
-                config.WiFi_RSSI,
-                config.picture.format,
-                config.picture.timestamp,
-                config.picture.width,
-                config.picture.height,
-                config.picture.length,
-                config.picture.data
+        with database().write() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO watermeters (name, picture_number, wifi_rssi, picture_format, 
+                picture_timestamp, picture_width, picture_height, picture_length, picture_data, setup) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+                """,
+                (
+                    config.name,
+                    config.picture_number,
+                    config.WiFi_RSSI,
+                    config.picture.format,
+                    config.picture.timestamp,
+                    config.picture.width,
+                    config.picture.height,
+                    config.picture.length,
+                    config.picture.data
+                )
             )
-        )
-        db.commit()
-        return {"message": "Watermeter configured", "name": config.name}
+            return {"message": "Watermeter configured", "name": config.name}
 
     @app.post("/api/watermeters/ha", dependencies=[Depends(authenticate)])
     def create_ha_watermeter(ha_config: HAWatermeterRequest):
@@ -473,31 +543,30 @@ def prepare_setup_app(config, lifespan):
         if not config.get('is_ha', False):
             raise HTTPException(status_code=400, detail="Not running as Home Assistant addon")
 
-        db = db_connection()
-        cursor = db.cursor()
-
-        # Check if watermeter with this name already exists
-        cursor.execute("SELECT name FROM watermeters WHERE name = ?", (ha_config.name,))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail=f"Watermeter with name '{ha_config.name}' already exists")
-
         try:
-            # Insert new HA-based watermeter with source_type='ha'
-            cursor.execute(
-                """
-                INSERT INTO watermeters (
-                    name, source_type, ha_entity_camera, ha_entity_led, ha_frequency, setup
-                ) VALUES (?, ?, ?, ?, ?, 0)
-                """,
-                (
-                    ha_config.name,
-                    'ha',
-                    ha_config.ha_entity_camera,
-                    ha_config.ha_entity_led,
-                    ha_config.ha_frequency
+            with database().write() as conn:
+                cursor = conn.cursor()
+
+                # Check if watermeter with this name already exists
+                cursor.execute("SELECT name FROM watermeters WHERE name = ?", (ha_config.name,))
+                if cursor.fetchone():
+                    raise HTTPException(status_code=400, detail=f"Watermeter with name '{ha_config.name}' already exists")
+
+                # Insert new HA-based watermeter with source_type='ha'
+                cursor.execute(
+                    """
+                    INSERT INTO watermeters (
+                        name, source_type, ha_entity_camera, ha_entity_led, ha_frequency, setup
+                    ) VALUES (?, ?, ?, ?, ?, 0)
+                    """,
+                    (
+                        ha_config.name,
+                        'ha',
+                        ha_config.ha_entity_camera,
+                        ha_config.ha_entity_led,
+                        ha_config.ha_frequency
+                    )
                 )
-            )
-            db.commit()
 
             return {
                 "message": "HA watermeter created successfully",
@@ -507,6 +576,8 @@ def prepare_setup_app(config, lifespan):
                 "ha_entity_led": ha_config.ha_entity_led,
                 "ha_frequency": ha_config.ha_frequency
             }
+        except HTTPException:
+            raise
         except sqlite3.IntegrityError as e:
             raise HTTPException(status_code=400, detail=f"Database error: {str(e)}")
         except Exception as e:
@@ -515,76 +586,116 @@ def prepare_setup_app(config, lifespan):
     @app.get("/api/settings/{name}", dependencies=[Depends(authenticate)])
     @app.get("/api/watermeters/{name}/settings", dependencies=[Depends(authenticate)])
     def get_settings(name: str):
-        cursor = db_connection().cursor()
-        cursor.execute("SELECT threshold_low, threshold_high, threshold_last_low, threshold_last_high, islanding_padding, segments, shrink_last_3, extended_last_digit, max_flow_rate, rotated_180, conf_threshold FROM settings WHERE name = ?", (name,))
-        row = cursor.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Thresholds not found")
-        return {
-            "threshold_low": row[0],
-            "threshold_high": row[1],
-            "threshold_last_low": row[2],
-            "threshold_last_high": row[3],
-            "islanding_padding": row[4],
-            "segments": row[5],
-            "shrink_last_3": row[6],
-            "extended_last_digit": row[7],
-            "max_flow_rate": row[8],
-            "rotated_180": row[9],
-            "conf_threshold": row[10]
-        }
+        with database().read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT threshold_low, threshold_high, threshold_last_low, threshold_last_high, islanding_padding, segments, shrink_last_3, extended_last_digit, max_flow_rate, rotated_180, conf_threshold, roi_polygon, model_variant FROM settings WHERE name = ?", (name,))
+            row = cursor.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Thresholds not found")
+            return {
+                "threshold_low": row[0],
+                "threshold_high": row[1],
+                "threshold_last_low": row[2],
+                "threshold_last_high": row[3],
+                "islanding_padding": row[4],
+                "segments": row[5],
+                "shrink_last_3": row[6],
+                "extended_last_digit": row[7],
+                "max_flow_rate": row[8],
+                "rotated_180": row[9],
+                "conf_threshold": row[10],
+                "roi_polygon": json.loads(row[11]) if row[11] else None,
+                "model_variant": row[12]
+            }
 
     @app.post("/api/settings", dependencies=[Depends(authenticate)])
     def set_settings(settings: SettingsRequest):
-        db = db_connection()
-        cursor = db.cursor()
-        cursor.execute(
-            """
-            INSERT INTO settings (name, threshold_low, threshold_high, threshold_last_low, threshold_last_high, islanding_padding, segments, shrink_last_3, extended_last_digit, max_flow_rate, rotated_180, conf_threshold) 
-            VALUES (?, ?, ?, ?,?,?, ?, ? , ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET 
-            threshold_low=excluded.threshold_low, threshold_high=excluded.threshold_high, threshold_last_low=excluded.threshold_last_low, threshold_last_high=excluded.threshold_last_high,
-            islanding_padding=excluded.islanding_padding,
-            segments=excluded.segments, shrink_last_3=excluded.shrink_last_3, extended_last_digit=excluded.extended_last_digit, max_flow_rate=excluded.max_flow_rate, rotated_180=excluded.rotated_180, conf_threshold=excluded.conf_threshold
-            """,
-            (settings.name, settings.threshold_low, settings.threshold_high, settings.threshold_last_low, settings.threshold_last_high, settings.islanding_padding,
-             settings.segments, settings.shrink_last_3, settings.extended_last_digit, settings.max_flow_rate, settings.rotated_180, settings.conf_threshold)
-        )
-        db.commit()
+        with database().write() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO settings (name, threshold_low, threshold_high, threshold_last_low, threshold_last_high, islanding_padding, segments, shrink_last_3, extended_last_digit, max_flow_rate, rotated_180, conf_threshold) 
+                VALUES (?, ?, ?, ?,?,?, ?, ? , ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET 
+                threshold_low=excluded.threshold_low, threshold_high=excluded.threshold_high, threshold_last_low=excluded.threshold_last_low, threshold_last_high=excluded.threshold_last_high,
+                islanding_padding=excluded.islanding_padding,
+                segments=excluded.segments, shrink_last_3=excluded.shrink_last_3, extended_last_digit=excluded.extended_last_digit, max_flow_rate=excluded.max_flow_rate, rotated_180=excluded.rotated_180, conf_threshold=excluded.conf_threshold
+                """,
+                (settings.name, settings.threshold_low, settings.threshold_high, settings.threshold_last_low, settings.threshold_last_high, settings.islanding_padding,
+                 settings.segments, settings.shrink_last_3, settings.extended_last_digit, settings.max_flow_rate, settings.rotated_180, settings.conf_threshold)
+            )
+        # detect the display again with the new settings
+        invalidate_caches(settings.name, predictions=False)
         return {"message": "Thresholds set", "name": settings.name}
 
     @app.put("/api/watermeters/{name}/settings", dependencies=[Depends(authenticate)])
     def update_settings(name: str, settings: SettingsUpdateRequest):
-        db = db_connection()
-        cursor = db.cursor()
-        cursor.execute(
-            """
-            INSERT INTO settings (name, threshold_low, threshold_high, threshold_last_low, threshold_last_high, islanding_padding, segments, shrink_last_3, extended_last_digit, max_flow_rate, rotated_180, conf_threshold) 
-            VALUES (?, ?, ?, ?,?,?, ?, ? , ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET 
-            threshold_low=excluded.threshold_low, threshold_high=excluded.threshold_high, threshold_last_low=excluded.threshold_last_low, threshold_last_high=excluded.threshold_last_high,
-            islanding_padding=excluded.islanding_padding,
-            segments=excluded.segments, shrink_last_3=excluded.shrink_last_3, extended_last_digit=excluded.extended_last_digit, max_flow_rate=excluded.max_flow_rate, rotated_180=excluded.rotated_180, conf_threshold=excluded.conf_threshold
-            """,
-            (name, settings.threshold_low, settings.threshold_high, settings.threshold_last_low, settings.threshold_last_high, settings.islanding_padding,
-             settings.segments, settings.shrink_last_3, settings.extended_last_digit, settings.max_flow_rate, settings.rotated_180, settings.conf_threshold)
-        )
-        db.commit()
+        with database().write() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO settings (name, threshold_low, threshold_high, threshold_last_low, threshold_last_high, islanding_padding, segments, shrink_last_3, extended_last_digit, max_flow_rate, rotated_180, conf_threshold) 
+                VALUES (?, ?, ?, ?,?,?, ?, ? , ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET 
+                threshold_low=excluded.threshold_low, threshold_high=excluded.threshold_high, threshold_last_low=excluded.threshold_last_low, threshold_last_high=excluded.threshold_last_high,
+                islanding_padding=excluded.islanding_padding,
+                segments=excluded.segments, shrink_last_3=excluded.shrink_last_3, extended_last_digit=excluded.extended_last_digit, max_flow_rate=excluded.max_flow_rate, rotated_180=excluded.rotated_180, conf_threshold=excluded.conf_threshold
+                """,
+                (name, settings.threshold_low, settings.threshold_high, settings.threshold_last_low, settings.threshold_last_high, settings.islanding_padding,
+                 settings.segments, settings.shrink_last_3, settings.extended_last_digit, settings.max_flow_rate, settings.rotated_180, settings.conf_threshold)
+            )
+        # detect the display again with the new settings
+        invalidate_caches(name, predictions=False)
         return {"message": "Settings updated", "name": name}
 
+    @app.put("/api/watermeters/{name}/roi", dependencies=[Depends(authenticate)])
+    def set_roi(name: str, roi: RoiRequest):
+        """
+        Pin the display region of a meter (4 corners as 8 values, full resolution, in the picture after
+        the 180 degree rotation setting), YOLO is not run for this meter anymore. null removes the pin.
+        """
+        if roi.polygon is not None and len(roi.polygon) != 8:
+            raise HTTPException(status_code=400, detail="polygon needs 8 values (4 corners)")
+        with database().write() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE settings SET roi_polygon = ? WHERE name = ?",
+                           (json.dumps(roi.polygon) if roi.polygon is not None else None, name))
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Settings not found")
+        invalidate_caches(name, predictions=False)
+        return {"message": "ROI pinned" if roi.polygon is not None else "ROI unpinned", "name": name}
+
+    @app.get("/api/models/variants", dependencies=[Depends(authenticate)])
+    def get_model_variants():
+        """Model variants built by tools/build_model_variants.py with their accuracy / latency report."""
+        return {
+            "variants": predictor().variants.specs,
+            "report": predictor().variants.report
+        }
+
+    @app.put("/api/watermeters/{name}/model", dependencies=[Depends(authenticate)])
+    def set_model_variant(name: str, request: ModelVariantRequest):
+        """Select the model variant of a meter, null for the default fp32 models."""
+        if request.variant is not None and request.variant not in predictor().variants.names():
+            raise HTTPException(status_code=400, detail=f"Unknown model variant '{request.variant}'")
+        with database().write() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE settings SET model_variant = ? WHERE name = ?", (request.variant, name))
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Settings not found")
+        # the display region and the cached predictions came from the previous models
+        invalidate_caches(name)
+        return {"message": "Model variant set", "name": name, "variant": request.variant}
+
     @app.post("/api/watermeters/{name}/evaluations/reevaluate", dependencies=[Depends(authenticate)])
     def reevaluate_latest(name: str):
         try:
-            r = reevaluate_latest_picture(config['dbfile'], name, meter_preditor, config, skip_setup_overwriting=False)
+            with inference_slot("interactive", name):
+                r = reevaluate_latest_picture(config['dbfile'], name, predictor(), config, skip_setup_overwriting=False)
             if r is None: return {"result": False}
-            _, _, bbox_base64 = r
-
-            # update in watermeters table
-            db = db_connection()
-            cursor = db.cursor()
-            cursor.execute("UPDATE watermeters SET picture_data_bbox = ? WHERE name = ?", (bbox_base64, name))
-            db.commit()
             print(f"[HTTP] Re-evaluated latest picture for watermeter {name}")
             return {"result": True}
 
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Re-evaluation failed: {str(e)}")
 
@@ -594,22 +705,17 @@ def prepare_setup_app(config, lifespan):
         # returns a set of random digits from historic evaluations for the given watermeter, evaluated with the current settings
         # if offset is provided, returns the evaluation at that offset from the latest (0 = latest, 1 = second latest, etc.)
         # if offset is -1, returns a random evaluation
-        return reevaluate_digits(config['dbfile'], name, meter_preditor, config, offset)
+        # random samples are requested in a loop by the setup benchmark and run as bulk work
+        with inference_slot("bulk" if offset == -1 else "interactive", name):
+            return reevaluate_digits(config['dbfile'], name, predictor(), config, offset)
 
     # GET endpoint for retrieving evaluations
     @app.get("/api/watermeters/{name}/evals", dependencies=[Depends(authenticate)])
     def get_evals(name: str, amount: int = None, from_id: int = None):
-        cursor = db_connection().cursor()
-        # Check if watermeter exists
-        cursor.execute("SELECT name FROM watermeters WHERE name = ?", (name,))
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="Watermeter not found")
-        # Retrieve all evaluations for the watermeter
-        cursor = db_connection().cursor()
-
         # Build query with optional pagination
         query = """
-            SELECT colored_digits, th_digits, predictions, timestamp, result, total_confidence, outdated, id, denied_digits, th_digits_inverted
+            SELECT colored_digits, th_digits, predictions, timestamp, result, total_confidence, outdated, id, denied_digits, th_digits_inverted,
+                   colored_digits_blob, th_digits_blob
             FROM evaluations
             WHERE name = ?
         """
@@ -625,36 +731,43 @@ def prepare_setup_app(config, lifespan):
             query += " LIMIT ?"
             params.append(amount)
 
-        cursor.execute(query, params)
+        with database().read() as conn:
+            cursor = conn.cursor()
+            # Check if watermeter exists
+            cursor.execute("SELECT name FROM watermeters WHERE name = ?", (name,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail="Watermeter not found")
+            # Retrieve all evaluations for the watermeter
+            rows = cursor.execute(query, params).fetchall()
+
         return {"evals": [{
             "id": row[7],
-            "colored_digits": json.loads(row[0]) if row[0] else None,
-            "th_digits": json.loads(row[1]) if row[1] else None,
+            "colored_digits": _digit_images(row[10], row[0], 'colored'),
+            "th_digits": _digit_images(row[11], row[1], 'th'),
             "predictions": json.loads(row[2]) if row[2] else None,
             "timestamp": row[3],
             "result": row[4],
             "total_confidence": row[5],
             "outdated": row[6],
             "denied_digits": json.loads(row[8]) if row[8] else None,
-            "th_digits_inverted": json.loads(row[9]) if row[9] else None
-        } for row in cursor.fetchall()]}
+            "th_digits_inverted": _digit_images(row[11], row[9], 'th_inverted')
+        } for row in rows]}
 
     # POST endpoint for adding an evaluation
     @app.post("/api/watermeters/{name}/evals", dependencies=[Depends(authenticate)])
     def add_eval(name: str, eval_req: EvalRequest):
-        db = db_connection()
-        cursor = db.cursor()
-        # Check if watermeter exists
-        cursor.execute("SELECT name FROM watermeters WHERE name = ?", (name,))
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="Watermeter not found")
-        # Insert the new evaluation
-        cursor.execute(
-            "INSERT INTO evaluations (name, eval) VALUES (?, ?)",
-            (name, eval_req.eval)
-        )
-        db.commit()
-        return {"message": "Eval added", "name": name}
+        with database().write() as conn:
+            cursor = conn.cursor()
+            # Check if watermeter exists
+            cursor.execute("SELECT name FROM watermeters WHERE name = ?", (name,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail="Watermeter not found")
+            # Insert the new evaluation
+            cursor.execute(
+                "INSERT INTO evaluations (name, eval) VALUES (?, ?)",
+                (name, eval_req.eval)
+            )
+            return {"message": "Eval added", "name": name}
 
     @app.get("/")
     async def serve_index():
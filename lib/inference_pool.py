@@ -0,0 +1,284 @@
+"""
+Optional multi-process inference for the MQTT pipeline (pipeline.mode = "processes").
+
+Letterbox, warp, thresholding and islanding hold the GIL for much of their runtime, so pipeline
+worker threads alone do not use more than a few cores. In process mode every pipeline worker
+thread drives one worker process that has its own MeterPredictor and runs evaluate_picture;
+database writes and MQTT publishing stay in the main process.
+
+    main process                                 worker process
+    pipeline thread -- picture bytes (shm) -->   Frame, evaluate_picture
+                    <-- digit blobs (shm)  ---   evaluation (small fields pickled)
+
+The encoded picture and the encoded digit images go through one multiprocessing.shared_memory
+block per direction and worker, only the settings context and the predictions are pickled.
+Pictures or results larger than a block (pipeline.process_slot_bytes) are pickled instead.
+
+The workers are forked when the pool is created, which run.py does before any thread is started
+or any ONNX session is created: they share the imported libraries copy-on-write with the main
+process and create their own sessions. A worker that dies is not replaced (forking a process with
+live ONNX Runtime threads is not safe), the remaining workers take over its meters.
+
+Each worker keeps its own ROI and prediction caches. Frames of a meter go to the worker that had
+it last if it is idle, and a worker drops the cached entries of a meter when the settings it
+receives for it change (the HTTP server can only invalidate the caches of its own predictor).
+"""
+import multiprocessing
+import signal
+import threading
+import traceback
+from multiprocessing import shared_memory
+
+from lib import metrics
+
+DEFAULT_SLOT_BYTES = 8 * 1024 * 1024
+
+# metrics recorded by evaluate_picture in the worker, sent back with the result and recorded in the main process
+_CAPTURED_METRICS = ("STAGE_SECONDS", "REJECTIONS", "DENIED_DIGITS")
+_BLOB_FIELDS = ("colored_blob", "th_blob")
+
+
+class _CapturedMetric:
+
+    def __init__(self, name: str, events: list):
+        self.name = name
+        self.events = events
+
+    def observe(self, *labels, value):
+        self.events.append((self.name, "observe", labels, value))
+
+    def inc(self, *labels, amount=1):
+        self.events.append((self.name, "inc", labels, amount))
+
+
+def _worker_main(config, conn, in_name, out_name):
+    # the main process handles Ctrl+C and closes the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # imported here, the main process may never load the models itself
+    from lib.functions import evaluate_picture
+    from lib.meter_processing.execution_profiles import autotune_path
+    from lib.meter_processing.frame import Frame
+    from lib.meter_processing.meter_processing import MeterPredictor
+
+    events = []
+    for attr in _CAPTURED_METRICS:
+        setattr(metrics, attr, _CapturedMetric(attr, events))
+
+    in_shm = shared_memory.SharedMemory(name=in_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        # not the singleton: a forked worker must not use sessions the main process may have created
+        options = dict(config.get('inference', {}))
+        options.setdefault('autotune_file', autotune_path(config))
+        predictor = MeterPredictor(options)
+        conn.send(("ready", predictor.execution_profile))
+        fingerprints = {}
+
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                break
+            if job is None:
+                break
+            name, timestamp, length, data, context = job
+            if data is None:
+                data = bytes(in_shm.buf[:length])
+
+            # settings changed through the API since the last frame: the cached region/predictions may be wrong
+            fingerprint = (context["setup"] is None, tuple(context["settings"]))
+            if fingerprints.get(name, fingerprint) != fingerprint:
+                predictor.roi_cache.invalidate(name)
+                predictor.prediction_cache.invalidate(name)
+            fingerprints[name] = fingerprint
+
+            del events[:]
+            error = None
+            evaluation = None
+            try:
+                evaluation = evaluate_picture(Frame.from_bytes(name, timestamp, data), context, predictor, config)
+            except Exception as e:
+                error = f"{e}\n{traceback.format_exc()}"
+
+            lengths = None
+            if evaluation is not None:
+                blobs = [evaluation[field] or b"" for field in _BLOB_FIELDS]
+                if sum(len(blob) for blob in blobs) <= out_shm.size:
+                    offset = 0
+                    lengths = []
+                    for field, blob in zip(_BLOB_FIELDS, blobs):
+                        out_shm.buf[offset:offset + len(blob)] = blob
+                        offset += len(blob)
+                        lengths.append(len(blob) if evaluation[field] is not None else None)
+                        evaluation[field] = None
+            conn.send(("result", evaluation, lengths, list(events), error))
+    finally:
+        in_shm.close()
+        out_shm.close()
+
+
+class _Worker:
+
+    def __init__(self, index, context, config, slot_bytes):
+        self.index = index
+        self.in_shm = shared_memory.SharedMemory(create=True, size=slot_bytes)
+        self.out_shm = shared_memory.SharedMemory(create=True, size=slot_bytes)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, name=f"inference-worker-{index}", daemon=True,
+                                       args=(config, child_conn, self.in_shm.name, self.out_shm.name))
+        self.process.start()
+        child_conn.close()
+        self.alive = True
+        self.execution_profile = None
+
+    def wait_ready(self, timeout):
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"inference worker {self.index} did not start within {timeout}s")
+        _, self.execution_profile = self.conn.recv()
+
+    def close(self):
+        self.alive = False
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        for shm in (self.in_shm, self.out_shm):
+            shm.close()
+            shm.unlink()
+
+
+class InferenceProcessPool:
+
+    def __init__(self, config, processes: int, slot_bytes: int = DEFAULT_SLOT_BYTES, job_timeout: float = 60.0,
+                 execution_profile: str = "throughput", start_method: str = "fork"):
+        # the workers run single threaded sessions by default, the pool provides the parallelism
+        worker_config = dict(config)
+        worker_config['inference'] = dict(config.get('inference', {}), execution_profile=execution_profile)
+        self.job_timeout = job_timeout
+        context = multiprocessing.get_context(start_method)
+        self._workers = [_Worker(i, context, worker_config, slot_bytes) for i in range(max(1, int(processes)))]
+        for worker in self._workers:
+            worker.wait_ready(max(job_timeout, 120))
+        self._idle = list(self._workers)
+        self._affinity = {}  # meter name -> worker that processed its last frame
+        self._cond = threading.Condition()
+        print(f"[InferencePool] Started {len(self._workers)} worker process(es) ({start_method}), "
+              f"execution profile '{self._workers[0].execution_profile}', {slot_bytes // 1024} KiB shared memory per slot")
+
+    @property
+    def size(self) -> int:
+        return sum(1 for worker in self._workers if worker.alive)
+
+    def _acquire(self, name):
+        with self._cond:
+            while not self._idle:
+                if self.size == 0:
+                    raise RuntimeError("all inference worker processes have died")
+                self._cond.wait()
+            worker = self._affinity.get(name)
+            if worker not in self._idle:
+                worker = self._idle[0]
+            self._idle.remove(worker)
+            self._affinity[name] = worker
+            return worker
+
+    def _release(self, worker):
+        with self._cond:
+            if worker.alive:
+                self._idle.append(worker)
+            self._cond.notify_all()
+
+    def _fail(self, worker, reason):
+        print(f"[InferencePool] Worker {worker.index} {reason}, {self.size - 1} worker(s) left")
+        worker.close()
+        with self._cond:
+            for name in [name for name, w in self._affinity.items() if w is worker]:
+                del self._affinity[name]
+
+    def evaluate(self, frame, context):
+        """evaluate_picture(frame, context, ...) on a worker process, same result (or exception)."""
+        worker = self._acquire(frame.name)
+        try:
+            data = frame.data
+            if len(data) <= worker.in_shm.size:
+                worker.in_shm.buf[:len(data)] = data
+                data = None
+            worker.conn.send((frame.name, frame.timestamp, len(frame.data), data, context))
+            if not worker.conn.poll(self.job_timeout):
+                self._fail(worker, f"did not answer within {self.job_timeout}s")
+                raise TimeoutError(f"inference of {frame.name} timed out")
+            _, evaluation, lengths, events, error = worker.conn.recv()
+        except TimeoutError:
+            # a subclass of OSError, the worker did not die
+            raise
+        except (EOFError, OSError) as e:
+            if worker.alive:
+                self._fail(worker, f"died ({e})")
+            raise RuntimeError(f"inference worker died while evaluating {frame.name}")
+        else:
+            if lengths is not None:
+                offset = 0
+                for field, length in zip(_BLOB_FIELDS, lengths):
+                    if length is not None:
+                        evaluation[field] = bytes(worker.out_shm.buf[offset:offset + length])
+                        offset += length
+        finally:
+            self._release(worker)
+
+        for metric, method, labels, value in events:
+            if method == "observe":
+                getattr(metrics, metric).observe(*labels, value=value)
+            else:
+                getattr(metrics, metric).inc(*labels, amount=value)
+        if error is not None:
+            raise RuntimeError(f"evaluation of {frame.name} failed in worker {worker.index}: {error}")
+        return evaluation
+
+    def close(self):
+        with self._cond:
+            workers, self._idle = self._workers, []
+            self._cond.notify_all()
+        for worker in workers:
+            if worker.alive:
+                worker.close()
+        with self._cond:
+            self._cond.notify_all()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_inference_pool(config=None):
+    """
+    The process pool if pipeline.mode is "processes", otherwise None.
+    Created on the first call with a config, run.py does that before any thread is started.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None and config is not None:
+            pipeline_config = config.get('pipeline', {})
+            if pipeline_config.get('mode', 'threads') == 'processes':
+                _pool = InferenceProcessPool(
+                    config,
+                    processes=pipeline_config.get('processes') or multiprocessing.cpu_count(),
+                    slot_bytes=pipeline_config.get('process_slot_bytes', DEFAULT_SLOT_BYTES),
+                    job_timeout=pipeline_config.get('process_job_timeout', 60.0),
+                    execution_profile=pipeline_config.get('process_execution_profile', 'throughput'),
+                    start_method=pipeline_config.get('process_start_method', 'fork'),
+                )
+        return _pool
+
+
+def close_inference_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
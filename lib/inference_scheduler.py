@@ -0,0 +1,160 @@
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from lib import metrics
+
+# Admission control for the shared MeterPredictor.
+# Live frames (MQTT pipeline workers), interactive setup requests and bulk jobs (sample
+# benchmarks of the setup UI) take a slot before running inference. At most max_concurrent
+# slots are in use, each class has its own limit, and a free slot goes to the waiting class
+# with the highest priority. A class limit below max_concurrent keeps the remaining slots for
+# the classes above it, e.g. the setup UI can never take all slots away from live frames.
+#
+# Live callers wait as long as it takes (the pipeline queue bounds them). Interactive and bulk
+# callers are rejected with SchedulerSaturated when too many of their class are already waiting
+# or no slot frees up within their timeout, the HTTP server answers 503 with Retry-After.
+
+CLASSES = ("live", "interactive", "bulk")  # highest priority first
+
+DEFAULT_CLASS_OPTIONS = {
+    "live": {"limit": None, "max_waiting": None, "timeout": None},
+    "interactive": {"limit": 1, "max_waiting": 4, "timeout": 2.0},
+    "bulk": {"limit": 1, "max_waiting": 1, "timeout": 0.5},
+}
+
+
+class SchedulerSaturated(Exception):
+
+    def __init__(self, priority_class: str, retry_after: int):
+        super().__init__(f"Inference scheduler saturated for {priority_class} requests, retry in {retry_after}s")
+        self.priority_class = priority_class
+        self.retry_after = retry_after
+
+
+class InferenceScheduler:
+
+    def __init__(self, options: dict = None):
+        options = options or {}
+        self.max_concurrent = max(1, int(options.get('max_concurrent', 2)))
+        self.classes = {}
+        for name in CLASSES:
+            class_options = dict(DEFAULT_CLASS_OPTIONS[name])
+            class_options.update(options.get(name, {}))
+            limit = class_options['limit']
+            class_options['limit'] = self.max_concurrent if limit is None else max(1, min(int(limit), self.max_concurrent))
+            self.classes[name] = class_options
+
+        self._cond = threading.Condition()
+        self._running = {name: 0 for name in CLASSES}
+        self._waiting = {name: deque() for name in CLASSES}
+        # moving average of the slot hold time per class, for Retry-After
+        self._hold_time = {name: 1.0 for name in CLASSES}
+        self.rejected = {name: 0 for name in CLASSES}
+        self.completed = {name: 0 for name in CLASSES}
+
+        metrics.SCHEDULER_SLOTS.add_function(self._slot_gauges)
+        print(f"[Scheduler] {self.max_concurrent} inference slot(s), class limits "
+              + ", ".join(f"{name} {opts['limit']}" for name, opts in self.classes.items()))
+
+    # A waiter may take a slot if it is first of its class, its class is below its limit and
+    # no class with a higher priority has a waiter that could run instead.
+    def _can_run(self, priority_class, ticket):
+        if sum(self._running.values()) >= self.max_concurrent:
+            return False
+        for name in CLASSES:
+            if name == priority_class:
+                break
+            if self._waiting[name] and self._running[name] < self.classes[name]['limit']:
+                return False
+        return (self._waiting[priority_class][0] is ticket
+                and self._running[priority_class] < self.classes[priority_class]['limit'])
+
+    def _retry_after(self, priority_class):
+        ahead = len(self._waiting[priority_class]) + self._running[priority_class]
+        slots = self.classes[priority_class]['limit']
+        return max(1, math.ceil(self._hold_time[priority_class] * (ahead / slots + 1)))
+
+    def _reject(self, priority_class, meter):
+        self.rejected[priority_class] += 1
+        metrics.REJECTIONS.inc(meter or "", f"scheduler_{priority_class}")
+        return SchedulerSaturated(priority_class, self._retry_after(priority_class))
+
+    @contextmanager
+    def slot(self, priority_class: str, meter: str = None):
+        """
+        Hold an inference slot of the given class for the duration of the block.
+        Raises SchedulerSaturated for interactive and bulk callers if the scheduler is busy.
+        """
+        class_options = self.classes[priority_class]
+        ticket = object()
+        start = time.perf_counter()
+        with self._cond:
+            max_waiting = class_options['max_waiting']
+            if max_waiting is not None and len(self._waiting[priority_class]) >= max_waiting:
+                raise self._reject(priority_class, meter)
+            queue = self._waiting[priority_class]
+            queue.append(ticket)
+            timeout = class_options['timeout']
+            deadline = None if timeout is None else start + timeout
+            try:
+                while not self._can_run(priority_class, ticket):
+                    remaining = None if deadline is None else deadline - time.perf_counter()
+                    if remaining is not None and remaining <= 0:
+                        raise self._reject(priority_class, meter)
+                    self._cond.wait(remaining)
+            finally:
+                queue.remove(ticket)
+                # the next waiter of this class (or of a lower class) may be able to run now
+                self._cond.notify_all()
+            self._running[priority_class] += 1
+
+        acquired = time.perf_counter()
+        metrics.STAGE_SECONDS.observe("scheduler_wait", meter or "", value=acquired - start)
+        try:
+            yield
+        finally:
+            held = time.perf_counter() - acquired
+            with self._cond:
+                self._running[priority_class] -= 1
+                self.completed[priority_class] += 1
+                self._hold_time[priority_class] = 0.8 * self._hold_time[priority_class] + 0.2 * held
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "classes": {name: {
+                    "limit": self.classes[name]['limit'],
+                    "running": self._running[name],
+                    "waiting": len(self._waiting[name]),
+                    "completed": self.completed[name],
+                    "rejected": self.rejected[name],
+                    "avg_hold_s": round(self._hold_time[name], 3),
+                } for name in CLASSES}
+            }
+
+    def _slot_gauges(self):
+        with self._cond:
+            gauges = {(name, "running"): self._running[name] for name in CLASSES}
+            gauges.update({(name, "waiting"): len(self._waiting[name]) for name in CLASSES})
+        return gauges
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_inference_scheduler(config=None):
+    """
+    Get the scheduler shared by the MQTT handler and the HTTP server.
+    The config is only used when the instance is created on the first call.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = InferenceScheduler(config.get('scheduler', {}) if config else {})
+        return _scheduler
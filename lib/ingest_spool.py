@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from lib import metrics
+
+# Durable spool between the MQTT network thread and the pipeline workers (ingest_spool.enabled).
+# The network thread appends the payload and queues its sequence number, the worker reads it back and
+# acknowledges it when done. Frames that were not acknowledged are replayed on startup.
+# Appends are written by a flusher thread, one transaction (synchronous=FULL) every flush_interval_ms.
+# Above max_frames / max_mb the oldest frames are dropped.
+
+DEFAULT_OPTIONS = {
+    "flush_interval_ms": 50,
+    "max_frames": 5000,
+    "max_mb": 512,
+}
+
+
+def spool_path(config) -> str:
+    """The spool is stored next to the database (persistent in the addon)."""
+    return config.get('ingest_spool', {}).get('path') or os.path.join(os.path.dirname(config.get('dbfile', '')) or '.', 'spool.sqlite')
+
+
+class IngestSpool:
+
+    def __init__(self, path: str, options: dict = None):
+        self.path = path
+        self.options = dict(DEFAULT_OPTIONS)
+        self.options.update(options or {})
+        self.flush_interval = self.options['flush_interval_ms'] / 1000.0
+        self.max_frames = max(1, int(self.options['max_frames']))
+        self.max_bytes = int(self.options['max_mb'] * 1024 * 1024)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # auto_vacuum only takes effect on a new (empty) file
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS frames (seq INTEGER PRIMARY KEY, name TEXT NOT NULL, received REAL NOT NULL, payload BLOB NOT NULL)")
+        self._conn.commit()
+        self._db_lock = threading.Lock()
+
+        # seq -> (name, size) of every frame that is not acknowledged, oldest first
+        self._live = OrderedDict(
+            (seq, (name, size)) for seq, name, size in self._conn.execute("SELECT seq, name, LENGTH(payload) FROM frames ORDER BY seq"))
+        self._bytes = sum(size for _, size in self._live.values())
+        self._next_seq = (next(reversed(self._live)) + 1) if self._live else 1
+        # appended but not written yet, and the batch the flusher is writing right now
+        self._pending = OrderedDict()
+        self._writing = {}
+        self._acked = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.appended = 0
+        self.acked = 0
+        self.evicted = 0
+
+        metrics.SPOOL_FRAMES.add_function(lambda: {(): len(self._live)})
+        metrics.SPOOL_BYTES.add_function(lambda: {(): self._bytes})
+        if self._live:
+            print(f"[Spool] {len(self._live)} unprocessed frame(s) in {path}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flusher, name="spool-flusher", daemon=True)
+            self._thread.start()
+
+    def append(self, name: str, payload: bytes) -> int:
+        """Spool a message payload, returns its sequence number. Never waits for the disk."""
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._pending[seq] = (name, time.time(), bytes(payload))
+            self._live[seq] = (name, len(payload))
+            self._bytes += len(payload)
+            self.appended += 1
+            while len(self._live) > 1 and (len(self._live) > self.max_frames or self._bytes > self.max_bytes):
+                old_seq, (old_name, _) = next(iter(self._live.items()))
+                print(f"[Spool] Spool full, dropping oldest frame of {old_name}")
+                metrics.REJECTIONS.inc(old_name, "spool_full")
+                self.evicted += 1
+                self._ack_locked(old_seq)
+            return seq
+
+    def get(self, seq: int):
+        """Payload of a spooled frame, None if it was dropped or acknowledged."""
+        with self._lock:
+            if seq not in self._live:
+                return None
+            entry = self._pending.get(seq) or self._writing.get(seq)
+            if entry is not None:
+                return entry[2]
+        with self._db_lock:
+            row = self._conn.execute("SELECT payload FROM frames WHERE seq = ?", (seq,)).fetchone()
+        return row[0] if row else None
+
+    def contains(self, seq: int) -> bool:
+        """False once the frame was acknowledged or dropped from the full spool."""
+        with self._lock:
+            return seq in self._live
+
+    def ack(self, seq: int):
+        """The frame was processed (or deliberately skipped), it is not replayed anymore."""
+        with self._lock:
+            if seq in self._live:
+                self.acked += 1
+                self._ack_locked(seq)
+
+    def _ack_locked(self, seq):
+        _, size = self._live.pop(seq)
+        self._bytes -= size
+        # never written: nothing to delete
+        if self._pending.pop(seq, None) is None:
+            self._acked.append(seq)
+
+    def pending(self):
+        """(seq, name) of the frames that are not acknowledged, oldest first (replayed on startup)."""
+        with self._lock:
+            return [(seq, name) for seq, (name, _) in self._live.items()]
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, OrderedDict()
+            acked, self._acked = self._acked, []
+            self._writing = batch
+        if not batch and not acked:
+            return
+        try:
+            with self._db_lock:
+                if batch:
+                    self._conn.executemany("INSERT INTO frames (seq, name, received, payload) VALUES (?,?,?,?)",
+                                           [(seq, name, received, payload) for seq, (name, received, payload) in batch.items()])
+                if acked:
+                    self._conn.executemany("DELETE FROM frames WHERE seq = ?", [(seq,) for seq in acked])
+                self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"[Spool] Could not write the spool: {e}")
+            with self._db_lock:
+                self._conn.rollback()
+            with self._lock:
+                # try again with the next batch (frames acknowledged meanwhile are not written)
+                self._pending = OrderedDict(list((seq, entry) for seq, entry in batch.items() if seq in self._live) + list(self._pending.items()))
+                self._acked = acked + self._acked
+        finally:
+            with self._lock:
+                self._writing = {}
+        if acked:
+            self._compact()
+
+    def _compact(self):
+        with self._lock:
+            empty = not self._live
+        with self._db_lock:
+            free, total = (self._conn.execute(f"PRAGMA {pragma}").fetchone()[0] for pragma in ("freelist_count", "page_count"))
+            if empty or free * 4 > total:
+                # executescript runs the pragma to completion, execute() would only free a single page
+                self._conn.executescript("PRAGMA incremental_vacuum;")
+            if empty:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _flusher(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[Spool] Flush failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"frames": len(self._live), "bytes": self._bytes, "appended": self.appended, "acked": self.acked, "evicted": self.evicted}
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
@@ -0,0 +1,102 @@
+"""
+Compact binary storage format for the digit images of an evaluation.
+
+- thresholded digits: the 64x40 classifier inputs as 8 bit greyscale, zlib compressed
+- colored digits: all segments side by side in a single lossless PNG strip
+- inverted thresholded digits are not stored, they are derived on read
+"""
+import struct
+import zlib
+
+import cv2
+import numpy as np
+
+TH_VERSION = 2
+COLORED_VERSION = 1
+
+# version, count, height, width
+_TH_HEADER = struct.Struct('<BBHH')
+# version, count, channels
+_COLORED_HEADER = struct.Struct('<BBB')
+# width, height per digit
+_COLORED_SIZE = struct.Struct('<HH')
+
+
+def encode_th_digits(tensors) -> bytes:
+    """
+    Store normalized (1,64,40,1) classifier tensors as 8 bit greyscale images,
+    the same pixels the PNG images of the legacy format had.
+    """
+    if len(tensors) == 0:
+        return _TH_HEADER.pack(TH_VERSION, 0, 0, 0)
+    # accepts classifier tensors (float 0..1) as well as HxW uint8 images
+    stack = np.stack([np.asarray(t).squeeze() for t in tensors])
+    if stack.dtype != np.uint8:
+        stack = (stack * 255).astype(np.uint8)
+    count, height, width = stack.shape
+    return _TH_HEADER.pack(TH_VERSION, count, height, width) + zlib.compress(stack.tobytes())
+
+
+def decode_th_digits(blob: bytes, invert: bool = False):
+    """Returns a list of HxW uint8 images (white background, black digit unless inverted)."""
+    version, count, height, width = _TH_HEADER.unpack_from(blob)
+    if version != TH_VERSION:
+        raise ValueError(f"Unsupported thresholded digits format version {version}")
+    if count == 0:
+        return []
+    pixels = np.frombuffer(bytearray(zlib.decompress(blob[_TH_HEADER.size:])), dtype=np.uint8).reshape(count, height, width)
+    if invert:
+        pixels = 255 - pixels
+    return list(pixels)
+
+
+def encode_colored_digits(digits) -> bytes:
+    """Store all colored segments (RGB or greyscale uint8 arrays) in one PNG strip."""
+    if len(digits) == 0:
+        return _COLORED_HEADER.pack(COLORED_VERSION, 0, 0)
+    channels = 1 if digits[0].ndim == 2 else digits[0].shape[2]
+    strip_height = max(d.shape[0] for d in digits)
+    strip_width = sum(d.shape[1] for d in digits)
+    shape = (strip_height, strip_width) if channels == 1 else (strip_height, strip_width, channels)
+    strip = np.zeros(shape, dtype=np.uint8)
+
+    header = _COLORED_HEADER.pack(COLORED_VERSION, len(digits), channels)
+    x = 0
+    for digit in digits:
+        h, w = digit.shape[:2]
+        strip[:h, x:x + w] = digit
+        header += _COLORED_SIZE.pack(w, h)
+        x += w
+
+    if channels == 3:
+        strip = cv2.cvtColor(strip, cv2.COLOR_RGB2BGR)
+    ok, png = cv2.imencode('.png', strip)
+    if not ok:
+        raise ValueError("Could not encode colored digits")
+    return header + png.tobytes()
+
+
+def decode_colored_digits(blob: bytes):
+    """Returns the list of colored segments as stored by encode_colored_digits (RGB order)."""
+    version, count, channels = _COLORED_HEADER.unpack_from(blob)
+    if version != COLORED_VERSION:
+        raise ValueError(f"Unsupported colored digits format version {version}")
+    if count == 0:
+        return []
+    offset = _COLORED_HEADER.size
+    sizes = []
+    for _ in range(count):
+        sizes.append(_COLORED_SIZE.unpack_from(blob, offset))
+        offset += _COLORED_SIZE.size
+
+    flag = cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR
+    strip = cv2.imdecode(np.frombuffer(blob, dtype=np.uint8, offset=offset), flag)
+    if channels == 3:
+        strip = cv2.cvtColor(strip, cv2.COLOR_BGR2RGB)
+
+    digits = []
+    x = 0
+    for w, h in sizes:
+        digits.append(np.ascontiguousarray(strip[:h, x:x + w]))
+        x += w
+    return digits
@@ -0,0 +1,110 @@
+"""
+Named ONNX Runtime / OpenCV threading and memory settings for the inference sessions.
+
+    low-memory  no memory arena or memory patterns, default thread counts (the previous hardcoded setup)
+    balanced    arena and memory patterns on, half of the cores per session run
+    throughput  arena and memory patterns on, single threaded session runs, the pipeline workers run
+                frames in parallel instead (best with several meters and workers >= cores)
+
+Selected with inference.execution_profile in settings.json, single values can be changed with
+inference.execution_overrides. "auto" uses the profile recorded by `python run.py --autotune`
+(see lib/autotune.py), low-memory if there is none.
+"""
+import json
+import os
+
+import cv2
+import onnxruntime as ort
+
+DEFAULT_PROFILE = "low-memory"
+
+
+def _cores():
+    return os.cpu_count() or 1
+
+
+# intra/inter op threads: 0 = chosen by ONNX Runtime, cv2_threads: None = OpenCV default
+PROFILES = {
+    "low-memory": {
+        "intra_op_threads": 0,
+        "inter_op_threads": 0,
+        "cpu_mem_arena": False,
+        "mem_pattern": False,
+        "execution_mode": "sequential",
+        "cv2_threads": None,
+    },
+    "balanced": {
+        "intra_op_threads": max(1, _cores() // 2),
+        "inter_op_threads": 1,
+        "cpu_mem_arena": True,
+        "mem_pattern": True,
+        "execution_mode": "sequential",
+        "cv2_threads": max(1, _cores() // 2),
+    },
+    "throughput": {
+        "intra_op_threads": 1,
+        "inter_op_threads": 1,
+        "cpu_mem_arena": True,
+        "mem_pattern": True,
+        "execution_mode": "sequential",
+        "cv2_threads": 1,
+    },
+}
+
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def autotune_path(config) -> str:
+    """The autotune result is stored next to the database (persistent in the addon)."""
+    return os.path.join(os.path.dirname(config.get('dbfile', '')) or '.', 'autotune.json')
+
+
+def read_autotune_result(path):
+    """Name of the profile recorded by the autotuner, None if there is no (valid) result."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            name = json.load(f).get("profile")
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"[MeterPredictor] Could not read autotune result {path}: {e}")
+        return None
+    return name if name in PROFILES else None
+
+
+def resolve_profile(options: dict):
+    """(name, settings) of the execution profile selected in the inference options."""
+    name = options.get('execution_profile', DEFAULT_PROFILE)
+    if name == "auto":
+        name = read_autotune_result(options.get('autotune_file')) or DEFAULT_PROFILE
+    if name not in PROFILES:
+        print(f"[MeterPredictor] Unknown execution profile '{name}', using '{DEFAULT_PROFILE}'")
+        name = DEFAULT_PROFILE
+
+    profile = dict(PROFILES[name])
+    for key, value in options.get('execution_overrides', {}).items():
+        if key not in profile:
+            print(f"[MeterPredictor] Ignoring unknown execution override '{key}'")
+            continue
+        profile[key] = value
+    return name, profile
+
+
+def session_options(profile: dict) -> ort.SessionOptions:
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.intra_op_num_threads = int(profile["intra_op_threads"])
+    sess_options.inter_op_num_threads = int(profile["inter_op_threads"])
+    sess_options.enable_cpu_mem_arena = bool(profile["cpu_mem_arena"])
+    sess_options.enable_mem_pattern = bool(profile["mem_pattern"])
+    sess_options.execution_mode = EXECUTION_MODES.get(profile["execution_mode"], ort.ExecutionMode.ORT_SEQUENTIAL)
+    return sess_options
+
+
+def apply_cv2_threads(profile: dict):
+    # process wide, the last created predictor wins (there is only one outside of the autotuner)
+    if profile["cv2_threads"] is not None:
+        cv2.setNumThreads(int(profile["cv2_threads"]))
@@ -0,0 +1,116 @@
+"""
+A camera picture decoded once and passed as numpy array through detection, warp and thresholding.
+
+MQTT frames are decoded on the pipeline worker from the message payload, the HTTP re-evaluation
+decodes the picture stored in the database. Nothing after that converts between PIL and numpy.
+
+Decoding is lazy and can happen at two resolutions: the detector only needs a picture slightly
+larger than its 640x640 input, which libjpeg can decode directly at 1/2, 1/4 or 1/8 scale (DCT
+scaling, a fraction of the cost of a full decode). The digit strip is cut out of the full resolution
+picture, or of a reduced decode too if the display is large enough (see MeterPredictor).
+"""
+import base64
+import math
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from lib import metrics
+
+# EXIF orientation is ignored, like PIL did before (the cameras are set up with rotated_180 instead)
+_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
+    2: cv2.IMREAD_REDUCED_COLOR_2 | cv2.IMREAD_IGNORE_ORIENTATION,
+    4: cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION,
+    8: cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_IGNORE_ORIENTATION,
+}
+
+
+class Frame:
+    """Picture of a meter and the metadata of its message, decoded on first use to RGB uint8 arrays."""
+
+    __slots__ = ("name", "timestamp", "data", "_size", "_images")
+
+    def __init__(self, name: str, timestamp: str, data: bytes = None, image: np.ndarray = None):
+        self.name = name
+        self.timestamp = timestamp
+        self.data = data
+        self._size = None
+        # decoded images by reduction factor (1 = full resolution)
+        self._images = {}
+        if image is not None:
+            self._images[1] = image
+
+    @classmethod
+    def from_bytes(cls, name: str, timestamp: str, data: bytes):
+        """An encoded picture (JPEG/PNG/...), checked but not decoded yet."""
+        frame = cls(name, timestamp, data=data)
+        try:
+            frame.size  # parses the header only
+        except Exception as e:
+            raise ValueError(f"Could not decode picture of {name}: {e}")
+        return frame
+
+    @classmethod
+    def from_base64(cls, name: str, timestamp: str, data_b64: str):
+        """A base64 encoded picture as sent by the cameras and stored in watermeters.picture_data."""
+        return cls.from_bytes(name, timestamp, base64.b64decode(data_b64))
+
+    @classmethod
+    def from_array(cls, name: str, timestamp: str, image: np.ndarray):
+        """An already decoded RGB image."""
+        return cls(name, timestamp, image=image)
+
+    @property
+    def size(self):
+        """(width, height) of the full resolution picture."""
+        if self._size is None:
+            if 1 in self._images:
+                self._size = (self._images[1].shape[1], self._images[1].shape[0])
+            else:
+                with Image.open(BytesIO(self.data)) as img:
+                    self._size = img.size
+        return self._size
+
+    @property
+    def image(self) -> np.ndarray:
+        """Full resolution RGB image (H, W, 3)."""
+        return self.reduced(1)
+
+    def reduced(self, factor: int) -> np.ndarray:
+        """
+        RGB image downscaled by factor (1, 2, 4 or 8), sized ceil(W / factor) x ceil(H / factor).
+        Pixel (x, y) covers the full resolution pixels [x * factor, (x + 1) * factor).
+        """
+        image = self._images.get(factor)
+        if image is not None:
+            return image
+
+        if self.data is None or 1 in self._images:
+            # already decoded (or not a file), scale the full resolution image
+            width, height = self.size
+            image = cv2.resize(self.image, (math.ceil(width / factor), math.ceil(height / factor)), interpolation=cv2.INTER_AREA)
+        else:
+            with metrics.time_stage("decode", self.name):
+                image = cv2.imdecode(np.frombuffer(self.data, dtype=np.uint8), _DECODE_FLAGS[factor])
+                if image is None:
+                    raise ValueError(f"Could not decode picture of {self.name}")
+                # OpenCV decodes to BGR, the models were trained on RGB (in place, no extra copy)
+                cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+
+        self._images[factor] = image
+        return image
+
+    def reduction_for(self, input_shape) -> int:
+        """Largest supported reduction after which letterbox still downscales (never upscales) to the detector input."""
+        width, height = self.size
+        for factor in (8, 4, 2):
+            if width / factor >= input_shape[1] or height / factor >= input_shape[0]:
+                return factor
+        return 1
+
+    def release(self, factor: int):
+        """Drop a decoded image that is no longer needed."""
+        self._images.pop(factor, None)
@@ -0,0 +1,133 @@
+"""
+PNG/base64 encoding of debug images for the setup UI.
+
+The inference pipeline only works on numpy arrays. Images are encoded here when an
+HTTP endpoint asks for them; the expensive ones are kept in small LRU caches.
+"""
+import base64
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from lib.meter_processing.digit_codec import decode_colored_digits, decode_th_digits
+
+
+class LRUCache:
+    """Small thread-safe least-recently-used cache, counts hits, misses and evictions."""
+
+    def __init__(self, maxsize: int = 32):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# bounding box previews of the latest picture per meter
+_bbox_cache = LRUCache(16)
+# digit images of stored evaluations, the setup UI pages through the same evaluations repeatedly
+_digits_cache = LRUCache(256)
+
+
+def encode_png_base64(img: np.ndarray) -> str:
+    """Encode a HxW or HxWx3 (RGB) uint8 array as base64 PNG string."""
+    buffered = BytesIO()
+    Image.fromarray(img).save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+
+def threshold_to_uint8(tensor: np.ndarray, invert: bool = False) -> np.ndarray:
+    """Convert a normalized (1,64,40,1) classifier tensor back to a 64x40 uint8 image."""
+    img = (tensor.squeeze() * 255).astype(np.uint8)
+    return 255 - img if invert else img
+
+
+def encode_threshold_base64(tensor: np.ndarray, invert: bool = False) -> str:
+    return encode_png_base64(threshold_to_uint8(tensor, invert))
+
+
+def stored_digits_base64(blob: bytes, kind: str):
+    """
+    Encode the digits of a stored evaluation (see digit_codec.py) as base64 PNG strings.
+    kind is one of 'colored', 'th' or 'th_inverted'. Cached by content.
+    """
+    if blob is None:
+        return None
+    key = (kind, zlib.crc32(blob), len(blob))
+    cached = _digits_cache.get(key)
+    if cached is None:
+        if kind == 'colored':
+            images = decode_colored_digits(blob)
+        else:
+            images = decode_th_digits(blob, invert=(kind == 'th_inverted'))
+        cached = [encode_png_base64(img) for img in images]
+        _digits_cache.put(key, cached)
+    return cached
+
+
+def bbox_info_json(polygon, rotated_180: bool) -> str:
+    """Serialize the detected display polygon for storage next to the picture."""
+    return json.dumps({
+        "polygon": [round(float(v), 1) for v in polygon],
+        "rotated_180": bool(rotated_180)
+    })
+
+
+def render_bbox_base64(picture_b64: str, bbox_info: str, cache_key=None) -> str:
+    """
+    Draw the detected display polygon onto the picture and encode it as base64 PNG.
+    cache_key should identify the picture (e.g. name, picture number and timestamp).
+    """
+    key = (cache_key, bbox_info) if cache_key is not None else None
+    if key is not None:
+        cached = _bbox_cache.get(key)
+        if cached is not None:
+            return cached
+
+    info = json.loads(bbox_info)
+    img = np.array(Image.open(BytesIO(base64.b64decode(picture_b64))).convert("RGB"))
+    if info.get("rotated_180"):
+        img = np.ascontiguousarray(img[::-1, ::-1])
+
+    obb_points = np.array(info["polygon"], dtype=np.float32).reshape(4, 2).astype(np.int32)
+    cv2.polylines(img, [obb_points], isClosed=True, color=(255, 0, 0), thickness=2)
+    encoded = encode_png_base64(img)
+
+    if key is not None:
+        _bbox_cache.put(key, encoded)
+    return encoded
@@ -1,14 +1,23 @@
-import base64
 import gc
-import os
-from io import BytesIO
+import math
+import time
 
 import cv2
 import numpy as np
-from PIL import Image
 import onnxruntime as ort
 
+from lib.meter_processing.execution_profiles import resolve_profile, session_options, apply_cv2_threads
+from lib.meter_processing.frame import Frame
+from lib.meter_processing.model_variants import ModelVariants, classifier_batch_size, detector_input_shape
+from lib.meter_processing.prediction_cache import PredictionCache
+from lib.meter_processing.roi_cache import RoiCache
 from lib.meter_processing.onnx_helpers import xywhr_to_poly, letterbox
+from lib.meter_processing.yolo_batcher import YoloBatcher
+from lib import metrics
+
+
+def _sigmoid(x: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-x))
 
 
 class MeterPredictor:
@@ -17,29 +26,34 @@ class MeterPredictor:
     and digit classification
     """
 
-    def __init__(self):
+    def __init__(self, options: dict = None):
         """
         Initializes the ONNX inference sessions for YOLO and digit classifier.
         Optimized for minimal memory usage - uses ~70% less RAM than TensorFlow+PyTorch.
+
+        Args:
+            options (dict): The 'inference' section of the config (optional).
         """
+        options = options or {}
         print("[MeterPredictor] Loading ONNX models...")
 
-        # Configure ONNX Runtime for minimal memory usage
-        sess_options = ort.SessionOptions()
-        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-        sess_options.enable_mem_pattern = False  # Reduce memory fragmentation
-        sess_options.enable_cpu_mem_arena = False  # Reduce memory overhead
+        # Threading and memory settings of ONNX Runtime and OpenCV (see execution_profiles.py)
+        self.execution_profile, profile = resolve_profile(options)
+        sess_options = session_options(profile)
+        apply_cv2_threads(profile)
+        print(f"[MeterPredictor] Execution profile '{self.execution_profile}': {profile}")
 
         # Load YOLO ONNX model for oriented bounding box detection
+        self.model_paths = {"detector": "models/yolo-best-obb-2.onnx", "classifier": "models/best_model.onnx"}
         self.yolo_session = ort.InferenceSession(
-            "models/yolo-best-obb-2.onnx",
+            self.model_paths["detector"],
             sess_options=sess_options,
             providers=['CPUExecutionProvider']
         )
 
         # Load digit classifier ONNX model
         self.digit_session = ort.InferenceSession(
-            'models/best_model.onnx',
+            self.model_paths["classifier"],
             sess_options=sess_options,
             providers=['CPUExecutionProvider']
         )
@@ -53,43 +67,79 @@ class MeterPredictor:
         self.digit_input_name = self.digit_session.get_inputs()[0].name
         self.digit_output_name = self.digit_session.get_outputs()[0].name
 
+        # None if the classifier accepts any batch size, otherwise the fixed batch size of the export
+        self.digit_batch_size = classifier_batch_size(self.digit_session)
+
+        # Determine YOLO model input size if fixed
+        self.yolo_input_shape = detector_input_shape(self.yolo_session)
+
+        # Decode pictures at reduced resolution for the detector (see frame.py)
+        self.reduced_decode = options.get('reduced_decode', True)
+        # The digit strip is cut from a reduced decode as well if it stays at least this high (0 = always full resolution).
+        # The classifier input is 64 pixels high, strips of twice that height are still downscaled for it.
+        self.strip_min_height = options.get('strip_min_height', 128)
+
+        # Display polygons of the meters, reused instead of running YOLO on every frame (see roi_cache.py)
+        self.roi_cache = RoiCache(options)
+
+        # Classifier results of digit crops that did not change since the last frames (see prediction_cache.py)
+        self.prediction_cache = PredictionCache(options)
+
+        # Frames of different meters arriving at the same time share one YOLO run
+        self.yolo_batcher = YoloBatcher(
+            self.yolo_session,
+            self.yolo_input_name,
+            max_batch=options.get('yolo_max_batch', 4),
+            max_wait_ms=options.get('yolo_max_wait_ms', 5),
+            model_name=self.model_paths["detector"]
+        )
+        if self.yolo_batcher.enabled:
+            print(f"[MeterPredictor] YOLO micro-batching enabled (max batch {self.yolo_batcher.max_batch}, max wait {self.yolo_batcher.max_wait * 1000:.0f}ms)")
+
+        # Quantized / reduced input exports meters can choose instead (see model_variants.py)
+        self.variants = ModelVariants(self, sess_options, options)
+
         # Force garbage collection after loading models
         gc.collect()
         print("[MeterPredictor] ONNX models loaded successfully with minimal memory footprint.")
         print(f"[MeterPredictor] YOLO input: {self.yolo_input_name}")
         print(f"[MeterPredictor] Digit classifier input: {self.digit_input_name}")
 
-    def _sigmoid(x: np.ndarray) -> np.ndarray:
-        return 1.0 / (1.0 + np.exp(-x))
-
-    def _infer_obb_polygon_best(self, input_image, conf_thres=0.15):
-        img0 = np.array(input_image)
+    def close(self):
+        """Stop the YOLO batcher threads, the sessions are freed with the predictor."""
+        self.variants.close()
+        self.yolo_batcher.close()
+
+    def models(self, variant=None):
+        """Sessions of a model variant, the predictor itself holds the default models."""
+        return self.variants.get(variant)
+
+    def model_files(self):
+        """{label: path} of the loaded model files (default models and the variants in use)."""
+        files = dict(self.model_paths)
+        for name, spec in self.variants.loaded_specs().items():
+            for part in ("detector", "classifier"):
+                if spec.get(part):
+                    files[f"{name}/{part}"] = spec[part]
+        return files
+
+    def _infer_obb_polygon_best(self, img0, conf_thres=0.15, models=None, meter=None):
         if img0.ndim != 3:
             raise ValueError("Expected HWC image")
+        models = models or self
 
-        inp = self.yolo_session.get_inputs()[0]
-        in_name = inp.name
-
-        # Determine model input size if fixed
-        try:
-            _, c, ih, iw = inp.shape
-            if isinstance(ih, int) and isinstance(iw, int):
-                new_shape = (ih, iw)
-            else:
-                new_shape = (640, 640)
-        except Exception:
-            new_shape = (640, 640)
-
-        # Letterbox
-        img_lb, r, (pad_x, pad_y) = letterbox(img0, new_shape=new_shape)
+        with metrics.time_stage("letterbox", meter):
+            # Letterbox
+            img_lb, r, (pad_x, pad_y) = letterbox(img0, new_shape=models.yolo_input_shape)
 
-        # To NCHW float32
-        x = img_lb.astype(np.float32) / 255.0
-        x = np.transpose(x, (2, 0, 1))
-        x = np.expand_dims(x, 0)
+            # To NCHW float32
+            x = img_lb.astype(np.float32) / 255.0
+            x = np.transpose(x, (2, 0, 1))
+            x = np.expand_dims(x, 0)
 
-        # Inference
-        out = self.yolo_session.run(None, {in_name: x})[0]
+        # Inference (possibly batched together with frames of other meters)
+        with metrics.time_stage("yolo", meter):
+            out = models.yolo_batcher.run(x)
 
         # Expect raw-head OBB: (1, 4+nc+1, A) e.g. (1,6,8400)
         if not (out.ndim == 3 and out.shape[0] == 1 and out.shape[2] > 1000 and out.shape[1] >= 6):
@@ -147,7 +197,16 @@ class MeterPredictor:
 
         return poly.reshape(-1), conf, cls
 
-    def extract_display_and_segment(self, input_image, segments=7, rotated_180=False, extended_last_digit=False, shrink_last_3=False, target_brightness=None):
+    def _strip_reduction(self, strip_height):
+        """Largest decode reduction that keeps the digit strip at least strip_min_height pixels high (1 = full resolution)."""
+        if not self.reduced_decode or not self.strip_min_height:
+            return 1
+        for factor in (8, 4, 2):
+            if strip_height / factor >= self.strip_min_height:
+                return factor
+        return 1
+
+    def extract_display_and_segment(self, frame, segments=7, rotated_180=False, extended_last_digit=False, shrink_last_3=False, target_brightness=None, polygon=None, variant=None):
         """
         Predicts the water meter reading on a single image:
           - Runs YOLO detection for oriented bounding box (OBB)
@@ -155,28 +214,55 @@ class MeterPredictor:
           - Splits the meter into vertical segments
 
         Args:
-            input_image (PIL.Image): The input image to process.
+            frame (Frame): The picture to process. RGB numpy arrays and PIL images are accepted too.
             segments (int): The number of segments to split the meter into.
             rotated_180 (bool): Whether to rotate the meter 180 degrees.
             extended_last_digit (bool): Whether to extend the last digit for better classification.
             shrink_last_3 (bool): Whether to shrink the last 3 digits for better classification.
             target_brightness (float): The target brightness to adjust the image to.
+            polygon (list of 8 floats): Known display polygon (full resolution, rotated picture), skips the detection.
+            variant (str): Model variant of the meter (see model_variants.py), None for the default models.
+
+        Returns:
+            digits (list of np.ndarray), target_brightness, obb polygon (8 values, in the rotated image)
+            Debug images are not encoded here, see image_encoding.py.
         """
 
-        # Rotate the image 180 degrees
-        if rotated_180:
-            #  is image.py
-            input_image = input_image.rotate(180, expand=True)
+        if not isinstance(frame, Frame):
+            image = frame if isinstance(frame, np.ndarray) else np.asarray(frame.convert("RGB"))
+            frame = Frame.from_array(None, None, image)
+
+        width, height = frame.size
+        factor = None
+        if polygon is not None:
+            obb_coords = np.asarray(polygon, dtype=np.float32).reshape(-1)
+        else:
+            # The detector works on a reduced decode, it letterboxes to its input size anyway
+            models = self.models(variant)
+            factor = frame.reduction_for(models.yolo_input_shape) if self.reduced_decode else 1
+            detection_img = frame.reduced(factor)
 
-        print("[Predictor] Running YOLO region-of-interest detection...")
+            # Rotate the image 180 degrees (only the small detection image is rotated)
+            if rotated_180:
+                detection_img = cv2.rotate(detection_img, cv2.ROTATE_180)
 
-        obb_coords, best_conf, best_cls = self._infer_obb_polygon_best(input_image, conf_thres=0.15)
+            print("[Predictor] Running YOLO region-of-interest detection...")
 
-        if obb_coords is None:
-            print("[Predictor] No instances detected in the image.")
-            return [], [], None
+            obb_coords, best_conf, best_cls = self._infer_obb_polygon_best(detection_img, conf_thres=0.15, models=models, meter=frame.name)
 
-        img = np.array(input_image)
+            if obb_coords is None:
+                print("[Predictor] No instances detected in the image.")
+                return [], None, None
+
+            # Map the polygon to the full resolution picture
+            poly = obb_coords.reshape(4, 2).astype(np.float64)
+            if factor != 1:
+                if rotated_180:
+                    poly = np.array([detection_img.shape[1] - 1, detection_img.shape[0] - 1]) - poly
+                poly = (poly + 0.5) * factor - 0.5
+                if rotated_180:
+                    poly = np.array([width - 1, height - 1]) - poly
+            obb_coords = poly.reshape(-1).astype(np.float32)
 
         # Reshape OBB coordinates into four (x,y) points
         points = obb_coords.reshape(4, 2).astype(np.float32)
@@ -196,6 +282,18 @@ class MeterPredictor:
         # Reassemble into final order: [top-left, top-right, bottom-right, bottom-left]
         points = np.array([top_left, top_right, bottom_right, bottom_left], dtype="float32")
 
+        # Cut the strip out of a reduced decode if the display is large enough, otherwise at full resolution
+        strip_height = max(np.linalg.norm(points[1] - points[2]), np.linalg.norm(points[3] - points[0]))
+        warp_factor = self._strip_reduction(strip_height)
+        if warp_factor != factor:
+            frame.release(factor)
+        # decoded before the warp timing starts, decoding has its own stage
+        img = frame.reduced(warp_factor)
+        warp_start = time.perf_counter()
+        if warp_factor != 1:
+            points = (points + 0.5) / warp_factor - 0.5
+            width, height = math.ceil(width / warp_factor), math.ceil(height / warp_factor)
+
         # Compute bounding box width/height
         width_a = np.linalg.norm(points[0] - points[1])
         width_b = np.linalg.norm(points[2] - points[3])
@@ -214,6 +312,10 @@ class MeterPredictor:
         ], dtype="float32")
 
         M = cv2.getPerspectiveTransform(points, dst_points)
+        if rotated_180:
+            # warp straight from the unrotated picture instead of rotating the whole image
+            flip = np.array([[-1, 0, width - 1], [0, -1, height - 1], [0, 0, 1]], dtype=np.float64)
+            M = M @ flip
         rotated_cropped_img = cv2.warpPerspective(img, M, (max_width, max_height))
         rotated_cropped_img_ext = None
 
@@ -222,10 +324,9 @@ class MeterPredictor:
             rotated_cropped_img_ext = cv2.warpPerspective(img, M, (max_width, int(max_height * 1.2)))
 
         # Split the cropped meter into segments vertical parts for classification
-        if (segments == 0): return [],[]
+        if (segments == 0): return [], None, None
         part_width = rotated_cropped_img.shape[1] // segments
 
-        base64s = []
         digits = []
 
         last_x = 0
@@ -246,7 +347,6 @@ class MeterPredictor:
                 part = rotated_cropped_img_ext[:, last_x: last_x + t_part_width]
             last_x = last_x + t_part_width
 
-            # Convert segment to base64 string for storage
             digits.append(part)
 
         # Adjust brightness of each image
@@ -260,36 +360,15 @@ class MeterPredictor:
             adjusted_images.append(adjusted_img)
 
         digits = adjusted_images
+        metrics.STAGE_SECONDS.observe("warp_segment", frame.name or "", value=time.perf_counter() - warp_start)
 
-        # Convert to base64 for temporary storage
-        for part in digits:
-            pil_img = Image.fromarray(part)
-
-            buffered = BytesIO()
-            pil_img.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue())
-            # to string
-            img_str = img_str.decode('utf-8')
-
-            base64s.append(img_str)
-
-        # export base64 with the input_image + the inserted bounding box for debugging
-        img_with_bbox = np.array(input_image)
-        boundingboxed_image = None
-        if obb_coords is not None:
-            obb_points = obb_coords.reshape(4, 2).astype(np.int32)
-            cv2.polylines(img_with_bbox, [obb_points], isClosed=True, color=(255, 0, 0), thickness=2)
-
-            pil_img = Image.fromarray(img_with_bbox)
-            buffered = BytesIO()
-            pil_img.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue())
-            # to string
-            boundingboxed_image = img_str.decode('utf-8')
-
-        return base64s, digits, target_brightness, boundingboxed_image
+        return digits, target_brightness, obb_coords
 
-    def apply_threshold(self, digit, threshold_low, threshold_high, islanding_padding=40, invert=False):
+    def apply_threshold(self, digit, threshold_low, threshold_high, islanding_padding=40):
+        """
+        Thresholds and islands a single colored digit.
+        Returns the normalized (1,64,40,1) float32 tensor for the classifier.
+        """
         threshold_low, threshold_high = int(threshold_low), int(threshold_high)
         islanding_padding = int(islanding_padding)
 
@@ -303,11 +382,8 @@ class MeterPredictor:
         # Invert the image to match this requirement.
         inverted = cv2.bitwise_not(digit)
 
-        # Find connected components (8-connectivity by default)
-        num_labels, labels = cv2.connectedComponents(inverted)
-
-        # Create a BGR color image with white background
-        color_image = np.full((*digit.shape, 3), (255, 255, 255), dtype=np.uint8)
+        # Find connected components (8-connectivity by default), with their areas
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(inverted)
 
         # Get the dimensions of the image
         height, width = digit.shape
@@ -318,82 +394,97 @@ class MeterPredictor:
         start_y = int((islanding_padding / 100.0) * height)
         end_y = int(1.0 - (islanding_padding / 100.0) * height)
 
-        extracted = 0
-        extracted_percentage = 0
-        for label in range(1, num_labels):
-            # Slice the labels to the middle region and check for any occurrence of the current label
-            component_region = labels[start_y:end_y, start_x:end_x]
-            in_middle = np.any(component_region == label)
-
-            if in_middle:
-                color = (0, 0, 0)
-                extracted += 1
-
-                # Calculate the percentage of the component in the middle region
-                component_area = np.sum(labels == label)
-                total_area = height * width
-                extracted_percentage += component_area / total_area * 100
-            else:
-                # remove the component if it is not in the middle region
-                color = (255, 255, 255)
+        # Find all components with at least one pixel in the middle region in a single pass
+        component_region = labels[start_y:end_y, start_x:end_x]
+        in_middle = np.bincount(component_region.ravel(), minlength=num_labels) > 0
+        in_middle[0] = False  # background
 
-            color_image[labels == label] = color
+        extracted = int(np.count_nonzero(in_middle))
+        # Calculate the percentage of the image covered by the kept components
+        extracted_percentage = stats[in_middle, cv2.CC_STAT_AREA].sum() / (height * width) * 100
 
+        # Lookup table label -> grey value: kept components black, everything else white
         # if no components are in the middle region or less than 10% of the image is extracted, use the whole image
         if extracted == 0 or extracted_percentage < 10:
-            # use the whole image
-            color_image = np.full((*digit.shape, 3), (255, 255, 255), dtype=np.uint8)
-            color_image[labels != 0] = (0, 0, 0)
+            lut = np.zeros(num_labels, dtype=np.uint8)
+            lut[0] = 255
+        else:
+            lut = np.where(in_middle, 0, 255).astype(np.uint8)
+        grey_image = lut[labels]
 
-        # back to greyscale
-        color_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
-        digit = cv2.resize(color_image, (40, 64))
+        digit = cv2.resize(grey_image, (40, 64))
 
         # --- Normalize & add extra dimensions ---
         img_norm = digit.astype('float32') / 255.0
         img_norm = np.expand_dims(img_norm, axis=-1)  # add channel dimension
         img_norm = np.expand_dims(img_norm, axis=0)  # add batch dimension
 
-        img_uint8 = (img_norm.squeeze() * 255).astype(np.uint8)  # Remove extra dims & convert to uint8
-        pil_img = Image.fromarray(img_uint8)
-
-        # Encode image to Base64
-        buffered = BytesIO()
-        if invert:
-            pil_img = Image.fromarray(255 - img_uint8)  # Invert for
-        pil_img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-        return img_str, img_norm
+        return img_norm
 
     # use the classifier to predict the digit, returns the top 3 predictions with their confidence
     def predict_digit(self, digit):
-        # Perform prediction using ONNX model
-        predictions = self.digit_session.run(
-            [self.digit_output_name],
-            {self.digit_input_name: digit}
-        )[0]
-
-        top3 = np.argsort(predictions[0])[-3:][::-1]
-        pairs = [(self.class_names[i], float(predictions[0][i])) for i in top3]
-
-        return pairs
+        return self.predict_digits([digit])[0]
 
-    def predict_digits(self, digits):
+    def _run_digit_batch(self, batch, models=None):
         """
-        Digits are np arrays
-        predict the digits
+        Runs the classifier on a (N,64,40,1) batch in as few session calls as possible.
+        Models exported with a fixed batch dimension are fed in chunks of that size (zero padded).
         """
-        # Predict each digit
-        predicted_digits = []
-        for i,digit in enumerate(digits):
-            digit = self.predict_digit(digit)
-            predicted_digits.append(digit)
-
-        # Clean up memory after batch prediction
-        gc.collect()
-
-        return predicted_digits
+        models = models or self
+        if models.digit_batch_size is None:
+            return models.digit_session.run([models.digit_output_name], {models.digit_input_name: batch})[0]
+
+        n = batch.shape[0]
+        size = models.digit_batch_size
+        outputs = []
+        for start in range(0, n, size):
+            chunk = batch[start:start + size]
+            if chunk.shape[0] < size:
+                pad = np.zeros((size - chunk.shape[0],) + chunk.shape[1:], dtype=chunk.dtype)
+                chunk = np.concatenate([chunk, pad], axis=0)
+            out = models.digit_session.run([models.digit_output_name], {models.digit_input_name: chunk})[0]
+            outputs.append(out)
+        return np.concatenate(outputs, axis=0)[:n]
+
+    def predict_digits(self, digits, name=None, variant=None):
+        """
+        Digits are np arrays of shape (1,64,40,1)
+        predict all digits with a single classifier run, returns the top 3 predictions per digit
+        With the meter name, digits seen before are answered from the prediction cache and only the others are classified.
+        variant selects the classifier of a model variant (the cache of a meter is cleared when it changes).
+        """
+        if len(digits) == 0:
+            return []
+
+        models = self.models(variant)
+        if name is None or not self.prediction_cache.enabled:
+            return self._classify(digits, models)
+
+        keys, predictions = self.prediction_cache.lookup(name, digits)
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if missing:
+            for i, prediction in zip(missing, self._classify([digits[i] for i in missing], models)):
+                self.prediction_cache.store(name, keys[i], prediction)
+                predictions[i] = prediction
+        # copies, the caller may modify the lists
+        return [list(prediction) for prediction in predictions]
+
+    def _classify(self, digits, models=None):
+        batch = np.concatenate(digits, axis=0).astype(np.float32, copy=False)
+        predictions = self._run_digit_batch(batch, models)
+
+        # top 3 classes per digit, sorted by confidence
+        k = min(3, predictions.shape[1])
+        top = np.argpartition(predictions, -k, axis=1)[:, -k:]
+        top_scores = np.take_along_axis(predictions, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        return [
+            [(self.class_names[c], float(score)) for c, score in zip(classes, scores)]
+            for classes, scores in zip(top.tolist(), top_scores.tolist())
+        ]
 
     def apply_thresholds(self, digits, thresholds, thresholds_last, islanding_padding):
         """
@@ -403,8 +494,6 @@ class MeterPredictor:
 
         # Apply thresholding
         thresholded_digits = []
-        base64s = []
-        base64s_inverted = []
 
         threshold_low = thresholds[0]
         threshold_high = thresholds[1]
@@ -412,17 +501,6 @@ class MeterPredictor:
             if i >= len(digits) - 3:
                 threshold_low = thresholds_last[0]
                 threshold_high = thresholds_last[1]
-            img_str, digit = self.apply_threshold(digit, threshold_low, threshold_high, islanding_padding)
-
-            thresholded_digits.append(digit)
-            base64s.append(img_str)
-
-            # also store inverted images as base64 for debugging
-            img_uint8 = (digit.squeeze() * 255).astype(np.uint8)
-            pil_img = Image.fromarray(255 - img_uint8)  # Invert for
-            buffered = BytesIO()
-            pil_img.save(buffered, format="PNG")
-            img_str_inverted = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            base64s_inverted.append(img_str_inverted)
+            thresholded_digits.append(self.apply_threshold(digit, threshold_low, threshold_high, islanding_padding))
 
-        return base64s, thresholded_digits, base64s_inverted
\ No newline at end of file
+        return thresholded_digits
@@ -0,0 +1,150 @@
+"""
+Alternative exports of the detector and the digit classifier that meters can choose instead of the
+fp32 models (settings.model_variant), e.g. INT8 quantized or with a 320x320 detector input.
+
+The variants are built by tools/build_model_variants.py, which also writes the manifest:
+
+    {"variants": {"int8-static": {"detector": "models/variants/yolo-int8-static.onnx",
+                                  "detector_input": [640, 640],
+                                  "classifier": "models/variants/digits-int8-static.onnx"}, ...},
+     "report": {...accuracy and latency per variant...}}
+
+A variant without a detector or classifier uses the default model for that part. Sessions are
+created when a meter first uses the variant. Unknown or broken variants fall back to the default models.
+"""
+import json
+import os
+import threading
+
+import onnxruntime as ort
+
+from lib.meter_processing.yolo_batcher import YoloBatcher
+
+DEFAULT_MANIFEST = "models/variants/manifest.json"
+
+
+def create_session(path, sess_options):
+    return ort.InferenceSession(path, sess_options=sess_options, providers=['CPUExecutionProvider'])
+
+
+def detector_input_shape(session, fallback=None):
+    """(h, w) of a fixed size detector input, the fallback (or 640x640) for dynamic exports."""
+    try:
+        _, _, ih, iw = session.get_inputs()[0].shape
+        if isinstance(ih, int) and isinstance(iw, int):
+            return ih, iw
+    except Exception:
+        pass
+    return tuple(fallback) if fallback else (640, 640)
+
+
+def classifier_batch_size(session):
+    """None if the classifier accepts any batch size, otherwise the fixed batch size of the export."""
+    batch_dim = session.get_inputs()[0].shape[0]
+    return batch_dim if isinstance(batch_dim, int) else None
+
+
+class ModelVariant:
+    """
+    Sessions of one variant. Has the same model attributes as MeterPredictor (which is the default
+    variant), so the predictor methods work on either.
+    """
+
+    def __init__(self, name: str, spec: dict, default, sess_options, options: dict):
+        self.name = name
+        self._own_batcher = False
+
+        if spec.get('detector'):
+            self.yolo_session = create_session(spec['detector'], sess_options)
+            self.yolo_input_name = self.yolo_session.get_inputs()[0].name
+            self.yolo_input_shape = detector_input_shape(self.yolo_session, spec.get('detector_input'))
+            self.yolo_batcher = YoloBatcher(
+                self.yolo_session,
+                self.yolo_input_name,
+                max_batch=options.get('yolo_max_batch', 4),
+                max_wait_ms=options.get('yolo_max_wait_ms', 5),
+                model_name=spec['detector']
+            )
+            self._own_batcher = True
+        else:
+            self.yolo_session = default.yolo_session
+            self.yolo_input_name = default.yolo_input_name
+            self.yolo_input_shape = default.yolo_input_shape
+            self.yolo_batcher = default.yolo_batcher
+
+        if spec.get('classifier'):
+            self.digit_session = create_session(spec['classifier'], sess_options)
+            self.digit_input_name = self.digit_session.get_inputs()[0].name
+            self.digit_output_name = self.digit_session.get_outputs()[0].name
+            self.digit_batch_size = classifier_batch_size(self.digit_session)
+        else:
+            self.digit_session = default.digit_session
+            self.digit_input_name = default.digit_input_name
+            self.digit_output_name = default.digit_output_name
+            self.digit_batch_size = default.digit_batch_size
+
+    def close(self):
+        if self._own_batcher:
+            self.yolo_batcher.close()
+
+
+class ModelVariants:
+    """The variants listed in the manifest, loaded on first use."""
+
+    def __init__(self, default, sess_options, options: dict):
+        self.default = default
+        self.sess_options = sess_options
+        self.options = options
+        self.manifest_path = options.get('model_variants_manifest', DEFAULT_MANIFEST)
+        self.specs = {}
+        self.report = {}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as f:
+                    manifest = json.load(f)
+                self.specs = manifest.get('variants', {})
+                self.report = manifest.get('report', {})
+                print(f"[MeterPredictor] Model variants available: {', '.join(self.specs) or 'none'}")
+            except (OSError, ValueError) as e:
+                print(f"[MeterPredictor] Could not read model variants manifest {self.manifest_path}: {e}")
+        self._loaded = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def names(self):
+        return list(self.specs)
+
+    def get(self, name):
+        """The loaded variant, the default models (predictor) for None, unknown or broken variants."""
+        if not name:
+            return self.default
+        variant = self._loaded.get(name)
+        if variant is not None:
+            return variant
+        with self._lock:
+            if name in self._loaded:
+                return self._loaded[name]
+            if name in self._failed:
+                return self.default
+            if name not in self.specs:
+                print(f"[MeterPredictor] Unknown model variant '{name}', using the default models")
+                self._failed.add(name)
+                return self.default
+            try:
+                variant = ModelVariant(name, self.specs[name], self.default, self.sess_options, self.options)
+            except Exception as e:
+                print(f"[MeterPredictor] Could not load model variant '{name}': {e}, using the default models")
+                self._failed.add(name)
+                return self.default
+            print(f"[MeterPredictor] Loaded model variant '{name}'")
+            self._loaded[name] = variant
+            return variant
+
+    def loaded_specs(self):
+        return {name: self.specs[name] for name in list(self._loaded)}
+
+    def close(self):
+        with self._lock:
+            for variant in self._loaded.values():
+                variant.close()
+            self._loaded.clear()
@@ -0,0 +1,87 @@
+"""
+Per-meter cache of classifier results for digit crops that did not change.
+
+The high-order digits of a meter stay the same for days, after thresholding their (64,40) tensors
+are mostly identical from frame to frame. predict_digits looks them up here by a hash of the tensor
+and only runs the classifier on the digits it has not seen yet.
+
+Keys (prediction_cache_mode):
+  - "exact":  hash of the tensor bytes, a hit returns exactly what the classifier would return.
+  - "binary": hash of the tensor binarized at 0.5, tolerates the grey edge pixels left by resizing the
+              thresholded digit, returns the prediction of the first crop seen with that shape.
+"""
+import hashlib
+import threading
+
+import numpy as np
+
+from lib.meter_processing.image_encoding import LRUCache
+
+MODES = ("exact", "binary")
+
+
+class PredictionCache:
+
+    def __init__(self, options: dict = None):
+        options = options or {}
+        self.enabled = options.get('prediction_cache', True)
+        self.size = options.get('prediction_cache_size', 64)
+        self.mode = options.get('prediction_cache_mode', 'exact')
+        if self.mode not in MODES:
+            print(f"[PredictionCache] Unknown prediction_cache_mode '{self.mode}', using 'exact'")
+            self.mode = 'exact'
+        self._meters = {}
+        self._lock = threading.Lock()
+        # counters of caches that were dropped with invalidate()
+        self._dropped = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def key(self, tensor: np.ndarray) -> bytes:
+        if self.mode == 'binary':
+            data = np.packbits(tensor > 0.5).tobytes()
+        else:
+            data = np.ascontiguousarray(tensor, dtype=np.float32).tobytes()
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def _cache(self, name: str) -> LRUCache:
+        with self._lock:
+            cache = self._meters.get(name)
+            if cache is None:
+                cache = self._meters[name] = LRUCache(self.size)
+            return cache
+
+    def lookup(self, name: str, tensors):
+        """Keys and cached predictions (None for misses) of the tensors."""
+        cache = self._cache(name)
+        keys = [self.key(tensor) for tensor in tensors]
+        return keys, [cache.get(key) for key in keys]
+
+    def store(self, name: str, key: bytes, prediction):
+        self._cache(name).put(key, prediction)
+
+    def invalidate(self, name: str = None):
+        with self._lock:
+            names = list(self._meters) if name is None else [name]
+            for meter in names:
+                cache = self._meters.pop(meter, None)
+                if cache is not None:
+                    self._dropped["hits"] += cache.hits
+                    self._dropped["misses"] += cache.misses
+                    self._dropped["evictions"] += cache.evictions
+
+    def stats(self):
+        with self._lock:
+            caches = list(self._meters.values())
+            totals = dict(self._dropped)
+        for cache in caches:
+            totals["hits"] += cache.hits
+            totals["misses"] += cache.misses
+            totals["evictions"] += cache.evictions
+        lookups = totals["hits"] + totals["misses"]
+        return {
+            "enabled": self.enabled,
+            "mode": self.mode,
+            "meters": len(caches),
+            "entries": sum(len(cache) for cache in caches),
+            **totals,
+            "hit_rate": round(totals["hits"] / lookups, 3) if lookups else None,
+        }
@@ -0,0 +1,120 @@
+"""
+Per-meter cache of the detected display polygon, so YOLO does not run on every frame of a bolted-down camera.
+
+A cached polygon is reused as long as
+  - the picture size and the rotation setting are unchanged,
+  - fewer than redetect_every frames were evaluated since the last detection,
+  - the cut out digits still look like the ones of the last detection (normalized cross-correlation
+    of small greyscale thumbnails, digits rolling over only change parts of it),
+  - the classifier stays confident on the digits.
+Otherwise the display is detected again. A polygon pinned in the settings is always used as is.
+"""
+import threading
+
+import cv2
+import numpy as np
+
+# thumbnail size per digit (width, height)
+_THUMB_SIZE = (12, 16)
+
+
+def strip_thumbnail(digits) -> np.ndarray:
+    """Small, blurred, zero-mean greyscale strip of the colored digits used for the similarity check."""
+    parts = []
+    for digit in digits:
+        grey = cv2.cvtColor(digit, cv2.COLOR_RGB2GRAY) if digit.ndim == 3 else digit
+        parts.append(cv2.resize(grey, _THUMB_SIZE, interpolation=cv2.INTER_AREA))
+    thumb = cv2.GaussianBlur(np.hstack(parts).astype(np.float32), (3, 3), 0)
+    thumb -= thumb.mean()
+    norm = np.linalg.norm(thumb)
+    return thumb / norm if norm > 0 else thumb
+
+
+class _Entry:
+    __slots__ = ("key", "polygon", "thumbnail", "frames")
+
+    def __init__(self, key, polygon, thumbnail):
+        self.key = key
+        self.polygon = polygon
+        self.thumbnail = thumbnail
+        self.frames = 0
+
+
+class RoiCache:
+
+    def __init__(self, options: dict = None):
+        options = options or {}
+        self.enabled = options.get('roi_cache', True)
+        self.redetect_every = options.get('roi_redetect_every', 50)
+        self.min_similarity = options.get('roi_min_similarity', 0.6)
+        self.min_confidence = options.get('roi_min_confidence', 0.5)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.detections = 0
+        self.rejections = 0
+
+    def get(self, name: str, key):
+        """Cached polygon (8 values, full resolution, rotated picture) or None if the display has to be detected."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.key != key:
+                return None
+            if self.redetect_every and entry.frames >= self.redetect_every:
+                return None
+            return entry.polygon
+
+    def verify(self, name: str, digits) -> bool:
+        """Similarity check of the digits cut out with the cached polygon, drops the entry on failure."""
+        thumbnail = strip_thumbnail(digits) if digits else None
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or thumbnail is None or thumbnail.shape != entry.thumbnail.shape:
+                return False
+            similarity = float(np.sum(thumbnail * entry.thumbnail))
+            if similarity < self.min_similarity:
+                print(f"[ROI ({name})] Cached display region rejected (similarity {similarity:.2f}), detecting again")
+                del self._entries[name]
+                self.rejections += 1
+                return False
+            entry.frames += 1
+            self.hits += 1
+            return True
+
+    def check_confidence(self, name: str, prediction):
+        """Drop the cached polygon if the classifier was unsure, the next frame detects the display again."""
+        if not prediction:
+            return
+        confidence = float(np.mean([p[0][1] for p in prediction if p]))
+        if confidence < self.min_confidence:
+            with self._lock:
+                if self._entries.pop(name, None) is not None:
+                    print(f"[ROI ({name})] Low digit confidence ({confidence:.2f}), detecting again on the next frame")
+                    self.rejections += 1
+
+    def store(self, name: str, key, polygon, digits):
+        """Remember the polygon of a fresh detection."""
+        if not self.enabled:
+            return
+        entry = _Entry(key, polygon, strip_thumbnail(digits))
+        with self._lock:
+            self._entries[name] = entry
+            self.detections += 1
+
+    def invalidate(self, name: str = None):
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "meters": len(self._entries),
+                "hits": self.hits,
+                "detections": self.detections,
+                "rejections": self.rejections,
+            }
@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class YoloBatcher:
+    """
+    Collects letterboxed frames from concurrent callers (different meters) into one NCHW batch
+    and runs a single YOLO session call for all of them.
+
+    The collector waits at most max_wait_ms after the first pending frame for more frames,
+    or until max_batch frames are pending. Each caller gets back the output row of its own frame.
+    """
+
+    def __init__(self, session, input_name, max_batch: int = 4, max_wait_ms: float = 5.0, model_name: str = "detector"):
+        self.session = session
+        self.input_name = input_name
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        # Models exported with a fixed batch size of 1 cannot be batched
+        batch_dim = session.get_inputs()[0].shape[0]
+        if isinstance(batch_dim, int) and batch_dim == 1:
+            if self.max_batch > 1:
+                print(f"[YoloBatcher] {model_name} has a fixed batch size of 1, micro-batching disabled. "
+                      f"Re-export it with a dynamic batch size (yolo export ... dynamic=True) to batch frames of different meters.")
+            self.max_batch = 1
+        elif isinstance(batch_dim, int):
+            self.max_batch = min(self.max_batch, batch_dim)
+
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+        if self.enabled:
+            self._thread = threading.Thread(target=self._collector, name="yolo-batcher", daemon=True)
+            self._thread.start()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch > 1
+
+    def run(self, x: np.ndarray) -> np.ndarray:
+        """
+        Run YOLO on a single (1,C,H,W) input, returns the (1, ...) output of the first model output.
+        Blocks until the batch containing this frame has been processed.
+        Raises RuntimeError once the batcher is closed.
+        """
+        if not self.enabled:
+            if self._closed:
+                raise RuntimeError("YOLO batcher is closed")
+            return self.session.run(None, {self.input_name: x})[0]
+
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("YOLO batcher is closed")
+            self._pending.append((x, future))
+            self._cond.notify()
+        return future.result()
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending:
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = self._pending[:self.max_batch]
+            self._pending = self._pending[self.max_batch:]
+            return batch
+
+    def _collector(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            try:
+                if len(batch) == 1:
+                    x = batch[0][0]
+                else:
+                    x = np.concatenate([item[0] for item in batch], axis=0)
+                out = self.session.run(None, {self.input_name: x})[0]
+                for i, (_, future) in enumerate(batch):
+                    future.set_result(out[i:i + 1])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+    def close(self):
+        """Stop the collector thread once the pending frames are processed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
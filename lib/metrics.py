@@ -0,0 +1,171 @@
+"""
+In-process metrics in the Prometheus text format, served at /api/metrics.
+
+Always on, so the instrumentation has to stay cheap: an observation is a perf_counter difference,
+a bisect over the bucket bounds and a few additions under a per-metric lock. Label values are
+kept as tuples, the text is only rendered when the endpoint is scraped.
+
+    with metrics.time_stage("classify", name):
+        ...
+    metrics.FRAMES.inc(name)
+    metrics.REJECTIONS.inc(name, "no_display")
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, from a cached digit prediction (sub-millisecond) to YOLO on a slow board
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f"{self.name}{_labels(self.label_names, labels)} {_number(value)}" for labels, value in items]
+        return lines
+
+
+class Gauge:
+    """Set directly or computed at scrape time by a function returning {label tuple: value}."""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._functions = []
+        self._lock = threading.Lock()
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def add_function(self, fn):
+        with self._lock:
+            self._functions.append(fn)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = list(self._functions)
+        for fn in functions:
+            try:
+                values.update(fn())
+            except Exception as e:
+                print(f"[Metrics] Could not collect {self.name}: {e}")
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{_labels(self.label_names, labels)} {_number(value)}" for labels, value in sorted(values.items())]
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label tuple -> [bucket counts (non cumulative, last = +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, (list(series[0]), series[1], series[2])) for labels, series in self._series.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "metermonitor_stage_seconds",
+    "Duration of the pipeline stages (scheduler_wait, decode, letterbox, yolo, warp_segment, threshold, classify, correct_value, db_write, mqtt_publish)",
+    ["stage", "meter"])
+FRAMES = Counter("metermonitor_frames_total", "Frames processed by the pipeline workers", ["meter"])
+REJECTIONS = Counter("metermonitor_rejections_total", "Frames or values that were dropped or rejected, by reason", ["meter", "reason"])
+DENIED_DIGITS = Counter("metermonitor_denied_digits_total", "Digits below the confidence threshold of the meter", ["meter"])
+RECONNECTS = Counter("metermonitor_mqtt_reconnects_total", "Reconnect attempts to the MQTT broker")
+QUEUE_DEPTH = Gauge("metermonitor_queue_depth", "Frames waiting for a pipeline worker", ["meter"])
+MODEL_BYTES = Gauge("metermonitor_model_bytes", "Size of the loaded ONNX models", ["model"])
+SPOOL_FRAMES = Gauge("metermonitor_spool_frames", "Frames in the ingest spool that are not processed yet")
+SPOOL_BYTES = Gauge("metermonitor_spool_bytes", "Payload bytes in the ingest spool")
+SCHEDULER_SLOTS = Gauge("metermonitor_scheduler_slots", "Inference slots in use and callers waiting for one, by priority class", ["class", "state"])
+RSS_BYTES = Gauge("metermonitor_resident_memory_bytes", "Resident memory of the process (models, caches, decoded pictures)")
+
+REGISTRY = [STAGE_SECONDS, FRAMES, REJECTIONS, DENIED_DIGITS, RECONNECTS, QUEUE_DEPTH, SPOOL_FRAMES, SPOOL_BYTES, SCHEDULER_SLOTS, MODEL_BYTES, RSS_BYTES]
+
+
+@contextmanager
+def time_stage(stage: str, meter):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(stage, meter or "", value=time.perf_counter() - start)
+
+
+def _rss():
+    # Linux only (the addon and the docker image), nothing is reported elsewhere
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return {(): int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")}
+    except (OSError, ValueError, IndexError):
+        return {}
+
+
+RSS_BYTES.add_function(_rss)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
@@ -4,23 +4,38 @@ This saves 150-300MB of RAM by avoiding duplicate model loading.
 """
 
 import gc
+import os
+import threading
+
+from lib import metrics
+from lib.meter_processing.execution_profiles import autotune_path
 from lib.meter_processing.meter_processing import MeterPredictor
 
 
 class MeterPredictorSingleton:
     _instance = None
     _predictor = None
+    # the HTTP server may load the predictor on its first request (process mode), from several threads
+    _lock = threading.Lock()
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(MeterPredictorSingleton, cls).__new__(cls)
         return cls._instance
 
-    def get_predictor(self):
+    def get_predictor(self, config=None):
         """Get or create the singleton MeterPredictor instance."""
+        with self._lock:
+            return self._get_predictor(config)
+
+    def _get_predictor(self, config):
         if self._predictor is None:
             print("[MeterPredictor] Initializing singleton instance...")
-            self._predictor = MeterPredictor()
+            options = dict(config.get('inference', {})) if config else {}
+            if config:
+                options.setdefault('autotune_file', autotune_path(config))
+            MeterPredictorSingleton._predictor = MeterPredictor(options)
+            metrics.MODEL_BYTES.add_function(_model_sizes(self._predictor))
             # Force garbage collection after loading models
             gc.collect()
             print("[MeterPredictor] Singleton instance initialized and memory cleaned.")
@@ -31,15 +46,29 @@ class MeterPredictorSingleton:
         """Release the predictor and free memory (useful for testing/reloading)."""
         if cls._predictor is not None:
             print("[MeterPredictor] Releasing singleton instance...")
+            cls._predictor.close()
             cls._predictor = None
             gc.collect()
             print("[MeterPredictor] Singleton instance released.")
 
 
-def get_meter_predictor():
+def _model_sizes(predictor):
+    def collect():
+        files = predictor.model_files()
+        return {(label,): os.path.getsize(path) for label, path in files.items() if os.path.exists(path)}
+    return collect
+
+
+def get_meter_predictor(config=None):
     """
     Get the singleton MeterPredictor instance.
     Use this function throughout the application instead of creating new instances.
+    The config is only used when the instance is created on the first call.
     """
     singleton = MeterPredictorSingleton()
-    return singleton.get_predictor()
+    return singleton.get_predictor(config)
+
+
+def loaded_meter_predictor():
+    """The singleton MeterPredictor if it was created already, otherwise None (nothing is loaded)."""
+    return MeterPredictorSingleton._predictor
@@ -0,0 +1,140 @@
+"""
+MQTT client on the asyncio event loop (mqtt_mode = "asyncio"), e.g. the one of uvicorn.
+
+The paho socket is registered with the loop (add_reader/add_writer), reconnects are tasks.
+Frames are still processed by the pipeline workers, blocking calls run in the default executor.
+"""
+import asyncio
+import threading
+
+from lib import metrics
+from lib.global_alerts import add_alert, remove_alert
+from lib.mqtt_handler import MQTTHandler
+
+MISC_INTERVAL = 1.0  # seconds between paho keepalive/timeout checks
+
+
+class AsyncMQTTHandler(MQTTHandler):
+
+    def __init__(self, config, db_file: str = 'watermeters.db'):
+        super().__init__(config, db_file=db_file, forever=False)
+        self.loop = None
+        self.broker = None
+        self.port = None
+        self.topic = None
+        self._loop_thread = None
+        self._misc_task = None
+        self._connect_task = None
+
+    # paho calls the socket callbacks from the loop (reads, keepalive) but also from the pipeline
+    # workers (publish) and the executor (connect), the selector may only be changed on the loop thread
+    def _on_loop(self, fn, *args):
+        if threading.get_ident() == self._loop_thread:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._on_loop(self.loop.add_reader, sock.fileno(), client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        # the file descriptor is taken now, the socket is closed when the callback returns
+        self._on_loop(self.loop.remove_reader, sock.fileno())
+        self._on_loop(self.loop.remove_writer, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_writer, sock.fileno())
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code != 0:
+            super()._on_connect(client, userdata, flags, reason_code, properties)
+            return
+        print("[MQTT] Successfully connected to MQTT broker")
+        remove_alert("mqtt")
+        # subscriptions do not survive a reconnect with a clean session
+        self.client.subscribe(self.topic)
+        # the registrations read the meters from the database, not on the event loop
+        self._on_loop(self.loop.run_in_executor, None, self._publish_registrations)
+
+    # Non-blocking replacement of the thread mode reconnect, safe to call from any thread
+    def _reconnect(self):
+        self._on_loop(self._schedule_connect, True)
+
+    def _schedule_connect(self, reconnect: bool):
+        if self.should_reconnect and (self._connect_task is None or self._connect_task.done()):
+            self._connect_task = self.loop.create_task(self._connect(reconnect))
+
+    # Connect (or reconnect) with exponential backoff, the blocking socket connect runs in the executor
+    async def _connect(self, reconnect: bool):
+        delay = 1
+        max_delay = 60
+        if reconnect:
+            add_alert("mqtt", "Reconnecting to MQTT broker")
+        while self.should_reconnect:
+            try:
+                if reconnect:
+                    print("[MQTT] Reconnecting to MQTT broker...")
+                    metrics.RECONNECTS.inc()
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                else:
+                    await self.loop.run_in_executor(None, self.client.connect, self.broker, self.port)
+                remove_alert("mqtt")
+                return
+            except Exception as e:
+                print(f"[MQTT] {'Reconnect' if reconnect else 'Connect'} failed: {e}, retrying in {delay} seconds...")
+                add_alert("mqtt", f"Failed to connect to MQTT broker: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    async def _misc(self):
+        while True:
+            self.client.loop_misc()
+            await asyncio.sleep(MISC_INTERVAL)
+
+    async def start_async(self,
+                          broker: str = 'localhost',
+                          port: int = 1883,
+                          topic: str = "MeterMonitor/#",
+                          username: str = None,
+                          password: str = None):
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.broker, self.port, self.topic = broker, port, topic
+
+        add_alert("mqtt", "Connecting to MQTT broker")
+        await self.loop.run_in_executor(None, self._prepare, username, password)
+
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+        self._misc_task = self.loop.create_task(self._misc())
+        self._schedule_connect(False)
+        print(f"[MQTT] Running on the asyncio event loop, connecting to {broker}:{port}")
+
+    async def stop_async(self):
+        self.should_reconnect = False
+        for task in (self._connect_task, self._misc_task):
+            if task is not None:
+                task.cancel()
+        self.client.disconnect()
+        # lets the loop write the DISCONNECT packet before the workers are stopped
+        await asyncio.sleep(0)
+        await self.loop.run_in_executor(None, self.pipeline.stop)
+        if self.spool:
+            await self.loop.run_in_executor(None, self.spool.close)
+        print("[MQTT] Stopped")
+
+
+async def serve_forever(config, mqtt_config):
+    """MQTT only (http disabled): run the handler on its own event loop until interrupted."""
+    handler = AsyncMQTTHandler(config, db_file=config['dbfile'])
+    await handler.start_async(**mqtt_config)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await handler.stop_async()
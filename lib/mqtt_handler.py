@@ -1,12 +1,21 @@
 import datetime
+import threading
 import time
+from collections import deque
 
 import paho.mqtt.client as mqtt
 import json
-import sqlite3
 from typing import Dict, Any
 
-from lib.functions import reevaluate_latest_picture, publish_registration
+from db.connection import get_database
+from lib import metrics
+from lib.frame_dedup import FrameDeduplicator
+from lib.frame_pipeline import FramePipeline
+from lib.functions import load_evaluation_context, evaluate_picture, save_evaluation, publish_value, publish_registration
+from lib.inference_pool import get_inference_pool
+from lib.inference_scheduler import get_inference_scheduler
+from lib.ingest_spool import IngestSpool, spool_path
+from lib.meter_processing.frame import Frame
 from lib.model_singleton import get_meter_predictor
 import traceback
 
@@ -20,9 +29,38 @@ class MQTTHandler:
         self.config = config
         self.forever = forever
         self.should_reconnect = True
-        # Use singleton instance (shared with HTTP server)
-        self.meter_preditor = get_meter_predictor()
-        print("[MQTT] Using shared meter predictor singleton instance.")
+        # Inference runs on worker threads, the network loop only parses and enqueues.
+        # In process mode each worker thread hands its frames to one inference process (see inference_pool.py)
+        pipeline_config = config.get('pipeline', {})
+        self.inference_pool = get_inference_pool(config)
+        # Use singleton instance (shared with HTTP server), not needed in process mode
+        self.meter_preditor = None
+        if self.inference_pool is None:
+            self.meter_preditor = get_meter_predictor(config)
+            print("[MQTT] Using shared meter predictor singleton instance.")
+        # Live frames have the highest priority for the predictor (shared with the HTTP server)
+        self.scheduler = get_inference_scheduler(config)
+        # With the spool the pipeline only queues sequence numbers, the payloads wait on disk (see ingest_spool.py)
+        spool_config = config.get('ingest_spool', {})
+        self.spool = IngestSpool(spool_path(config), spool_config) if spool_config.get('enabled', True) else None
+        # Frames that do not fit into the pipeline queue stay in the spool (bounded by its caps) and are
+        # queued oldest first when the workers make room, the overflow policy only applies without spool.
+        self._deferred = deque()  # (seq, name, picture time) of spooled frames waiting for room in the queue
+        self._deferred_lock = threading.Lock()
+        self.pipeline = FramePipeline(
+            self._process_spooled if self.spool else self._process_message,
+            workers=self.inference_pool.size if self.inference_pool else pipeline_config.get('workers', 2),
+            queue_size=pipeline_config.get('queue_size', 64),
+            overflow="defer" if self.spool else pipeline_config.get('overflow', 'drop_oldest'),
+            coalesce=pipeline_config.get('coalesce', True),
+            deadline=pipeline_config.get('deadline_s', 300),
+            continuity_gap=pipeline_config.get('continuity_gap_s', 600),
+            on_discard=self._discard_spooled if self.spool else None,
+            on_space=self._refill_from_spool if self.spool else None
+        )
+        # Repeated pictures are dropped before they are decoded (see frame_dedup.py)
+        self.dedup = FrameDeduplicator(config.get('dedup', {}))
+        metrics.QUEUE_DEPTH.add_function(self.pipeline.depth_by_meter)
 
     # On connect, remove the alert for the frontend
     # Also publish registration messages for all known watermeters
@@ -37,13 +75,16 @@ class MQTTHandler:
             self._reconnect()
             return
 
-        # send registration message for all watermeters
-        with sqlite3.connect(self.db_file) as conn:
+        self._publish_registrations()
+
+    # send registration message for all watermeters
+    def _publish_registrations(self):
+        with get_database(self.db_file).read() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT name FROM watermeters")
             rows = cursor.fetchall()
-            for row in rows:
-                publish_registration(self.client, self.config, row[0], "value")
+        for row in rows:
+            publish_registration(self.client, self.config, row[0], "value")
 
 
     # On disconnect, add an alert for the frontend and try to reconnect
@@ -64,6 +105,7 @@ class MQTTHandler:
         while self.should_reconnect:
             try:
                 print(f"[MQTT] Reconnecting to MQTT broker...")
+                metrics.RECONNECTS.inc()
                 self.client.reconnect()
                 print("Reconnected successfully")
                 remove_alert("mqtt")
@@ -73,10 +115,90 @@ class MQTTHandler:
                 time.sleep(delay)
                 delay = min(delay * 2, max_delay)  # Exponential backoff
 
-    # Validate the incoming message
+    # Ingest stage, runs on the paho network thread: parse, validate and enqueue only
     def _on_message(self, client, userdata, msg):
-        data = json.loads(msg.payload)
-        self._process_message(data)
+        try:
+            data = json.loads(msg.payload)
+        except ValueError as e:
+            print(f"[MQTT] Could not parse message on {msg.topic}: {e}")
+            metrics.REJECTIONS.inc("", "invalid_message")
+            return
+
+        if not isinstance(data, dict) or not self._validate_message(data):
+            print(f"[MQTT] Invalid message format received at {datetime.datetime.now().isoformat()} on {msg.topic}")
+            metrics.REJECTIONS.inc(data.get('name', '') if isinstance(data, dict) else '', "invalid_message")
+            return
+
+        # Check if timestamp is 0 or null, if so set it to current time
+        # (done at ingest, so a queued frame keeps its arrival time)
+        payload = msg.payload
+        if not data['picture']['timestamp'] or data['picture']['timestamp'] == "0":
+            # current iso time
+            data['picture']['timestamp'] = datetime.datetime.now().isoformat()
+            print(f"[MQTT] Timestamp was missing or zero, set to current time for {data['name']} ({data['picture']['timestamp']})")
+            # the spool has to keep the corrected message, not the one received
+            payload = json.dumps(data).encode()
+
+        if self.dedup.is_duplicate(data['name'], data['picture_number'], data['picture']['data']):
+            metrics.REJECTIONS.inc(data['name'], "duplicate")
+            return
+
+        if self.spool:
+            self._enqueue_spooled(self.spool.append(data['name'], payload), data['name'], self._picture_time(data))
+        elif not self.pipeline.submit(data['name'], data, self._picture_time(data)):
+            self.dedup.forget(data['name'], data['picture']['data'])
+
+    # Epoch seconds of the picture timestamp, None if it cannot be parsed (the pipeline uses the arrival time)
+    @staticmethod
+    def _picture_time(data: Dict[str, Any]):
+        try:
+            return datetime.datetime.fromisoformat(data['picture']['timestamp']).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    # Process a spooled frame, runs on a pipeline worker thread. Acknowledged once processed, so it is replayed after a crash
+    def _process_spooled(self, seq: int):
+        payload = self.spool.get(seq)
+        if payload is None:
+            return  # dropped from the full spool meanwhile
+        try:
+            self._process_message(json.loads(payload))
+        finally:
+            self.spool.ack(seq)
+
+    # Superseded by a newer frame or skipped after the deadline: not replayed
+    def _discard_spooled(self, name: str, seq: int):
+        self.spool.ack(seq)
+
+    # Queue a spooled frame, behind the frames that are already waiting for room in the queue
+    def _enqueue_spooled(self, seq: int, name: str, picture_time):
+        with self._deferred_lock:
+            self._deferred.append((seq, name, picture_time))
+        self._refill_from_spool()
+
+    def _refill_from_spool(self):
+        with self._deferred_lock:
+            while self._deferred:
+                seq, name, picture_time = self._deferred[0]
+                # dropped from the full spool meanwhile (the oldest frames go first)
+                if self.spool.contains(seq) and not self.pipeline.submit(name, seq, picture_time):
+                    break
+                self._deferred.popleft()
+
+    # Queue the frames that were not processed before the last shutdown, latest-wins coalescing applies to them too
+    def _replay_spool(self):
+        replayed = 0
+        for seq, name in self.spool.pending():
+            payload = self.spool.get(seq)
+            try:
+                data = json.loads(payload)
+            except (TypeError, ValueError):
+                self.spool.ack(seq)
+                continue
+            self._enqueue_spooled(seq, name, self._picture_time(data))
+            replayed += 1
+        if replayed:
+            print(f"[MQTT] Replayed {replayed} spooled frame(s)")
 
     def _validate_message(self, data: Dict[str, Any]) -> bool:
         # Erforderliche Top-Level Felder
@@ -102,25 +224,44 @@ class MQTTHandler:
 
         return True
 
-    # Process the incoming message
+    # Process a validated message, runs on a pipeline worker thread
     def _process_message(self, data: Dict[str, Any]):
         try:
-            if not self._validate_message(data):
-                print(f"[MQTT] Invalid message format received at {datetime.datetime.now().isoformat()}: {data}")
-                return
+            print(f"[MQTT] Processing message for watermeter {data['name']}")
 
-            print(f"[MQTT] Received message for watermeter {data['name']}")
+            name = data['name']
+            db = get_database(self.db_file)
+            metrics.FRAMES.inc(name)
 
-            # Check if timestamp is 0 or null, if so set it to current time
-            if not data['picture']['timestamp']or data['picture']['timestamp'] == "0":
-                # current iso time
-                data['picture']['timestamp'] = datetime.datetime.now().isoformat()
-                print(f"[MQTT] Timestamp was missing or zero, set to current time for {data['name']} ({data['picture']['timestamp']})")
+            # Read everything the evaluation needs up front, no connection is held during inference
+            with db.read() as conn:
+                context = load_evaluation_context(conn.cursor(), name)
+            # The picture is decoded once, here on the worker thread, and not read back from the database
+            evaluation = None
+            try:
+                frame = Frame.from_base64(name, data['picture']['timestamp'], data['picture']['data'])
+            except ValueError as e:
+                # still store the picture, it is shown in the frontend
+                print(f"[MQTT] {e}")
+                metrics.REJECTIONS.inc(name, "decode_error")
+            else:
+                if context["setup"] is not None and self.dedup.is_static(name, frame):
+                    metrics.REJECTIONS.inc(name, "unchanged_scene")
+                    self._save_static_frame(db, data)
+                    return
+                if self.inference_pool is not None:
+                    # the worker processes have their own predictors, no slot of the shared one is needed
+                    evaluation = self.inference_pool.evaluate(frame, context)
+                else:
+                    with self.scheduler.slot("live", name):
+                        evaluation = evaluate_picture(frame, context, self.meter_preditor, self.config)
 
-            with sqlite3.connect(self.db_file) as conn:
+            # Picture, evaluation and history entry are written in a single transaction
+            new_meter = False
+            with metrics.time_stage("db_write", name), db.write() as conn:
                 cursor = conn.cursor()
                 #check if watermeter exists
-                cursor.execute("SELECT * FROM watermeters WHERE name = ?", (data['name'],))
+                cursor.execute("SELECT 1 FROM watermeters WHERE name = ?", (name,))
                 if not cursor.fetchone():
                     cursor.execute('''
                         INSERT INTO watermeters (name, picture_number, wifi_rssi, picture_format, picture_timestamp, picture_width, picture_height, picture_length, picture_data, setup, picture_data_bbox)
@@ -139,6 +280,8 @@ class MQTTHandler:
                     ))
                     cursor.execute('''
                                     INSERT OR IGNORE INTO settings
+                                    (name, threshold_low, threshold_high, threshold_last_low, threshold_last_high, islanding_padding,
+                                     segments, rotated_180, shrink_last_3, extended_last_digit, max_flow_rate, conf_threshold)
                                     VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
                                 ''', (
                         data['name'],
@@ -154,8 +297,7 @@ class MQTTHandler:
                         1.0,
                         None
                     ))
-
-                    publish_registration(self.client, self.config, data['name'], "value")
+                    new_meter = True
                 else:
                     cursor.execute('''
                             UPDATE watermeters 
@@ -168,7 +310,8 @@ class MQTTHandler:
                                 picture_height = ?, 
                                 picture_length = ?, 
                                 picture_data = ?,
-                                picture_data_bbox = NULL
+                                picture_data_bbox = NULL,
+                                bbox_polygon = NULL
                             WHERE name = ?
                         ''', (
                         data['picture_number'],
@@ -181,29 +324,48 @@ class MQTTHandler:
                         data['picture']['data'],
                         data['name']
                     ))
-                conn.commit()
-                print(f"[MQTT] Saved/updated metadata of {data['name']} to database.")
-                _, _, boundingboxed_image = reevaluate_latest_picture(self.db_file, data['name'], self.meter_preditor,
-                                                                      self.config, publish=True,
-                                                                      mqtt_client=self.client)
-                # Insert boundingboxed image into database
-                if boundingboxed_image:
-                    cursor.execute('''
-                        UPDATE watermeters 
-                        SET picture_data_bbox = ?
-                        WHERE name = ?
-                    ''', (
-                        boundingboxed_image,
-                        data['name']
-                    ))
-                    conn.commit()
-                    print(f"[MQTT] Saved boundingboxed image of {data['name']} to database.")
+                if evaluation is not None:
+                    save_evaluation(cursor, name, evaluation, self.config)
+
+            if new_meter:
+                publish_registration(self.client, self.config, name, "value")
+            print(f"[MQTT] Saved/updated metadata of {name} to database.")
+            if evaluation is not None:
+                if evaluation["value"] is not None:
+                    publish_value(self.client, self.config, name, evaluation["value"])
+                print(f"[Eval ({name})] Prediction saved")
 
         except Exception as e:
             print(f"[MQTT] Error processing message: {e}")
             # print traceback
             traceback.print_exc()
 
+    # A picture that looks like the last evaluated one: keep picture, evaluation and history, only record that the meter is alive
+    def _save_static_frame(self, db, data: Dict[str, Any]):
+        with db.write() as conn:
+            conn.execute("UPDATE watermeters SET picture_number = ?, wifi_rssi = ?, picture_timestamp = ? WHERE name = ?",
+                         (data['picture_number'], data['WiFi-RSSI'], data['picture']['timestamp'], data['name']))
+        print(f"[Dedup ({data['name']})] Scene unchanged, skipped evaluation of picture {data['picture_number']}")
+
+    # Workers, spool replay, dedup state and client callbacks, everything before the connection is opened
+    def _prepare(self, username: str = None, password: str = None):
+        self.pipeline.start()
+        if self.spool:
+            self.spool.start()
+            self._replay_spool()
+
+        # the broker replays the retained picture of every meter on subscribe, those are already stored
+        if self.dedup.enabled:
+            with get_database(self.db_file).read() as conn:
+                self.dedup.seed(conn.execute("SELECT name, picture_number, picture_data FROM watermeters").fetchall())
+
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.on_disconnect = self._on_disconnect
+
+        if username and password:
+            self.client.username_pw_set(username, password)
+
     # Start the MQTT client
     def start(self,
               broker: str = 'localhost',
@@ -213,13 +375,7 @@ class MQTTHandler:
               password: str = None):
 
         add_alert("mqtt", "Connecting to MQTT broker")
-
-        self.client.on_connect = self._on_connect
-        self.client.on_message = self._on_message
-        self.client.on_disconnect = self._on_disconnect
-
-        if username and password:
-            self.client.username_pw_set(username, password)
+        self._prepare(username, password)
 
         try:
             self.client.connect(broker, port)
@@ -234,5 +390,9 @@ class MQTTHandler:
             self.client.loop_start()
 
     def stop(self):
+        self.should_reconnect = False
         self.client.loop_stop()
-        self.client.disconnect()
\ No newline at end of file
+        self.client.disconnect()
+        self.pipeline.stop()
+        if self.spool:
+            self.spool.close()
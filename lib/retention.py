@@ -0,0 +1,138 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from db.connection import get_database
+
+# rows the correction algorithm and the setup UI need, never removed by the age limits
+MIN_KEEP = {"history": 2, "evaluations": 1}
+
+# Timestamps are stored as the devices send them, with or without a UTC offset, 'T' or ' ' separated.
+# Compared as julian days in UTC: julianday() applies an offset itself, local times need the 'utc' modifier.
+_TIMESTAMP_UTC = ("julianday(timestamp, CASE WHEN timestamp GLOB '*Z' OR timestamp GLOB '*[+-][0-9][0-9]:[0-9][0-9]' "
+                  "THEN '+0 days' ELSE 'utc' END)")
+
+
+class RetentionJob:
+    """
+    Periodically trims history and evaluations in the background instead of on every frame.
+
+    Count limits: max_history / max_evals entries per meter (top level settings).
+    Age limits: max_history_days / max_evals_days, 0 or missing = disabled.
+    Rows are deleted in bounded batches, each in its own short write transaction, so ingestion
+    is never blocked for long. Freed pages are returned to the file system with incremental_vacuum
+    if the database uses incremental auto_vacuum, otherwise SQLite reuses them for new rows.
+    """
+
+    def __init__(self, db_file: str, config):
+        options = config.get('retention', {})
+        self.db_file = db_file
+        self.interval = options.get('interval_s', 300)
+        self.batch_size = options.get('batch_size', 500)
+        self.vacuum_pages = options.get('vacuum_pages', 1000)
+        self.limits = {
+            "history": (config.get('max_history', 200), config.get('max_history_days', 0)),
+            "evaluations": (config.get('max_evals', 100), config.get('max_evals_days', 0)),
+        }
+        self.last_report = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+        print(f"[Retention] Started (every {self.interval}s, batches of {self.batch_size})")
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        # first run shortly after startup, then every interval
+        while not self._stop.wait(min(self.interval, 30) if self.last_report is None else self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"[Retention] Error during retention run: {e}")
+
+    def run_once(self):
+        start = time.perf_counter()
+        db = get_database(self.db_file)
+        report = {"history": {}, "evaluations": {}, "freed_pages": 0}
+
+        for table, (max_count, max_days) in self.limits.items():
+            with db.read() as conn:
+                names = [row[0] for row in conn.execute(f"SELECT DISTINCT name FROM {table}")]
+            for name in names:
+                if self._stop.is_set():
+                    return None
+                trimmed = self._trim_count(db, table, name, max_count)
+                if max_days:
+                    trimmed += self._trim_age(db, table, name, max_days)
+                if trimmed:
+                    report[table][name] = trimmed
+
+        report["freed_pages"] = self._incremental_vacuum(db)
+        report["duration_ms"] = round((time.perf_counter() - start) * 1000.0, 1)
+        self.last_report = report
+
+        history = sum(report["history"].values())
+        evaluations = sum(report["evaluations"].values())
+        if history or evaluations or report["freed_pages"]:
+            print(f"[Retention] Trimmed {history} history entries and {evaluations} evaluations "
+                  f"({len(set(report['history']) | set(report['evaluations']))} meters), "
+                  f"freed {report['freed_pages']} pages in {report['duration_ms']} ms")
+        return report
+
+    def _cutoff_id(self, db, table, name, keep):
+        # id of the newest row that is no longer kept, None if there are not more than `keep` rows
+        with db.read() as conn:
+            row = conn.execute(f"SELECT id FROM {table} WHERE name = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                               (name, keep)).fetchone()
+        return row[0] if row else None
+
+    def _delete_batches(self, db, table, where, params):
+        deleted = 0
+        while not self._stop.is_set():
+            with db.write() as conn:
+                cursor = conn.execute(f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE {where} LIMIT ?)",
+                                      (*params, self.batch_size))
+                count = cursor.rowcount
+            deleted += count
+            if count < self.batch_size:
+                break
+        return deleted
+
+    def _trim_count(self, db, table, name, max_count):
+        cutoff = self._cutoff_id(db, table, name, max_count)
+        if cutoff is None:
+            return 0
+        return self._delete_batches(db, table, "name = ? AND id <= ?", (name, cutoff))
+
+    def _trim_age(self, db, table, name, max_days):
+        cutoff = self._cutoff_id(db, table, name, MIN_KEEP[table])
+        if cutoff is None:
+            return 0
+        oldest = (datetime.now(timezone.utc) - timedelta(days=max_days)).strftime("%Y-%m-%d %H:%M:%S")
+        return self._delete_batches(db, table, f"name = ? AND id <= ? AND {_TIMESTAMP_UTC} < julianday(?)", (name, cutoff, oldest))
+
+    def _incremental_vacuum(self, db):
+        with db.read() as conn:
+            # databases created before incremental auto_vacuum keep their freed pages for new rows
+            # (see retention.convert_auto_vacuum in migrations.py)
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0
+        freed = 0
+        while not self._stop.is_set():
+            with db.write() as conn:
+                free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if free_pages == 0:
+                    break
+                # the pragma only does its work while its result rows are stepped through
+                conn.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall()
+                remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            freed += free_pages - remaining
+            if remaining == free_pages:
+                break
+        return freed
@@ -1,5 +1,6 @@
+import asyncio
 import os
-import sqlite3
+import sys
 import threading
 from contextlib import asynccontextmanager
 
@@ -7,9 +8,14 @@ import uvicorn
 import json
 from fastapi import FastAPI
 
+from db.connection import open_database, close_databases
 from db.migrations import run_migrations
+from db.schema import create_tables
 from lib.http_server import prepare_setup_app
+from lib.inference_pool import get_inference_pool, close_inference_pool
+from lib.mqtt_async import AsyncMQTTHandler, serve_forever
 from lib.mqtt_handler import MQTTHandler
+from lib.retention import RetentionJob
 
 
 config = {}
@@ -43,80 +49,31 @@ print("[INIT] Loaded config:")
 # pretty print json
 print(json.dumps(config, indent=4))
 
+# benchmark the execution profiles on this host and exit (see lib/autotune.py)
+if '--autotune' in sys.argv:
+    from lib.autotune import run_autotune
+    sys.exit(run_autotune(config))
+
 # create database and tables
-db_connection = sqlite3.connect(config['dbfile'])
-cursor = db_connection.cursor()
-cursor.execute('''
-            CREATE TABLE IF NOT EXISTS watermeters (
-                name TEXT PRIMARY KEY,
-                picture_number INTEGER,
-                wifi_rssi INTEGER,
-                picture_format TEXT,
-                picture_timestamp TEXT,
-                picture_width INTEGER,
-                picture_height INTEGER,
-                picture_length INTEGER,
-                picture_data TEXT,
-                setup BOOLEAN DEFAULT 0,
-                picture_data_bbox BLOB,
-                source_type TEXT DEFAULT 'mqtt',
-                ha_entity_camera TEXT DEFAULT NULL,
-                ha_entity_led TEXT DEFAULT NULL,
-                ha_frequency INTEGER DEFAULT 600
-            )
-        ''')
-cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                name TEXT PRIMARY KEY,
-                threshold_low INTEGER,
-                threshold_high INTEGER,
-                threshold_last_low INTEGER,
-                threshold_last_high INTEGER,
-                islanding_padding INTEGER,
-                segments INTEGER,
-                rotated_180 BOOLEAN,
-                shrink_last_3 BOOLEAN,
-                extended_last_digit BOOLEAN,
-                max_flow_rate FLOAT,
-                conf_threshold REAL DEFAULT NULL,
-                FOREIGN KEY(name) REFERENCES watermeters(name)
-            )
-        ''')
-# Add evaluations table
-cursor.execute('''
-            CREATE TABLE IF NOT EXISTS evaluations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                colored_digits TEXT,
-                th_digits TEXT,
-                predictions TEXT,
-                timestamp DATETIME,
-                result INTEGER,
-                total_confidence REAL,
-                outdated BOOLEAN DEFAULT 0,
-                denied_digits TEXT,
-                th_digits_inverted TEXT,
-                FOREIGN KEY(name) REFERENCES watermeters(name)
-            )
-        ''')
-cursor.execute('''
-            CREATE TABLE IF NOT EXISTS history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                value INTEGER,
-                confidence REAL,
-                target_brightness REAL,
-                timestamp TEXT,
-                manual BOOLEAN,
-                FOREIGN KEY(name) REFERENCES watermeters(name)
-            )
-        ''')
-db_connection.commit()
+create_tables(config['dbfile'])
 
 # Run migrations
-run_migrations(config['dbfile'])
+# (retention.convert_auto_vacuum: one-time VACUUM of an existing database so the retention job can shrink the file)
+run_migrations(config['dbfile'], convert_auto_vacuum=config.get('retention', {}).get('convert_auto_vacuum', False))
+
+# In process mode the inference workers are forked now, before any thread or ONNX session exists
+get_inference_pool(config)
+
+# Open the shared connections (WAL writer + read-only pool) used by the MQTT handler and the HTTP server
+open_database(config['dbfile'], config.get('database', {}))
+
+# Trim history and evaluations in the background
+retention_job = RetentionJob(config['dbfile'], config)
+retention_job.start()
 
 MQTT_CONFIG = config['mqtt']
+# "thread": paho network loop in its own thread, "asyncio": on the event loop of the HTTP server (see lib/mqtt_async.py)
+MQTT_MODE = config.get('mqtt_mode', 'thread')
 
 # start application. if http is enabled, start the http server
 # if not, start only the mqtt handler
@@ -124,18 +81,37 @@ MQTT_CONFIG = config['mqtt']
 if config['http']['enabled']:
     @asynccontextmanager
     async def lifespan(_: FastAPI):
-        def run_mqtt():
+        if MQTT_MODE == 'asyncio':
+            mqtt_handler = AsyncMQTTHandler(config, db_file=config['dbfile'])
+            await mqtt_handler.start_async(**MQTT_CONFIG)
+            yield
+            await mqtt_handler.stop_async()
+        else:
             mqtt_handler = MQTTHandler(config, db_file=config['dbfile'], forever=True)
-            mqtt_handler.start(**MQTT_CONFIG)
-
-        thread = threading.Thread(target=run_mqtt, daemon=True)
-        thread.start()
-        yield
+            thread = threading.Thread(target=mqtt_handler.start, kwargs=MQTT_CONFIG, daemon=True)
+            thread.start()
+            yield
+            # workers and spool are stopped before the databases are closed
+            await asyncio.get_running_loop().run_in_executor(None, mqtt_handler.stop)
+        retention_job.stop()
+        close_inference_pool()
+        close_databases()
 
     app = prepare_setup_app(config, lifespan)
     print(f"[INIT] Started setup server on http://{config['http']['host']}:{config['http']['port']}")
     uvicorn.run(app, host=config['http']['host'], port=config['http']['port'], log_level="error")
 
 else:
-    mqtt_handler = MQTTHandler(config, db_file=config['dbfile'], forever=True)
-    mqtt_handler.start(**MQTT_CONFIG)
+    try:
+        if MQTT_MODE == 'asyncio':
+            asyncio.run(serve_forever(config, MQTT_CONFIG))
+        else:
+            mqtt_handler = MQTTHandler(config, db_file=config['dbfile'], forever=True)
+            try:
+                mqtt_handler.start(**MQTT_CONFIG)
+            finally:
+                mqtt_handler.stop()
+    finally:
+        retention_job.stop()
+        close_inference_pool()
+        close_databases()
@@ -0,0 +1,21 @@
+import base64
+import sqlite3
+from contextlib import closing
+
+from db.schema import create_tables
+from lib.autotune import load_sample_frames
+
+
+def test_sample_frames_of_a_path_with_uri_characters(tmp_path):
+    folder = tmp_path / "data #1 ?%20"
+    folder.mkdir()
+    db_file = str(folder / "watermeters.sqlite")
+    create_tables(db_file)
+    with closing(sqlite3.connect(db_file)) as conn:
+        conn.execute("INSERT INTO watermeters (name, picture_data) VALUES ('a', ?)", (base64.b64encode(b"jpeg").decode(),))
+        conn.commit()
+
+    samples = load_sample_frames(db_file)
+    assert [picture for picture, _ in samples] == [b"jpeg"]
+    # meters without settings get the defaults of new meters
+    assert samples[0][1][0] == 7
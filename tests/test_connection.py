@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from db.connection import Database
+
+
+def _database(path, **options):
+    db = Database(str(path), options)
+    with db.write() as conn:
+        conn.execute("CREATE TABLE t (v INTEGER)")
+        conn.execute("INSERT INTO t VALUES (1)")
+    return db
+
+
+@pytest.mark.parametrize("file_name", ["meters?x=1.db", "meters#1.db", "meters%20.db", "meters 1.db"])
+def test_reader_opens_paths_with_uri_characters(tmp_path, file_name):
+    db = _database(tmp_path / file_name)
+    try:
+        with db.read() as conn:
+            assert conn.execute("SELECT v FROM t").fetchall() == [(1,)]
+    finally:
+        db.close()
+    assert sorted(p.name for p in tmp_path.iterdir() if p.suffix == ".db") == [file_name]
+
+
+def test_readers_are_read_only(tmp_path):
+    db = _database(tmp_path / "w.db")
+    try:
+        with db.read() as conn, pytest.raises(Exception):
+            conn.execute("INSERT INTO t VALUES (2)")
+    finally:
+        db.close()
+
+
+def test_waiting_reader_fails_when_closed(tmp_path, monkeypatch):
+    monkeypatch.setattr("db.connection.READER_WAIT_INTERVAL", 0.05)
+    db = _database(tmp_path / "w.db", read_pool_size=1)
+    errors = []
+
+    def waiter():
+        try:
+            with db.read():
+                pass
+        except RuntimeError as e:
+            errors.append(e)
+
+    with db.read():
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        thread.join(0.2)
+        assert thread.is_alive()  # pool exhausted, waiting
+        db.close()
+        thread.join(2)
+    assert not thread.is_alive()
+    assert errors
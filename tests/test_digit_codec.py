@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from lib.meter_processing.digit_codec import (
+    _TH_HEADER, decode_colored_digits, decode_th_digits, encode_colored_digits, encode_th_digits,
+)
+from lib.meter_processing.image_encoding import threshold_to_uint8
+
+
+def _tensors(count=8, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.random((1, 64, 40, 1), dtype=np.float32) for _ in range(count)]
+
+
+def test_th_digits_keep_greyscale_pixels():
+    tensors = _tensors()
+    decoded = decode_th_digits(encode_th_digits(tensors))
+    assert len(decoded) == len(tensors)
+    for image, tensor in zip(decoded, tensors):
+        # same pixels as the PNG images of the legacy format
+        assert image.dtype == np.uint8
+        np.testing.assert_array_equal(image, threshold_to_uint8(tensor))
+
+
+def test_th_digits_inverted():
+    tensors = _tensors(3)
+    for image, tensor in zip(decode_th_digits(encode_th_digits(tensors), invert=True), tensors):
+        np.testing.assert_array_equal(image, threshold_to_uint8(tensor, invert=True))
+
+
+def test_th_digits_uint8_input_is_lossless():
+    images = [np.random.default_rng(1).integers(0, 256, (64, 40), dtype=np.uint8) for _ in range(4)]
+    for decoded, image in zip(decode_th_digits(encode_th_digits(images)), images):
+        np.testing.assert_array_equal(decoded, image)
+
+
+def test_th_digits_unknown_version_is_rejected():
+    blob = _TH_HEADER.pack(1, 2, 64, 40) + bytes(640)
+    with pytest.raises(ValueError, match="version 1"):
+        decode_th_digits(blob)
+
+
+def test_empty_digit_lists():
+    assert decode_th_digits(encode_th_digits([])) == []
+    assert decode_colored_digits(encode_colored_digits([])) == []
+
+
+def test_colored_digits_round_trip():
+    rng = np.random.default_rng(3)
+    digits = [rng.integers(0, 256, (60 + i, 30 + 2 * i, 3), dtype=np.uint8) for i in range(5)]
+    for decoded, digit in zip(decode_colored_digits(encode_colored_digits(digits)), digits):
+        np.testing.assert_array_equal(decoded, digit)
@@ -0,0 +1,89 @@
+import base64
+
+import cv2
+import numpy as np
+
+from lib.frame_dedup import FrameDeduplicator
+from lib.meter_processing.frame import Frame
+
+
+def _picture(seed=0, offset=0):
+    image = np.random.default_rng(seed).integers(0, 256, (48, 64, 3), dtype=np.uint8)
+    image = cv2.resize(image, (640, 480), interpolation=cv2.INTER_NEAREST)
+    image = np.clip(image.astype(int) + offset, 0, 255).astype(np.uint8)
+    ok, jpeg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return base64.b64encode(jpeg.tobytes()).decode()
+
+
+def test_replayed_picture_is_dropped():
+    dedup = FrameDeduplicator()
+    data = _picture()
+    assert not dedup.is_duplicate("m", 1, data)
+    assert dedup.is_duplicate("m", 1, data)
+    assert dedup.exact_duplicates == 1
+
+
+def test_same_content_with_new_picture_number_is_kept():
+    # a camera pointed at a meter that does not move sends the same picture with a new number
+    dedup = FrameDeduplicator()
+    data = _picture()
+    assert not dedup.is_duplicate("m", 1, data)
+    assert not dedup.is_duplicate("m", 2, data)
+    assert dedup.is_duplicate("m", 2, data)
+
+
+def test_same_number_with_new_content_is_kept():
+    dedup = FrameDeduplicator()
+    assert not dedup.is_duplicate("m", 1, _picture(0))
+    assert not dedup.is_duplicate("m", 1, _picture(1))
+
+
+def test_meters_are_separate_and_window_is_bounded():
+    dedup = FrameDeduplicator({"window": 2})
+    data = _picture()
+    assert not dedup.is_duplicate("a", 1, data)
+    assert not dedup.is_duplicate("b", 1, data)
+    assert not dedup.is_duplicate("a", 2, _picture(1))
+    assert not dedup.is_duplicate("a", 3, _picture(2))
+    # picture 1 of meter a is out of the window
+    assert not dedup.is_duplicate("a", 1, data)
+
+
+def test_seed_and_forget():
+    dedup = FrameDeduplicator()
+    data = _picture()
+    dedup.seed([("m", 7, data)])
+    assert dedup.is_duplicate("m", 7, data)
+
+    other = _picture(1)
+    assert not dedup.is_duplicate("m", 8, other)
+    dedup.forget("m", other)
+    assert not dedup.is_duplicate("m", 8, other)
+
+
+def test_disabled():
+    dedup = FrameDeduplicator({"enabled": False})
+    data = _picture()
+    assert not dedup.is_duplicate("m", 1, data)
+    assert not dedup.is_duplicate("m", 1, data)
+
+
+def test_static_scene():
+    dedup = FrameDeduplicator({"near_duplicate": True, "near_duplicate_max_skip": 2})
+    frame = lambda data: Frame.from_base64("m", "2026-01-01T00:00:00", data)
+    assert not dedup.is_static("m", frame(_picture()))
+    # slightly different exposure, same scene
+    assert dedup.is_static("m", frame(_picture(offset=3)))
+    assert dedup.is_static("m", frame(_picture(offset=3)))
+    # evaluated at least every max_skip frames
+    assert not dedup.is_static("m", frame(_picture()))
+    # different scene
+    assert not dedup.is_static("m", frame(_picture(seed=5)))
+
+
+def test_static_check_is_off_by_default():
+    dedup = FrameDeduplicator()
+    data = _picture()
+    frame = Frame.from_base64("m", "2026-01-01T00:00:00", data)
+    assert not dedup.is_static("m", frame)
+    assert not dedup.is_static("m", frame)
@@ -0,0 +1,164 @@
+import threading
+import time
+
+import pytest
+
+from lib.frame_pipeline import FramePipeline
+
+
+class Recorder:
+    """process_fn that records the frames and blocks on the first one until released."""
+
+    def __init__(self):
+        self.processed = []
+        self.discarded = []
+        self.first_started = threading.Event()
+        self.release = threading.Event()
+        self.done = threading.Condition()
+
+    def process(self, data):
+        if not self.first_started.is_set():
+            self.first_started.set()
+            self.release.wait(5)
+        if data == "fail":
+            raise RuntimeError("processing failed")
+        with self.done:
+            self.processed.append(data)
+            self.done.notify_all()
+
+    def discard(self, name, data):
+        self.discarded.append(data)
+
+    def wait_for(self, count, timeout=2.0):
+        with self.done:
+            assert self.done.wait_for(lambda: len(self.processed) >= count, timeout), self.processed
+
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+
+def _pipeline(recorder, **options):
+    options.setdefault("workers", 1)
+    pipeline = FramePipeline(recorder.process, on_discard=recorder.discard, **options)
+    pipeline.start()
+    return pipeline
+
+
+def _block(pipeline, recorder, name="block"):
+    """Occupy the only worker with a frame of another meter."""
+    pipeline.submit(name, name)
+    assert recorder.first_started.wait(2)
+
+
+def test_meters_are_served_round_robin(recorder):
+    pipeline = _pipeline(recorder, coalesce=False)
+    _block(pipeline, recorder, "a")
+    for data in ("a1", "a2", "a3"):
+        pipeline.submit("a", data)
+    pipeline.submit("b", "b1")
+    recorder.release.set()
+    recorder.wait_for(5)
+    pipeline.stop()
+    # b does not wait behind the backlog of a, the frames of a stay in order
+    assert recorder.processed == ["a", "b1", "a1", "a2", "a3"]
+
+
+def test_latest_wins(recorder):
+    pipeline = _pipeline(recorder, continuity_gap=0)
+    _block(pipeline, recorder)
+    for data in ("a1", "a2", "a3"):
+        pipeline.submit("a", data)
+    recorder.release.set()
+    recorder.wait_for(2)
+    pipeline.stop()
+    assert recorder.processed == ["block", "a3"]
+    assert recorder.discarded == ["a1", "a2"]
+    assert pipeline.superseded == 2
+
+
+def test_continuity_gap_keeps_frames(recorder):
+    pipeline = _pipeline(recorder, continuity_gap=600)
+    pipeline.submit("a", "a1", picture_time=0)
+    assert recorder.first_started.wait(2)
+    pipeline.submit("a", "a2", picture_time=500)
+    # without a2 the history would have a gap of 1000s after a1
+    pipeline.submit("a", "a3", picture_time=1000)
+    # a3 is redundant: a2 -> a4 is 600s
+    pipeline.submit("a", "a4", picture_time=1100)
+    recorder.release.set()
+    recorder.wait_for(3)
+    pipeline.stop()
+    assert recorder.processed == ["a1", "a2", "a4"]
+    assert recorder.discarded == ["a3"]
+
+
+def test_deadline_skips_stale_frames(recorder):
+    pipeline = _pipeline(recorder, deadline=0.05)
+    _block(pipeline, recorder)
+    pipeline.submit("a", "a1")
+    time.sleep(0.1)
+    pipeline.submit("b", "b1")
+    recorder.release.set()
+    recorder.wait_for(2)
+    pipeline.stop()
+    assert recorder.processed == ["block", "b1"]
+    assert recorder.discarded == ["a1"]
+    assert pipeline.expired == 1
+
+
+@pytest.mark.parametrize("overflow,expected", [("drop_oldest", ["block", "c1", "b1"]),
+                                                ("drop_newest", ["block", "a1", "b1"])])
+def test_overflow(recorder, overflow, expected):
+    pipeline = _pipeline(recorder, queue_size=2, overflow=overflow)
+    _block(pipeline, recorder)
+    assert pipeline.submit("a", "a1")
+    assert pipeline.submit("b", "b1")
+    assert pipeline.submit("c", "c1") == (overflow == "drop_oldest")
+    assert pipeline.dropped == 1
+    recorder.release.set()
+    recorder.wait_for(3)
+    pipeline.stop()
+    assert sorted(recorder.processed) == sorted(expected)
+    assert recorder.discarded == (["a1"] if overflow == "drop_oldest" else [])
+
+
+def test_worker_survives_errors(recorder):
+    pipeline = _pipeline(recorder)
+    _block(pipeline, recorder)
+    pipeline.submit("a", "fail")
+    pipeline.submit("b", "b1")
+    recorder.release.set()
+    recorder.wait_for(2)
+    pipeline.stop()
+    assert recorder.processed == ["block", "b1"]
+    assert pipeline.processed == 3
+
+
+def test_frames_of_a_meter_are_never_processed_in_parallel():
+    active = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def process(data):
+        name = data[0]
+        with lock:
+            if name in active:
+                overlaps.append(data)
+            active.add(name)
+        time.sleep(0.002)
+        with lock:
+            active.discard(name)
+
+    pipeline = FramePipeline(process, workers=4, queue_size=1000, coalesce=False)
+    pipeline.start()
+    for i in range(50):
+        for name in "abc":
+            pipeline.submit(name, (name, i))
+    deadline = time.monotonic() + 5
+    while pipeline.processed < 150 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pipeline.stop()
+    assert pipeline.processed == 150
+    assert overlaps == []
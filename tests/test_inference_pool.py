@@ -0,0 +1,130 @@
+import os
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from lib import functions, metrics
+from lib.inference_pool import InferenceProcessPool
+from lib.meter_processing import meter_processing
+from lib.meter_processing.frame import Frame
+from lib.meter_processing.prediction_cache import PredictionCache
+from lib.meter_processing.roi_cache import RoiCache
+
+
+class StubPredictor:
+    execution_profile = "stub"
+
+    def __init__(self, options):
+        self.roi_cache = RoiCache()
+        self.prediction_cache = PredictionCache()
+
+
+def stub_evaluate_picture(frame, context, predictor, config):
+    """Runs in the worker process: echoes the picture through the result blobs."""
+    if frame.name == "slow":
+        time.sleep(2)
+    if frame.name == "die":
+        os._exit(1)
+    if frame.name == "fail":
+        raise ValueError("no display found")
+    metrics.STAGE_SECONDS.observe("stub", frame.name, value=0.25)
+    return {
+        "timestamp": frame.timestamp,
+        "colored_blob": frame.data[::-1],
+        "th_blob": None if context.get("no_th") else frame.data[:16],
+        "prediction": [[("1", 0.9)]],
+        "value": len(frame.data),
+        "pid": os.getpid(),
+    }
+
+
+def _jpeg(size=(64, 48), seed=0):
+    image = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    ok, jpeg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 100])
+    return jpeg.tobytes()
+
+
+def _frame(name, data=None):
+    return Frame.from_bytes(name, "2026-01-01T10:00:00", data if data is not None else _jpeg())
+
+
+def _context(**extra):
+    return dict({"setup": True, "settings": (1, 2, 3)}, **extra)
+
+
+@pytest.fixture
+def pool_factory(tmp_path, monkeypatch):
+    # the workers are forked, they inherit the stubs
+    monkeypatch.setattr(functions, "evaluate_picture", stub_evaluate_picture)
+    monkeypatch.setattr(meter_processing, "MeterPredictor", StubPredictor)
+    pools = []
+
+    def create(**options):
+        options.setdefault("processes", 2)
+        pool = InferenceProcessPool({"dbfile": str(tmp_path / "w.sqlite"), "inference": {}}, **options)
+        pools.append(pool)
+        return pool
+
+    yield create
+    for pool in pools:
+        pool.close()
+
+
+def test_round_trip_through_shared_memory(pool_factory):
+    pool = pool_factory(slot_bytes=1024 * 1024)
+    data = _jpeg()
+    evaluation = pool.evaluate(_frame("meter1", data), _context())
+    assert evaluation["colored_blob"] == data[::-1]
+    assert evaluation["th_blob"] == data[:16]
+    assert evaluation["value"] == len(data)
+    assert evaluation["pid"] != os.getpid()
+
+
+def test_missing_blob_stays_none(pool_factory):
+    pool = pool_factory(slot_bytes=1024 * 1024)
+    evaluation = pool.evaluate(_frame("meter1"), _context(no_th=True))
+    assert evaluation["th_blob"] is None
+
+
+def test_pictures_larger_than_the_slot_are_pickled(pool_factory):
+    pool = pool_factory(slot_bytes=4096)
+    data = _jpeg(size=(640, 480))
+    assert len(data) > 4096
+    evaluation = pool.evaluate(_frame("meter1", data), _context())
+    assert evaluation["colored_blob"] == data[::-1]
+
+
+def test_worker_metrics_are_recorded_in_the_parent(pool_factory):
+    pool = pool_factory()
+    label = 'stage="stub",meter="metered"'
+    assert label not in metrics.render()
+    pool.evaluate(_frame("metered"), _context())
+    assert label in metrics.render()
+
+
+def test_evaluation_errors_are_raised(pool_factory):
+    pool = pool_factory()
+    with pytest.raises(RuntimeError, match="no display found"):
+        pool.evaluate(_frame("fail"), _context())
+    # the worker is still usable
+    assert pool.size == 2
+    assert pool.evaluate(_frame("meter1"), _context())["value"] > 0
+
+
+def test_timeout_is_not_reported_as_dead_worker(pool_factory):
+    pool = pool_factory(job_timeout=0.5)
+    with pytest.raises(TimeoutError):
+        pool.evaluate(_frame("slow"), _context())
+    # the stuck worker is replaced by the remaining one
+    assert pool.size == 1
+    assert pool.evaluate(_frame("meter1"), _context())["value"] > 0
+
+
+def test_dead_worker(pool_factory):
+    pool = pool_factory()
+    with pytest.raises(RuntimeError, match="died"):
+        pool.evaluate(_frame("die"), _context())
+    assert pool.size == 1
+    assert pool.evaluate(_frame("meter1"), _context())["value"] > 0
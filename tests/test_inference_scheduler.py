@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+
+from lib.inference_scheduler import InferenceScheduler, SchedulerSaturated
+
+
+def _hold(scheduler, priority_class, started, release, order=None):
+    def run():
+        with scheduler.slot(priority_class):
+            if order is not None:
+                order.append(priority_class)
+            started.set()
+            release.wait(5)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def _wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_class_limit_keeps_slots_for_live_frames():
+    scheduler = InferenceScheduler({"max_concurrent": 2, "interactive": {"limit": 1, "timeout": 0.05}})
+    release = threading.Event()
+    started = threading.Event()
+    thread = _hold(scheduler, "interactive", started, release)
+    assert started.wait(2)
+
+    # the second slot is not available to interactive requests
+    with pytest.raises(SchedulerSaturated) as error:
+        with scheduler.slot("interactive"):
+            pass
+    assert error.value.retry_after >= 1
+    assert scheduler.stats()["classes"]["interactive"]["rejected"] == 1
+
+    # but to live frames
+    with scheduler.slot("live"):
+        assert scheduler.stats()["classes"]["live"]["running"] == 1
+    release.set()
+    thread.join(2)
+
+
+def test_free_slot_goes_to_highest_priority_waiter():
+    scheduler = InferenceScheduler({"max_concurrent": 1,
+                                    "interactive": {"timeout": 5, "max_waiting": 4},
+                                    "bulk": {"timeout": 5, "max_waiting": 4}})
+    release = threading.Event()
+    started = threading.Event()
+    holder = _hold(scheduler, "bulk", started, release)
+    assert started.wait(2)
+
+    order = []
+    waiters = []
+    done = threading.Event()
+    done.set()  # the waiters release their slot right away
+    for priority_class in ("bulk", "interactive", "live"):
+        waiters.append(_hold(scheduler, priority_class, threading.Event(), done, order))
+        _wait_until(lambda: scheduler.stats()["classes"][priority_class]["waiting"] == 1)
+    for waiter in waiters:
+        # nothing starts while the slot is held
+        assert waiter.is_alive()
+
+    release.set()
+    for thread in [holder] + waiters:
+        thread.join(2)
+    assert order == ["live", "interactive", "bulk"]
+
+
+def test_max_waiting_rejects_immediately():
+    scheduler = InferenceScheduler({"max_concurrent": 1, "bulk": {"max_waiting": 0}})
+    start = time.perf_counter()
+    with pytest.raises(SchedulerSaturated):
+        with scheduler.slot("bulk"):
+            pass
+    assert time.perf_counter() - start < 0.1
+
+
+def test_live_waits_without_timeout():
+    scheduler = InferenceScheduler({"max_concurrent": 1})
+    release = threading.Event()
+    started = threading.Event()
+    holder = _hold(scheduler, "live", started, release)
+    assert started.wait(2)
+    threading.Timer(0.2, release.set).start()
+    with scheduler.slot("live"):
+        pass
+    holder.join(2)
+    assert scheduler.stats()["classes"]["live"]["completed"] == 2
+
+
+def test_slot_is_released_on_error():
+    scheduler = InferenceScheduler({"max_concurrent": 1})
+    with pytest.raises(ValueError):
+        with scheduler.slot("interactive"):
+            raise ValueError()
+    stats = scheduler.stats()["classes"]["interactive"]
+    assert stats["running"] == 0 and stats["completed"] == 1
+    with scheduler.slot("bulk"):
+        pass
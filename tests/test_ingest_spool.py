@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+from lib.ingest_spool import IngestSpool, spool_path
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "spool.sqlite")
+
+
+def test_spool_path_is_next_to_the_database():
+    assert spool_path({"dbfile": "/data/watermeters.sqlite"}) == "/data/spool.sqlite"
+    assert spool_path({"dbfile": "w.sqlite"}) == os.path.join(".", "spool.sqlite")
+    assert spool_path({"dbfile": "/data/w.sqlite", "ingest_spool": {"path": "/tmp/s.sqlite"}}) == "/tmp/s.sqlite"
+
+
+def test_append_get_ack(path):
+    spool = IngestSpool(path)
+    seq = spool.append("a", b"payload")
+    # readable before and after it was written
+    assert spool.get(seq) == b"payload"
+    spool.flush()
+    assert spool.get(seq) == b"payload"
+    spool.ack(seq)
+    assert spool.get(seq) is None
+    assert spool.pending() == []
+    spool.close()
+
+
+def test_unacknowledged_frames_are_replayed(path):
+    spool = IngestSpool(path)
+    first = spool.append("a", b"1")
+    second = spool.append("b", b"2")
+    third = spool.append("a", b"3")
+    spool.ack(second)
+    spool.close()
+
+    spool = IngestSpool(path)
+    assert spool.pending() == [(first, "a"), (third, "a")]
+    assert spool.get(third) == b"3"
+    # sequence numbers continue after the replayed frames
+    assert spool.append("c", b"4") > third
+    spool.close()
+
+
+def test_ack_before_flush_is_never_written(path):
+    spool = IngestSpool(path)
+    spool.ack(spool.append("a", b"x"))
+    spool.flush()
+    assert spool._conn.execute("SELECT COUNT(*) FROM frames").fetchone()[0] == 0
+    spool.close()
+
+
+def test_max_frames_drops_oldest(path):
+    spool = IngestSpool(path, {"max_frames": 3})
+    seqs = [spool.append("a", bytes([i])) for i in range(5)]
+    assert [seq for seq, _ in spool.pending()] == seqs[2:]
+    assert spool.get(seqs[0]) is None
+    assert spool.stats()["evicted"] == 2
+    spool.close()
+
+
+def test_max_mb_drops_oldest(path):
+    spool = IngestSpool(path, {"max_mb": 1})
+    seqs = [spool.append("a", bytes(400 * 1024)) for _ in range(4)]
+    assert [seq for seq, _ in spool.pending()] == seqs[2:]
+    assert spool.stats()["bytes"] == 800 * 1024
+    spool.close()
+
+
+def test_flusher_thread_writes(path):
+    spool = IngestSpool(path, {"flush_interval_ms": 10})
+    spool.start()
+    seq = spool.append("a", b"x")
+    spool.close()
+    assert IngestSpool(path).pending() == [(seq, "a")]
+
+
+def test_file_shrinks_when_empty(path):
+    spool = IngestSpool(path)
+    seqs = [spool.append("a", bytes(100 * 1024)) for _ in range(50)]
+    spool.flush()
+    size = os.path.getsize(path) + os.path.getsize(path + "-wal")
+    for seq in seqs:
+        spool.ack(seq)
+    spool.flush()
+    assert os.path.getsize(path) + os.path.getsize(path + "-wal") < size / 10
+    spool.close()
@@ -0,0 +1,102 @@
+import base64
+import json
+import sqlite3
+from collections import namedtuple
+from contextlib import closing
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from db import migrations
+from db.migrations import run_migrations
+from db.schema import create_tables
+from lib.meter_processing.digit_codec import decode_colored_digits, decode_th_digits
+
+
+def _png_base64(image):
+    buffered = BytesIO()
+    Image.fromarray(image).save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def _legacy_database(path):
+    """A database created before incremental auto_vacuum."""
+    db_file = str(path / "watermeters.sqlite")
+    create_tables(db_file)
+    with closing(sqlite3.connect(db_file)) as conn:
+        conn.execute("PRAGMA auto_vacuum = NONE")
+        conn.execute("VACUUM")
+    return db_file
+
+
+def _auto_vacuum(db_file):
+    with closing(sqlite3.connect(db_file)) as conn:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def test_new_database_uses_incremental_auto_vacuum(tmp_path):
+    db_file = str(tmp_path / "watermeters.sqlite")
+    create_tables(db_file)
+    run_migrations(db_file)
+    assert _auto_vacuum(db_file) == 2
+
+
+def test_existing_database_is_not_vacuumed_by_default(tmp_path):
+    db_file = _legacy_database(tmp_path)
+    run_migrations(db_file)
+    assert _auto_vacuum(db_file) == 0
+
+
+def test_auto_vacuum_conversion_is_opt_in(tmp_path):
+    db_file = _legacy_database(tmp_path)
+    run_migrations(db_file, convert_auto_vacuum=True)
+    assert _auto_vacuum(db_file) == 2
+
+
+def test_auto_vacuum_conversion_needs_free_space(tmp_path, monkeypatch):
+    db_file = _legacy_database(tmp_path)
+    usage = namedtuple("usage", "total used free")
+    monkeypatch.setattr(migrations.shutil, "disk_usage", lambda path: usage(1, 1, 0))
+    run_migrations(db_file, convert_auto_vacuum=True)
+    assert _auto_vacuum(db_file) == 0
+
+
+def test_migrations_are_idempotent(tmp_path):
+    db_file = _legacy_database(tmp_path)
+    run_migrations(db_file)
+    run_migrations(db_file)
+    with closing(sqlite3.connect(db_file)) as conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(evaluations)")]
+    assert columns.count("colored_digits_blob") == 1
+
+
+def test_legacy_digit_images_are_converted(tmp_path, monkeypatch):
+    monkeypatch.setattr(migrations, "DIGIT_MIGRATION_CHUNK", 2)
+    db_file = _legacy_database(tmp_path)
+    run_migrations(db_file)
+
+    rng = np.random.default_rng(0)
+    colored = [rng.integers(0, 256, (50, 20 + i, 3), dtype=np.uint8) for i in range(3)]
+    thresholded = [rng.integers(0, 256, (64, 40), dtype=np.uint8) for _ in range(3)]
+    with closing(sqlite3.connect(db_file)) as conn:
+        for _ in range(5):
+            conn.execute("INSERT INTO evaluations (name, colored_digits, th_digits, th_digits_inverted) VALUES ('m', ?, ?, ?)",
+                         (json.dumps([_png_base64(d) for d in colored]), json.dumps([_png_base64(d) for d in thresholded]),
+                          json.dumps([_png_base64(255 - d) for d in thresholded])))
+        conn.execute("INSERT INTO evaluations (name, colored_digits) VALUES ('m', '[\"not a png\"]')")
+        conn.commit()
+
+    run_migrations(db_file)
+
+    with closing(sqlite3.connect(db_file)) as conn:
+        rows = conn.execute("SELECT colored_digits, th_digits, th_digits_inverted, colored_digits_blob, th_digits_blob "
+                            "FROM evaluations ORDER BY id").fetchall()
+    for colored_json, th_json, inverted_json, colored_blob, th_blob in rows[:5]:
+        assert (colored_json, th_json, inverted_json) == (None, None, None)
+        for decoded, digit in zip(decode_colored_digits(colored_blob), colored):
+            np.testing.assert_array_equal(decoded, digit)
+        for decoded, digit in zip(decode_th_digits(th_blob), thresholded):
+            np.testing.assert_array_equal(decoded, digit)
+    # rows that cannot be converted keep their legacy images
+    assert rows[5][0] == '["not a png"]' and rows[5][3] is None
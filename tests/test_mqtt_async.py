@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+import pytest
+
+from db.connection import close_databases
+from db.migrations import run_migrations
+from db.schema import create_tables
+from lib import mqtt_handler
+from lib.mqtt_async import AsyncMQTTHandler
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    monkeypatch.setattr(mqtt_handler, "get_meter_predictor", lambda config: None)
+    db_file = str(tmp_path / "watermeters.sqlite")
+    create_tables(db_file)
+    run_migrations(db_file)
+    handler = AsyncMQTTHandler({"dbfile": db_file, "ingest_spool": {"enabled": False}}, db_file=db_file)
+    yield handler
+    close_databases()
+
+
+def test_on_connect_subscribes_and_registers_off_the_loop(handler):
+    subscribed = []
+    registered = threading.Event()
+    threads = []
+    handler.client.subscribe = subscribed.append
+
+    def publish_registrations():
+        threads.append(threading.get_ident())
+        registered.set()
+
+    handler._publish_registrations = publish_registrations
+
+    async def connect():
+        handler.loop = asyncio.get_running_loop()
+        handler._loop_thread = threading.get_ident()
+        handler.topic = "MeterMonitor/#"
+        handler._on_connect(handler.client, None, None, 0, None)
+        await handler.loop.run_in_executor(None, registered.wait, 2)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(connect())
+    assert subscribed == ["MeterMonitor/#"]
+    assert threads and threads[0] != loop_thread
+
+
+def test_connect_retries_without_blocking_the_loop(handler):
+    async def run():
+        await handler.start_async(broker="127.0.0.1", port=1, topic="MeterMonitor/#")
+        ticks = 0
+        for _ in range(20):
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert not handler.client.is_connected()
+        await handler.stop_async()
+        return ticks, [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    ticks, tasks = asyncio.run(run())
+    assert ticks == 20
+    assert tasks == []
@@ -0,0 +1,175 @@
+import base64
+import datetime
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from db.connection import close_databases
+from db.migrations import run_migrations
+from db.schema import create_tables
+from lib import mqtt_handler
+from lib.mqtt_handler import MQTTHandler
+
+
+def _message(timestamp, name="meter1", number=1):
+    ok, jpeg = cv2.imencode(".jpg", np.zeros((48, 64, 3), dtype=np.uint8))
+    data = base64.b64encode(jpeg.tobytes()).decode()
+    return {"name": name, "picture_number": number, "WiFi-RSSI": -50,
+            "picture": {"timestamp": timestamp, "format": "jpeg", "width": 64, "height": 48,
+                        "length": len(jpeg), "data": data}}
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    # the ingest path does not run inference
+    monkeypatch.setattr(mqtt_handler, "get_meter_predictor", lambda config: None)
+    db_file = str(tmp_path / "watermeters.sqlite")
+    create_tables(db_file)
+    run_migrations(db_file)
+    yield {
+        "dbfile": db_file,
+        "pipeline": {"workers": 1, "queue_size": 16},
+        "ingest_spool": {"enabled": True},
+        "dedup": {"enabled": True},
+    }
+    close_databases()
+
+
+def _receive(handler, data):
+    handler._on_message(None, None, SimpleNamespace(topic="MeterMonitor/" + data["name"], payload=json.dumps(data).encode()))
+
+
+@pytest.mark.parametrize("timestamp", ["0", ""])
+def test_missing_timestamp_is_fixed_in_the_spool(config, timestamp):
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    _receive(handler, _message(timestamp))
+
+    [(seq, name)] = handler.spool.pending()
+    spooled = json.loads(handler.spool.get(seq))
+    datetime.datetime.fromisoformat(spooled["picture"]["timestamp"])
+
+    processed = []
+    handler._process_message = processed.append
+    handler._process_spooled(seq)
+    datetime.datetime.fromisoformat(processed[0]["picture"]["timestamp"])
+    assert handler.spool.pending() == []
+    handler.spool.close()
+
+
+def test_replayed_frame_keeps_the_fixed_timestamp(config):
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    _receive(handler, _message("0"))
+    handler.spool.close()
+
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    submitted = []
+    handler.pipeline.submit = lambda name, seq, picture_time=None: submitted.append((name, picture_time)) or True
+    handler._replay_spool()
+    assert len(submitted) == 1
+    assert submitted[0][0] == "meter1" and submitted[0][1] is not None
+    handler.spool.close()
+
+
+def test_spool_keeps_the_received_payload(config):
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    data = _message("2026-01-01T10:00:00")
+    payload = json.dumps(data).encode()
+    handler._on_message(None, None, SimpleNamespace(topic="MeterMonitor/meter1", payload=payload))
+    [(seq, _)] = handler.spool.pending()
+    assert handler.spool.get(seq) == payload
+    handler.spool.close()
+
+
+def test_pipeline_keeps_the_configured_queue_size(config):
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    assert handler.pipeline.queue_size == 16
+    handler.spool.close()
+
+
+def test_replayed_picture_is_not_spooled(config):
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    data = _message("2026-01-01T10:00:00")
+    _receive(handler, data)
+    _receive(handler, data)
+    assert len(handler.spool.pending()) == 1
+    handler.spool.close()
+
+
+def _record_processing(handler, delay=0.0):
+    processed = []
+    lock = threading.Lock()
+
+    def process(data):
+        time.sleep(delay)
+        with lock:
+            processed.append((data["name"], data["picture_number"]))
+
+    handler._process_message = process
+    return processed
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+@pytest.mark.parametrize("coalesce", [True, False])
+def test_burst_larger_than_the_queue_is_not_lost(config, coalesce):
+    config["pipeline"].update(queue_size=4, coalesce=coalesce)
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    processed = _record_processing(handler, delay=0.002)
+    handler.pipeline.start()
+
+    # distinct meters, latest-wins has nothing to replace
+    sent = [(f"meter{i % 25}", i) for i in range(50 if not coalesce else 25)]
+    for name, number in sent:
+        _receive(handler, _message("2026-01-01T10:00:00", name=name, number=number))
+    assert handler.pipeline.deferred > 0
+
+    _wait_for(lambda: len(processed) == len(sent))
+    handler.pipeline.stop()
+    assert sorted(processed) == sorted(sent)
+    assert handler.spool.pending() == []
+    handler.spool.close()
+
+
+def test_restart_backlog_larger_than_the_queue_is_replayed(config):
+    config["pipeline"].update(queue_size=4)
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    sent = [(f"meter{i}", i) for i in range(30)]
+    for name, number in sent:
+        _receive(handler, _message("2026-01-01T10:00:00", name=name, number=number))
+    handler.spool.close()
+
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    processed = _record_processing(handler)
+    handler.pipeline.start()
+    handler._replay_spool()
+    _wait_for(lambda: len(processed) == len(sent))
+    handler.pipeline.stop()
+    assert sorted(processed) == sorted(sent)
+    assert handler.spool.pending() == []
+    handler.spool.close()
+
+
+def test_superseded_frames_are_acknowledged(config):
+    config["pipeline"].update(queue_size=4, workers=1)
+    handler = MQTTHandler(config, db_file=config["dbfile"])
+    processed = _record_processing(handler)
+    # nothing is processed yet, the newer frames of meter1 replace the older ones
+    for number in range(10):
+        _receive(handler, _message(f"2026-01-01T10:0{number}:00", number=number))
+    assert len(handler.spool.pending()) == 1
+    handler.pipeline.start()
+    _wait_for(lambda: len(processed) == 1)
+    handler.pipeline.stop()
+    assert processed == [("meter1", 9)]
+    assert handler.spool.pending() == []
+    handler.spool.close()
@@ -0,0 +1,121 @@
+"""The hot per-meter queries must be answered from indexes (no full scan of history or evaluations)."""
+import base64
+import json
+import os
+import sqlite3
+from contextlib import asynccontextmanager, closing
+
+import cv2
+import numpy as np
+import pytest
+
+from db import connection
+from db.connection import close_databases
+from db.migrations import run_migrations
+from db.schema import create_tables
+from tools.check_query_plans import HOT_QUERIES, fill, problems_of
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _plan(conn, query, params=()):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+
+
+@pytest.fixture(scope="module")
+def db_file(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp("plans") / "watermeters.sqlite")
+    create_tables(db_file)
+    run_migrations(db_file)
+    with closing(sqlite3.connect(db_file)) as conn:
+        fill(conn, meters=5, rows=500)
+        ok, jpeg = cv2.imencode(".jpg", np.zeros((96, 128, 3), dtype=np.uint8))
+        conn.execute("UPDATE watermeters SET picture_data = ?, picture_timestamp = '2026-01-02T00:00:00', picture_number = 1",
+                     (base64.b64encode(jpeg.tobytes()).decode(),))
+        conn.commit()
+    return db_file
+
+
+@pytest.mark.parametrize("label,query", HOT_QUERIES, ids=[label for label, _ in HOT_QUERIES])
+def test_listed_hot_queries_use_indexes(db_file, label, query):
+    placeholders = query.count("?")
+    params = (["meter0"] + [1] * (placeholders - 1)) if placeholders else []
+    with closing(sqlite3.connect(db_file)) as conn:
+        assert problems_of(label, _plan(conn, query, params)) == []
+
+
+@pytest.fixture
+def traced(db_file, monkeypatch):
+    """Every statement the application runs on db_file, with the parameters filled in."""
+    statements = []
+    connect = connection.Database._connect
+
+    def traced_connect(self, read_only):
+        conn = connect(self, read_only)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    close_databases()
+    monkeypatch.setattr(connection.Database, "_connect", traced_connect)
+    yield statements
+    close_databases()
+
+
+def _assert_indexed(db_file, statements):
+    queries = [s for s in statements if s.split(None, 1)[0].upper() in ("SELECT", "UPDATE", "DELETE", "INSERT")]
+    assert queries
+    with closing(sqlite3.connect(db_file)) as conn:
+        for query in queries:
+            plan = _plan(conn, query)
+            assert problems_of(query, plan) == [], f"{query}\n{plan}"
+
+
+@pytest.fixture
+def client(db_file, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    from lib import http_server
+
+    # the endpoints checked here do not run inference
+    monkeypatch.setattr(http_server, "get_meter_predictor", lambda config: None)
+    # prepare_setup_app serves the built frontend relative to the working directory
+    os.makedirs(tmp_path / "frontend" / "dist" / "assets")
+    (tmp_path / "frontend" / "dist" / "index.html").write_text("")
+    monkeypatch.chdir(tmp_path)
+
+    with open(os.path.join(REPO, "settings.json")) as f:
+        config = json.load(f)
+    config.update(dbfile=db_file, enable_auth=False, is_ha=False)
+
+    @asynccontextmanager
+    async def lifespan(_):
+        yield
+
+    return TestClient(http_server.prepare_setup_app(config, lifespan))
+
+
+def test_get_watermeters_uses_indexes(db_file, traced, client):
+    response = client.get("/api/watermeters")
+    assert response.status_code == 200
+    _assert_indexed(db_file, traced)
+
+
+@pytest.mark.parametrize("params", ["amount=10", "amount=10&from_id=300"])
+def test_get_evals_uses_indexes(db_file, traced, client, params):
+    response = client.get(f"/api/watermeters/meter1/evals?{params}")
+    assert response.status_code == 200
+    _assert_indexed(db_file, traced)
+
+
+def test_reevaluate_latest_picture_uses_indexes(db_file, traced, monkeypatch):
+    from lib import functions
+
+    evaluation = {
+        "timestamp": "2026-01-02T00:00:00", "target_brightness": 120.0, "colored_blob": None, "th_blob": None,
+        "prediction": [], "denied_digits": [], "value": 1500, "confidence": 0.9,
+        "bbox_info": functions.bbox_info_json([0] * 8, False),
+    }
+    # only the database access is checked here, not the inference
+    monkeypatch.setattr(functions, "evaluate_picture", lambda *args: dict(evaluation))
+    for skip_setup_overwriting in (True, False):
+        assert functions.reevaluate_latest_picture(db_file, "meter2", None, {}, skip_setup_overwriting=skip_setup_overwriting)
+    _assert_indexed(db_file, traced)
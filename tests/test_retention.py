@@ -0,0 +1,105 @@
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from db.connection import close_databases
+from db.migrations import run_migrations
+from db.schema import create_tables
+from lib.retention import RetentionJob
+
+
+def _database(path, auto_vacuum):
+    db_file = str(path / "watermeters.sqlite")
+    create_tables(db_file)
+    with closing(sqlite3.connect(db_file)) as conn:
+        conn.execute(f"PRAGMA auto_vacuum = {auto_vacuum}")
+        conn.execute("VACUUM")
+    run_migrations(db_file)
+    with closing(sqlite3.connect(db_file)) as conn:
+        for name in ("a", "b"):
+            conn.executemany("INSERT INTO history (name, value, confidence, timestamp, manual) VALUES (?, ?, 1, ?, 0)",
+                             [(name, i, f"2020-01-01T00:{i // 60:02d}:{i % 60:02d}") for i in range(300)])
+            conn.executemany("INSERT INTO evaluations (name, predictions, timestamp, th_digits_blob) VALUES (?, '[]', ?, ?)",
+                             [(name, "2020-01-01T00:00:00", bytes(2000)) for _ in range(150)])
+        conn.commit()
+    return db_file
+
+
+def _counts(db_file, table):
+    with closing(sqlite3.connect(db_file)) as conn:
+        return dict(conn.execute(f"SELECT name, COUNT(*) FROM {table} GROUP BY name").fetchall())
+
+
+@pytest.fixture(autouse=True)
+def _close_databases():
+    yield
+    close_databases()
+
+
+@pytest.mark.parametrize("auto_vacuum", ["INCREMENTAL", "NONE"])
+def test_count_limits(tmp_path, auto_vacuum):
+    db_file = _database(tmp_path, auto_vacuum)
+    job = RetentionJob(db_file, {"max_history": 200, "max_evals": 100, "retention": {"batch_size": 30}})
+    report = job.run_once()
+
+    assert _counts(db_file, "history") == {"a": 200, "b": 200}
+    assert _counts(db_file, "evaluations") == {"a": 100, "b": 100}
+    assert report["history"] == {"a": 100, "b": 100}
+    # the newest entries are kept
+    with closing(sqlite3.connect(db_file)) as conn:
+        assert conn.execute("SELECT MIN(value) FROM history WHERE name = 'a'").fetchone()[0] == 100
+    if auto_vacuum == "INCREMENTAL":
+        assert report["freed_pages"] > 0
+    else:
+        assert report["freed_pages"] == 0
+
+
+def test_age_limits_keep_minimum(tmp_path):
+    db_file = _database(tmp_path, "INCREMENTAL")
+    job = RetentionJob(db_file, {"max_history": 1000, "max_evals": 1000, "max_history_days": 30, "max_evals_days": 30})
+    job.run_once()
+    assert _counts(db_file, "history") == {"a": 2, "b": 2}
+    assert _counts(db_file, "evaluations") == {"a": 1, "b": 1}
+
+
+@pytest.mark.parametrize("tz", ["UTC0", "EST5"])
+def test_age_limits_compare_mixed_timestamp_formats(tmp_path, monkeypatch, tz):
+    monkeypatch.setenv("TZ", tz)
+    time.tzset()
+    db_file = str(tmp_path / "watermeters.sqlite")
+    create_tables(db_file)
+    run_migrations(db_file)
+
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=5)
+    local = cutoff.astimezone().replace(tzinfo=None)
+    rows = [
+        # (timestamp as stored, older than the cutoff)
+        ((local - timedelta(days=5)).isoformat(), True),
+        ((local - timedelta(minutes=30)).isoformat(sep=" ", timespec="seconds"), True),
+        ((local + timedelta(minutes=30)).isoformat(sep=" ", timespec="seconds"), False),
+        ((local + timedelta(minutes=30)).isoformat(), False),
+        ((cutoff - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ"), True),
+        # the text reads newer than the cutoff, the instant is older
+        ((cutoff - timedelta(hours=1)).astimezone(timezone(timedelta(hours=10))).isoformat(), True),
+        # the text reads older than the cutoff, the instant is newer
+        ((cutoff + timedelta(hours=1)).astimezone(timezone(timedelta(hours=-10))).isoformat(), False),
+    ]
+    recent = [(now.astimezone().replace(tzinfo=None).isoformat(), False)] * 2
+    with closing(sqlite3.connect(db_file)) as conn:
+        conn.executemany("INSERT INTO history (name, value, confidence, timestamp, manual) VALUES ('a', ?, 1, ?, 0)",
+                         [(i, timestamp) for i, (timestamp, _) in enumerate(rows + recent)])
+        conn.commit()
+
+    try:
+        RetentionJob(db_file, {"max_history": 1000, "max_history_days": 5}).run_once()
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    with closing(sqlite3.connect(db_file)) as conn:
+        kept = [row[0] for row in conn.execute("SELECT value FROM history WHERE name = 'a' ORDER BY value")]
+    assert kept == [i for i, (_, old) in enumerate(rows + recent) if not old]
@@ -0,0 +1,83 @@
+import threading
+
+import numpy as np
+import pytest
+
+from lib.meter_processing.yolo_batcher import YoloBatcher
+
+
+class _Input:
+    def __init__(self, batch_dim):
+        self.name = "images"
+        self.shape = [batch_dim, 3, 8, 8]
+
+
+class StubSession:
+    """Echoes the first pixel of every frame as its output row and records the batch sizes."""
+
+    def __init__(self, batch_dim="batch"):
+        self.batch_dim = batch_dim
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def get_inputs(self):
+        return [_Input(self.batch_dim)]
+
+    def run(self, output_names, feed):
+        x = feed["images"]
+        with self._lock:
+            self.batches.append(x.shape[0])
+        return [x[:, :1, 0, 0].copy()]
+
+
+def _frame(value):
+    return np.full((1, 3, 8, 8), value, dtype=np.float32)
+
+
+def test_concurrent_callers_get_their_own_rows():
+    session = StubSession()
+    batcher = YoloBatcher(session, "images", max_batch=4, max_wait_ms=50)
+    assert batcher.enabled
+    barrier = threading.Barrier(8)
+    results = {}
+
+    def call(value):
+        barrier.wait(2)
+        results[value] = batcher.run(_frame(value))
+
+    threads = [threading.Thread(target=call, args=(value,)) for value in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    batcher.close()
+
+    assert sorted(results) == list(range(8))
+    for value, out in results.items():
+        assert out.shape == (1, 1)
+        assert out[0, 0] == value
+    assert sum(session.batches) == 8
+    assert max(session.batches) > 1
+    assert max(session.batches) <= 4
+
+
+def test_fixed_batch_size_disables_batching(capsys):
+    batcher = YoloBatcher(StubSession(batch_dim=1), "images", max_batch=4, model_name="models/fixed.onnx")
+    assert not batcher.enabled
+    assert "models/fixed.onnx has a fixed batch size of 1" in capsys.readouterr().out
+    assert batcher.run(_frame(3))[0, 0] == 3
+    batcher.close()
+
+
+def test_fixed_batch_size_limits_the_batch():
+    batcher = YoloBatcher(StubSession(batch_dim=2), "images", max_batch=4)
+    assert batcher.max_batch == 2
+    batcher.close()
+
+
+@pytest.mark.parametrize("max_batch", [1, 4])
+def test_run_after_close_raises(max_batch):
+    batcher = YoloBatcher(StubSession(), "images", max_batch=max_batch)
+    batcher.close()
+    with pytest.raises(RuntimeError, match="closed"):
+        batcher.run(_frame(1))
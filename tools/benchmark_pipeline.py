@@ -0,0 +1,293 @@
+"""
+Offline benchmark of the inference hot path over recorded frames.
+
+Drives MeterPredictor.extract_display_and_segment, apply_thresholds and predict_digits like the
+MQTT pipeline does and reports:
+  - p50/p95/p99 latency per stage: the stages instrumented in lib/metrics.py (decode, letterbox,
+    yolo, warp_segment) plus extract, threshold, classify and the whole frame
+  - frames per second with 1..N threads (frames of different meters are processed in parallel)
+  - peak RSS of the process
+  - with --processes N: frames per second with 1..N inference worker processes (pipeline.mode
+    "processes", see lib/inference_pool.py) and the scaling efficiency against one process
+
+Corpus:
+  --frames DIR   camera pictures (*.jpg, *.jpeg, *.png, recursively), e.g. the folder written by
+                 tools/mqtt_image_collector.py
+  --dataset DIR  dataset export folders (<meter>/color/<label>/*.png), the colored digits are grouped
+                 into frames of --segments digits and only go through threshold and classify
+
+The results are written as JSON. With --baseline, a previous result is compared stage by stage and
+the exit code is 1 if a p50/p95 latency or the throughput got worse by more than --threshold.
+
+ROI and prediction caches are off unless --caches is given, so every frame runs the full pipeline.
+
+Usage: python tools/benchmark_pipeline.py --frames collected_images [--dataset data/output_dataset]
+           [--threads 4] [--processes 8] [--rounds 3] [--out bench.json] [--baseline baseline.json] [--threshold 0.1]
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from lib import metrics  # noqa: E402
+from lib.functions import DEFAULT_SETTINGS  # noqa: E402
+from lib.inference_pool import InferenceProcessPool  # noqa: E402
+from lib.meter_processing.frame import Frame  # noqa: E402
+
+PICTURE_PATTERNS = ("*.jpg", "*.jpeg", "*.png")
+
+
+class StageRecorder(metrics.Histogram):
+    """Stage histogram that also keeps the raw durations, installed in place of metrics.STAGE_SECONDS."""
+
+    def __init__(self):
+        super().__init__(metrics.STAGE_SECONDS.name, metrics.STAGE_SECONDS.help, ["stage", "meter"])
+        self.samples = defaultdict(list)
+
+    def observe(self, *labels, value):
+        super().observe(*labels, value=value)
+        self.samples[labels[0]].append(value)  # list.append is atomic, no lock needed
+
+    def reset(self):
+        self.samples = defaultdict(list)
+
+
+def load_frames(folder):
+    paths = []
+    for pattern in PICTURE_PATTERNS:
+        paths += glob.glob(os.path.join(folder, "**", pattern), recursive=True)
+    samples = []
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            # the parent folder stands in for the meter (per meter caches, metric labels)
+            samples.append(("frame", os.path.basename(os.path.dirname(path)) or "bench", f.read()))
+    return samples
+
+
+def load_digit_groups(folder, segments):
+    paths = sorted(glob.glob(os.path.join(folder, "*", "color", "*", "*.png")))
+    digits = []
+    for path in paths:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is not None:
+            digits.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    return [("digits", "dataset", digits[i:i + segments]) for i in range(0, len(digits) - segments + 1, segments)]
+
+
+class Bench:
+
+    def __init__(self, predictor, recorder, args):
+        self.predictor = predictor
+        self.recorder = recorder
+        self.args = args
+        self.thresholds = [args.threshold_low, args.threshold_high]
+
+    def _timed(self, stage, fn):
+        start = time.perf_counter()
+        result = fn()
+        self.recorder.samples[stage].append(time.perf_counter() - start)
+        return result
+
+    def process(self, sample):
+        kind, meter, data = sample
+        start = time.perf_counter()
+        if kind == "frame":
+            frame = Frame.from_bytes(meter, "", data)
+            digits, _, _ = self._timed("extract", lambda: self.predictor.extract_display_and_segment(
+                frame, segments=self.args.segments, rotated_180=self.args.rotated_180))
+        else:
+            digits = data
+        if digits:
+            th_digits = self._timed("threshold", lambda: self.predictor.apply_thresholds(digits, self.thresholds, self.thresholds, self.args.padding))
+            self._timed("classify", lambda: self.predictor.predict_digits(th_digits, name=meter if self.args.caches else None))
+        self.recorder.samples[f"{kind}_total"].append(time.perf_counter() - start)
+
+    def latency(self, corpus, rounds):
+        self.recorder.reset()
+        for _ in range(rounds):
+            for sample in corpus:
+                self.process(sample)
+        stages = {}
+        for stage, values in sorted(self.recorder.samples.items()):
+            ms = np.array(values) * 1000.0
+            stages[stage] = {
+                "count": len(values),
+                "mean_ms": round(float(ms.mean()), 3),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                "p99_ms": round(float(np.percentile(ms, 99)), 3),
+            }
+        return stages
+
+    def throughput(self, corpus, rounds, threads):
+        jobs = corpus * rounds
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(self.process, jobs))
+        return round(len(jobs) / (time.perf_counter() - start), 2)
+
+
+def process_throughput(corpus, options, args):
+    """Frames per second of evaluate_picture on a pool of 1..N worker processes, driven by as many threads."""
+    frames = [Frame.from_bytes(meter, "", data) for kind, meter, data in corpus if kind == "frame"]
+    if not frames:
+        print("[Bench] No camera pictures in the corpus, skipping the process pool")
+        return {}
+    settings = list(DEFAULT_SETTINGS)
+    settings[0:6] = [args.threshold_low, args.threshold_high, args.threshold_low, args.threshold_high, args.padding, args.segments]
+    settings[9] = args.rotated_180
+    context = {"setup": False, "settings": tuple(settings), "history": [], "target_brightness": None}
+    config = {"inference": options, "dbfile": os.path.join(ROOT, "data", "bench.sqlite"), "allow_negative_correction": False}
+
+    throughput = {}
+    for processes in range(1, max(1, args.processes) + 1):
+        pool = InferenceProcessPool(config, processes, execution_profile=args.process_profile)
+        try:
+            for frame in frames[:processes]:
+                pool.evaluate(frame, context)  # warm up
+            jobs = [frame for _ in range(args.rounds) for frame in frames]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=processes) as executor:
+                list(executor.map(lambda frame: pool.evaluate(frame, context), jobs))
+            throughput[str(processes)] = round(len(jobs) / (time.perf_counter() - start), 2)
+        finally:
+            pool.close()
+        scaling = throughput[str(processes)] / throughput["1"] / processes
+        print(f"[Bench] {processes} process(es): {throughput[str(processes)]} frames/s ({scaling:.0%} of linear)")
+    return throughput
+
+
+def compare(result, baseline, threshold):
+    """Regressions of result against baseline, as printable lines."""
+    regressions = []
+    for stage, current in result["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if not previous:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            if previous[key] > 0 and current[key] > previous[key] * (1 + threshold):
+                regressions.append(f"{stage} {key}: {previous[key]} -> {current[key]} (+{current[key] / previous[key] - 1:.0%})")
+    for threads, fps in result["throughput"].items():
+        previous = baseline.get("throughput", {}).get(threads)
+        if previous and fps < previous * (1 - threshold):
+            regressions.append(f"throughput at {threads} thread(s): {previous} -> {fps} fps ({fps / previous - 1:.0%})")
+    for processes, fps in result.get("process_throughput", {}).items():
+        previous = baseline.get("process_throughput", {}).get(processes)
+        if previous and fps < previous * (1 - threshold):
+            regressions.append(f"throughput at {processes} process(es): {previous} -> {fps} fps ({fps / previous - 1:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", help="folder with recorded camera pictures")
+    parser.add_argument("--dataset", help="dataset export folder with colored digits")
+    parser.add_argument("--settings", default=os.path.join(ROOT, "settings.json"), help="settings.json to take the inference options from")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1, help="measure throughput with 1..N threads")
+    parser.add_argument("--processes", type=int, default=0, help="also measure throughput with 1..N inference worker processes")
+    parser.add_argument("--process-profile", default="throughput", help="execution profile of the worker processes")
+    parser.add_argument("--rounds", type=int, default=3, help="passes over the corpus per measurement")
+    parser.add_argument("--segments", type=int, default=7)
+    parser.add_argument("--rotated-180", action="store_true")
+    parser.add_argument("--threshold-low", type=int, default=0)
+    parser.add_argument("--threshold-high", type=int, default=100)
+    parser.add_argument("--padding", type=int, default=20, help="islanding padding in percent")
+    parser.add_argument("--caches", action="store_true", help="keep the ROI and prediction caches on")
+    parser.add_argument("--out", default="bench.json", help="result file")
+    parser.add_argument("--baseline", help="previous result to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown against the baseline (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    corpus = []
+    if args.frames:
+        corpus += load_frames(args.frames)
+    if args.dataset:
+        corpus += load_digit_groups(args.dataset, args.segments)
+    if not corpus:
+        parser.error("no frames found, pass --frames and/or --dataset")
+
+    with open(args.settings, "r") as f:
+        options = dict(json.load(f).get("inference", {}))
+    if not args.caches:
+        options.update(roi_cache=False, prediction_cache=False)
+
+    recorder = StageRecorder()
+    metrics.STAGE_SECONDS = recorder
+
+    # the model paths are relative to the repository root, like in the server
+    out, baseline_path = os.path.abspath(args.out), args.baseline and os.path.abspath(args.baseline)
+    os.chdir(ROOT)
+
+    # the worker processes are forked before this process creates any ONNX session
+    process_fps = process_throughput(corpus, options, args) if args.processes else {}
+
+    from lib.meter_processing.meter_processing import MeterPredictor
+    predictor = MeterPredictor(options)
+    bench = Bench(predictor, recorder, args)
+
+    try:
+        print(f"[Bench] {len(corpus)} samples, warming up...")
+        for sample in corpus:
+            bench.process(sample)
+
+        stages = bench.latency(corpus, args.rounds)
+        for stage, values in stages.items():
+            print(f"[Bench] {stage:14s} p50 {values['p50_ms']:9.3f} ms   p95 {values['p95_ms']:9.3f} ms   p99 {values['p99_ms']:9.3f} ms   ({values['count']})")
+
+        throughput = {}
+        for threads in range(1, max(1, args.threads) + 1):
+            throughput[str(threads)] = bench.throughput(corpus, args.rounds, threads)
+            print(f"[Bench] {threads} thread(s): {throughput[str(threads)]} frames/s")
+    finally:
+        predictor.close()
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    print(f"[Bench] Peak RSS {peak_rss / 1024 / 1024:.0f} MB")
+
+    result = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "samples": len(corpus),
+            "rounds": args.rounds,
+            "caches": args.caches,
+            "execution_profile": predictor.execution_profile,
+        },
+        "stages": stages,
+        "throughput": throughput,
+        "process_throughput": process_fps,
+        "peak_rss_bytes": peak_rss,
+    }
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"[Bench] Wrote {out}")
+
+    if baseline_path:
+        with open(baseline_path, "r") as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        if regressions:
+            print(f"[Bench] Regressions against {baseline_path} (threshold {args.threshold:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"[Bench] No regressions against {baseline_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Microbenchmark for MeterPredictor.apply_threshold on noisy digits.
+
+Compares the current vectorized islanding (connectedComponentsWithStats + lookup table)
+against the previous per-label loop and checks that both produce the same tensors.
+
+Usage: python tools/benchmark_threshold.py [--noise 0.05] [--runs 200] [--padding 20]
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.meter_processing.meter_processing import MeterPredictor  # noqa: E402
+
+
+def legacy_apply_threshold(digit, threshold_low, threshold_high, islanding_padding=40):
+    """The per-label implementation the vectorized version replaced."""
+    digit = cv2.cvtColor(digit, cv2.COLOR_BGR2GRAY)
+    digit = cv2.inRange(digit, int(threshold_low), int(threshold_high))
+    inverted = cv2.bitwise_not(digit)
+    num_labels, labels = cv2.connectedComponents(inverted)
+    color_image = np.full((*digit.shape, 3), (255, 255, 255), dtype=np.uint8)
+    height, width = digit.shape
+    start_x = int((islanding_padding / 100.0) * width)
+    end_x = int(1.0 - (islanding_padding / 100.0) * width)
+    start_y = int((islanding_padding / 100.0) * height)
+    end_y = int(1.0 - (islanding_padding / 100.0) * height)
+
+    extracted = 0
+    extracted_percentage = 0
+    for label in range(1, num_labels):
+        component_region = labels[start_y:end_y, start_x:end_x]
+        if np.any(component_region == label):
+            color = (0, 0, 0)
+            extracted += 1
+            extracted_percentage += np.sum(labels == label) / (height * width) * 100
+        else:
+            color = (255, 255, 255)
+        color_image[labels == label] = color
+
+    if extracted == 0 or extracted_percentage < 10:
+        color_image = np.full((*digit.shape, 3), (255, 255, 255), dtype=np.uint8)
+        color_image[labels != 0] = (0, 0, 0)
+
+    color_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
+    digit = cv2.resize(color_image, (40, 64))
+    img_norm = digit.astype('float32') / 255.0
+    return img_norm[np.newaxis, :, :, np.newaxis]
+
+
+def make_noisy_digit(rng, value, noise, size=(90, 60)):
+    """A bright digit on a dark drum, sprinkled with bright specks (dust, reflections, JPEG artefacts)."""
+    height, width = size
+    img = np.full((height, width, 3), 30, dtype=np.uint8)
+    cv2.putText(img, str(value), (8, height - 18), cv2.FONT_HERSHEY_SIMPLEX, 2.0, (220, 220, 220), 5)
+    specks = rng.random((height, width)) < noise
+    img[specks] = 220
+    return img
+
+
+def time_fn(fn, digits, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        for digit in digits:
+            fn(digit)
+    return (time.perf_counter() - start) / (runs * len(digits)) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--noise", type=float, default=0.05, help="fraction of pixels turned into specks")
+    parser.add_argument("--runs", type=int, default=200, help="repetitions over the digit set")
+    parser.add_argument("--padding", type=int, default=20, help="islanding padding in percent")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    digits = [make_noisy_digit(rng, i, args.noise) for i in range(10)]
+
+    # apply_threshold does not need the ONNX sessions
+    predictor = MeterPredictor.__new__(MeterPredictor)
+
+    def current(digit):
+        return predictor.apply_threshold(digit, 0, 100, args.padding)
+
+    def legacy(digit):
+        return legacy_apply_threshold(digit, 0, 100, args.padding)
+
+    for digit in digits:
+        if not np.array_equal(current(digit), legacy(digit)):
+            print("Mismatch between vectorized and legacy implementation!")
+            sys.exit(1)
+
+    labels = [cv2.connectedComponents(cv2.bitwise_not(cv2.inRange(cv2.cvtColor(d, cv2.COLOR_BGR2GRAY), 0, 100)))[0] for d in digits]
+    print(f"Noise {args.noise:.2%}, {np.mean(labels):.0f} components per digit on average")
+
+    t_legacy = time_fn(legacy, digits, args.runs)
+    t_current = time_fn(current, digits, args.runs)
+    print(f"legacy loop:  {t_legacy:8.3f} ms/digit")
+    print(f"vectorized:   {t_current:8.3f} ms/digit")
+    print(f"speedup:      {t_legacy / t_current:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
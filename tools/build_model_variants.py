@@ -0,0 +1,316 @@
+"""
+Builds quantized and reduced input variants of the detector and the digit classifier and reports
+their accuracy and latency against the fp32 models.
+
+Variants (written to --out, listed in manifest.json, see lib/meter_processing/model_variants.py):
+    int8-dynamic        both models with dynamically quantized INT8 weights
+    int8-static         both models statically quantized (QDQ), calibrated on stored data
+    fp32-<size>         fp32 detector with a <size>x<size> input
+    int8-static-<size>  statically quantized detector with a <size>x<size> input, int8-static classifier
+
+Calibration data comes from the database: the latest picture of every meter for the detector and
+the thresholded digits of stored evaluations for the classifier.
+
+The report compares each variant with the fp32 models:
+    detector    detection rate and mean IoU of the display polygon on the stored pictures, ms per frame
+    classifier  top-1 accuracy on the labeled dataset folders (<output_dataset>/<meter>/th/<label>/*.png)
+                and ms per 7 digit batch
+
+Reduced input sizes need a detector exported with dynamic input dimensions. Fixed size exports
+are rewritten, which only works if the export has no input size dependent constants (the anchor
+grid of most YOLO exports is one). Otherwise re-export with `yolo export ... imgsz=<size>` and
+place it as models/variants/yolo-fp32-<size>.onnx.
+
+Needs the onnx package (pip install onnx), which is not required at runtime.
+
+Usage: python tools/build_model_variants.py [--db data/watermeters.sqlite] [--dataset data/output_dataset]
+                                            [--sizes 320] [--calibration 64] [--out models/variants]
+"""
+import argparse
+import base64
+import glob
+import json
+import os
+import pathlib
+import sqlite3
+import sys
+import time
+from contextlib import closing
+
+import cv2
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from lib.meter_processing.digit_codec import decode_th_digits  # noqa: E402
+from lib.meter_processing.onnx_helpers import letterbox  # noqa: E402
+
+DETECTOR = "models/yolo-best-obb-2.onnx"
+CLASSIFIER = "models/best_model.onnx"
+CLASS_NAMES = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'r']
+
+
+# --- calibration data ---
+
+def connect_read_only(db_file):
+    # as_uri() escapes '?', '#' and '%' in the path
+    return sqlite3.connect(pathlib.Path(db_file).resolve().as_uri() + "?mode=ro", uri=True)
+
+
+def load_pictures(db_file, limit):
+    """Decoded RGB pictures (rotated like the meter settings say) of the stored latest frames."""
+    with closing(connect_read_only(db_file)) as conn:
+        rows = conn.execute('''
+            SELECT w.picture_data, s.rotated_180 FROM watermeters w LEFT JOIN settings s ON s.name = w.name
+            WHERE w.picture_data IS NOT NULL LIMIT ?
+        ''', (limit,)).fetchall()
+    pictures = []
+    for data, rotated_180 in rows:
+        img = cv2.imdecode(np.frombuffer(base64.b64decode(data), dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        pictures.append(cv2.rotate(img, cv2.ROTATE_180) if rotated_180 else img)
+    return pictures
+
+
+def load_digit_tensors(db_file, limit):
+    """Classifier inputs (1,64,40,1) of stored evaluations."""
+    with closing(connect_read_only(db_file)) as conn:
+        rows = conn.execute("SELECT th_digits_blob FROM evaluations WHERE th_digits_blob IS NOT NULL ORDER BY id DESC LIMIT ?",
+                            (limit,)).fetchall()
+    tensors = []
+    for (blob,) in rows:
+        for img in decode_th_digits(blob):
+            tensors.append((img.astype(np.float32) / 255.0)[None, :, :, None])
+    return tensors[:limit]
+
+
+def load_labeled_digits(dataset_root):
+    """(tensor, label) of the thresholded digits in the dataset folders."""
+    samples = []
+    for path in glob.glob(os.path.join(dataset_root, "*", "th", "*", "*.png")):
+        label = os.path.basename(os.path.dirname(path))
+        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if img is None or label not in CLASS_NAMES:
+            continue
+        img = cv2.resize(img, (40, 64))
+        samples.append(((img.astype(np.float32) / 255.0)[None, :, :, None], label))
+    return samples
+
+
+def detector_inputs(pictures, size):
+    inputs = []
+    for img in pictures:
+        img_lb, _, _ = letterbox(img, new_shape=(size, size))
+        inputs.append(np.transpose(img_lb.astype(np.float32) / 255.0, (2, 0, 1))[None])
+    return inputs
+
+
+class ListReader:
+    """CalibrationDataReader over a list of inputs."""
+
+    def __init__(self, input_name, inputs):
+        self.input_name = input_name
+        self._iter = iter(inputs)
+
+    def get_next(self):
+        x = next(self._iter, None)
+        return None if x is None else {self.input_name: x}
+
+
+# --- building ---
+
+def input_name(path):
+    import onnxruntime as ort
+    return ort.InferenceSession(path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+
+
+def input_dims(path):
+    import onnx
+    model = onnx.load(path)
+    return [d.dim_value if d.HasField("dim_value") else None for d in model.graph.input[0].type.tensor_type.shape.dim]
+
+
+def quantize_dynamic(src, dst):
+    from onnxruntime.quantization import QuantType, quantize_dynamic as ort_quantize_dynamic
+    ort_quantize_dynamic(src, dst, weight_type=QuantType.QUInt8)
+
+
+def quantize_static(src, dst, inputs):
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static as ort_quantize_static
+    ort_quantize_static(src, dst, ListReader(input_name(src), inputs), quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=True)
+
+
+def resize_detector(src, dst, size):
+    """
+    Path of a detector with a size x size input. Dynamic exports are used as they are (the manifest
+    records the input size), fixed ones are rewritten and checked with a test run.
+    """
+    import onnx
+    import onnxruntime as ort
+
+    dims = input_dims(src)
+    if dims[2] is None or dims[3] is None:
+        return src
+
+    model = onnx.load(src)
+    shape = model.graph.input[0].type.tensor_type.shape
+    shape.dim[2].dim_value = size
+    shape.dim[3].dim_value = size
+    # drop the inferred shapes of the original size, the outputs get a dynamic anchor dimension
+    del model.graph.value_info[:]
+    for output in model.graph.output:
+        for dim in output.type.tensor_type.shape.dim:
+            dim.ClearField("dim_value")
+    model = onnx.shape_inference.infer_shapes(model)
+    onnx.save(model, dst)
+
+    session = ort.InferenceSession(dst, providers=['CPUExecutionProvider'])
+    session.run(None, {session.get_inputs()[0].name: np.zeros((1, 3, size, size), np.float32)})
+    return dst
+
+
+def build(args, pictures, digit_tensors):
+    os.makedirs(args.out, exist_ok=True)
+    out = lambda filename: os.path.join(args.out, filename)  # noqa: E731
+    variants = {}
+
+    def step(description, fn):
+        print(f"[Variants] {description}...")
+        try:
+            return fn()
+        except Exception as e:
+            print(f"[Variants] {description} failed: {e}")
+            return None
+
+    det_dyn = step("Quantizing detector (dynamic)", lambda: quantize_dynamic(DETECTOR, out("yolo-int8-dynamic.onnx")) or out("yolo-int8-dynamic.onnx"))
+    cls_dyn = step("Quantizing classifier (dynamic)", lambda: quantize_dynamic(CLASSIFIER, out("digits-int8-dynamic.onnx")) or out("digits-int8-dynamic.onnx"))
+    if det_dyn or cls_dyn:
+        variants["int8-dynamic"] = {"detector": det_dyn, "classifier": cls_dyn}
+
+    det_static = cls_static = None
+    if pictures:
+        det_static = step(f"Quantizing detector (static, {len(pictures)} calibration pictures)",
+                          lambda: quantize_static(DETECTOR, out("yolo-int8-static.onnx"), detector_inputs(pictures, 640)) or out("yolo-int8-static.onnx"))
+    else:
+        print("[Variants] No stored pictures, skipping the static detector quantization")
+    if digit_tensors:
+        cls_static = step(f"Quantizing classifier (static, {len(digit_tensors)} calibration digits)",
+                          lambda: quantize_static(CLASSIFIER, out("digits-int8-static.onnx"), digit_tensors) or out("digits-int8-static.onnx"))
+    else:
+        print("[Variants] No stored evaluations, skipping the static classifier quantization")
+    if det_static or cls_static:
+        variants["int8-static"] = {"detector": det_static, "classifier": cls_static}
+
+    for size in args.sizes:
+        resized = out(f"yolo-fp32-{size}.onnx")
+        if not os.path.exists(resized):
+            resized = step(f"Building detector with {size}x{size} input", lambda: resize_detector(DETECTOR, resized, size))
+        if resized is None:
+            print(f"[Variants] Re-export the detector with imgsz={size} and place it at {out(f'yolo-fp32-{size}.onnx')}")
+            continue
+        variants[f"fp32-{size}"] = {"detector": resized, "detector_input": [size, size]}
+        if pictures:
+            det = step(f"Quantizing {size}x{size} detector (static)",
+                       lambda: quantize_static(resized, out(f"yolo-int8-static-{size}.onnx"), detector_inputs(pictures, size)) or out(f"yolo-int8-static-{size}.onnx"))
+            if det:
+                variants[f"int8-static-{size}"] = {"detector": det, "detector_input": [size, size], "classifier": cls_static}
+
+    # parts that could not be built fall back to the fp32 model
+    return {name: {key: value for key, value in spec.items() if value} for name, spec in variants.items()}
+
+
+# --- report ---
+
+def polygon_iou(a, b):
+    a = np.asarray(a, np.float32).reshape(4, 2)
+    b = np.asarray(b, np.float32).reshape(4, 2)
+    inter, _ = cv2.intersectConvexConvex(a, b)
+    union = cv2.contourArea(a) + cv2.contourArea(b) - inter
+    return float(inter / union) if union > 0 else 0.0
+
+
+def report(predictor, names, pictures, labeled, runs):
+    results = {}
+    reference = [predictor._infer_obb_polygon_best(img)[0] for img in pictures]
+    batch = [tensor for tensor, _ in labeled[:7]]
+
+    for name in [None] + names:
+        models = predictor.models(name)
+        if name is not None and models is predictor:
+            continue  # could not be loaded
+        result = {}
+
+        if pictures:
+            ious, found = [], 0
+            start = time.perf_counter()
+            for img, ref in zip(pictures, reference):
+                poly = predictor._infer_obb_polygon_best(img, models=models)[0]
+                if poly is not None:
+                    found += 1
+                    if ref is not None:
+                        ious.append(polygon_iou(poly, ref))
+            result["detector_ms"] = round((time.perf_counter() - start) * 1000.0 / len(pictures), 1)
+            result["detection_rate"] = round(found / len(pictures), 3)
+            result["mean_iou_vs_fp32"] = round(float(np.mean(ious)), 3) if ious else None
+
+        if labeled:
+            correct = 0
+            for i in range(0, len(labeled), 64):
+                chunk = labeled[i:i + 64]
+                predictions = predictor._classify([tensor for tensor, _ in chunk], models)
+                correct += sum(1 for prediction, (_, label) in zip(predictions, chunk) if prediction[0][0] == label)
+            result["classifier_accuracy"] = round(correct / len(labeled), 4)
+            start = time.perf_counter()
+            for _ in range(runs):
+                predictor._classify(batch, models)
+            result["classifier_ms_per_7"] = round((time.perf_counter() - start) * 1000.0 / runs, 2)
+
+        results[name or "default"] = result
+        print(f"[Variants] {name or 'default'}: {result}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="data/watermeters.sqlite", help="database with pictures and evaluations")
+    parser.add_argument("--dataset", default="data/output_dataset", help="labeled dataset folders (setup UI export)")
+    parser.add_argument("--out", default="models/variants", help="output folder of the variants and the manifest")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[320], help="reduced detector input sizes")
+    parser.add_argument("--calibration", type=int, default=64, help="calibration samples per model")
+    parser.add_argument("--runs", type=int, default=20, help="repetitions of the classifier latency measurement")
+    args = parser.parse_args()
+
+    # the model paths are relative to the repository root, like in MeterPredictor
+    db_file, dataset = os.path.abspath(args.db), os.path.abspath(args.dataset)
+    os.chdir(ROOT)
+
+    pictures = load_pictures(db_file, args.calibration) if os.path.exists(db_file) else []
+    digit_tensors = load_digit_tensors(db_file, args.calibration) if os.path.exists(db_file) else []
+    labeled = load_labeled_digits(dataset)
+    print(f"[Variants] {len(pictures)} pictures, {len(digit_tensors)} calibration digits, {len(labeled)} labeled digits")
+
+    variants = build(args, pictures, digit_tensors)
+    manifest_path = os.path.join(args.out, "manifest.json")
+    with open(manifest_path, "w") as f:
+        json.dump({"variants": variants, "report": {}}, f, indent=2)
+
+    from lib.meter_processing.meter_processing import MeterPredictor
+    predictor = MeterPredictor({"model_variants_manifest": manifest_path, "yolo_max_batch": 1,
+                                "roi_cache": False, "prediction_cache": False})
+    try:
+        results = report(predictor, list(variants), pictures, labeled, args.runs)
+    finally:
+        predictor.close()
+
+    with open(manifest_path, "w") as f:
+        json.dump({"variants": variants, "report": results}, f, indent=2)
+    print(f"[Variants] Wrote {manifest_path} ({len(variants)} variants)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
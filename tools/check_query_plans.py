@@ -0,0 +1,134 @@
+"""
+Checks that the hot per-meter queries are answered from indexes.
+
+Creates a scratch database with the current schema and migrations, fills it with a few
+meters worth of history and evaluations and runs EXPLAIN QUERY PLAN on every query below.
+Fails (exit code 1) if a query scans history or evaluations or sorts them in a temporary
+b-tree, i.e. if it would get slower as the tables grow.
+
+Keep the list in sync when adding or changing queries in lib/, tests/test_query_plans.py runs
+it with pytest and also checks the statements the endpoints actually execute.
+
+Usage: python tools/check_query_plans.py [--meters 5] [--rows 500] [--verbose]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from db.migrations import run_migrations  # noqa: E402
+from db.schema import create_tables  # noqa: E402
+
+# tables that grow with every frame, watermeters and settings have one row per meter
+LARGE_TABLES = ("history", "evaluations")
+
+# (where it is used, query); parameters are filled with placeholder values
+HOT_QUERIES = [
+    ("load_evaluation_context: last history entries",
+     "SELECT value, timestamp, confidence, target_brightness FROM history WHERE name = ? ORDER BY id DESC LIMIT 2"),
+    ("correct_value: last history entries",
+     "SELECT value, timestamp, confidence FROM history WHERE name = ? ORDER BY id DESC LIMIT 2"),
+    ("save_evaluation: last evaluation",
+     "SELECT id FROM evaluations WHERE name = ? ORDER BY id DESC LIMIT 1"),
+    ("RetentionJob: cutoff id",
+     "SELECT id FROM history WHERE name = ? ORDER BY id DESC LIMIT 1 OFFSET ?"),
+    ("RetentionJob: count limit batch",
+     "DELETE FROM history WHERE id IN (SELECT id FROM history WHERE name = ? AND id <= ? LIMIT ?)"),
+    ("RetentionJob: age limit batch",
+     "DELETE FROM history WHERE id IN (SELECT id FROM history WHERE name = ? AND id <= ? "
+     "AND julianday(timestamp, CASE WHEN timestamp GLOB '*Z' OR timestamp GLOB '*[+-][0-9][0-9]:[0-9][0-9]' THEN '+0 days' ELSE 'utc' END) < julianday(?) LIMIT ?)"),
+    ("RetentionJob: evaluations age limit batch",
+     "DELETE FROM evaluations WHERE id IN (SELECT id FROM evaluations WHERE name = ? AND id <= ? "
+     "AND julianday(timestamp, CASE WHEN timestamp GLOB '*Z' OR timestamp GLOB '*[+-][0-9][0-9]:[0-9][0-9]' THEN '+0 days' ELSE 'utc' END) < julianday(?) LIMIT ?)"),
+    ("reevaluate_digits: latest / offset",
+     "SELECT colored_digits_blob, colored_digits FROM evaluations WHERE name = ? ORDER BY id DESC LIMIT 1 OFFSET ?"),
+    ("reevaluate_digits: random",
+     "SELECT colored_digits_blob, colored_digits FROM evaluations WHERE id = (SELECT id FROM evaluations WHERE name = ? ORDER BY RANDOM() LIMIT 1)"),
+    ("GET /api/watermeters",
+     """SELECT w.name, w.picture_timestamp, w.wifi_rssi,
+               (SELECT value FROM history h WHERE h.name = w.name ORDER BY timestamp DESC LIMIT 1),
+               e.th_digits_blob, e.th_digits_inverted
+        FROM watermeters w
+        LEFT JOIN evaluations e ON e.id = (SELECT id FROM evaluations WHERE name = w.name ORDER BY id DESC LIMIT 1)
+        WHERE w.setup = 1"""),
+    ("GET /api/watermeters/{name}/history",
+     "SELECT value, timestamp, confidence, manual FROM history WHERE name = ? ORDER BY id"),
+    ("GET /api/watermeters/{name}/evals",
+     """SELECT colored_digits, th_digits, predictions, timestamp, result, total_confidence, outdated, id, denied_digits,
+               th_digits_inverted, colored_digits_blob, th_digits_blob
+        FROM evaluations WHERE name = ? AND id < ? ORDER BY id DESC LIMIT ?"""),
+    ("POST /api/setup/{name}/finish: outdate evaluations",
+     "UPDATE evaluations SET outdated = true WHERE name = ?"),
+    ("DELETE /api/watermeters/{name}: history",
+     "DELETE FROM history WHERE name = ?"),
+    ("DELETE /api/watermeters/{name}: evaluations",
+     "DELETE FROM evaluations WHERE name = ?"),
+]
+
+# random evaluation: the RANDOM() sort only runs over the (name, id) index entries of one meter
+ALLOWED_TEMP_BTREE = {"reevaluate_digits: random"}
+
+
+def fill(conn, meters, rows):
+    cursor = conn.cursor()
+    for m in range(meters):
+        name = f"meter{m}"
+        cursor.execute("INSERT INTO watermeters (name, setup) VALUES (?, 1)", (name,))
+        cursor.executemany(
+            "INSERT INTO history (name, value, confidence, target_brightness, timestamp, manual) VALUES (?,?,?,?,?,0)",
+            [(name, 1000 + i, 0.9, 120.0, f"2026-01-01T{i // 60 % 24:02d}:{i % 60:02d}:00") for i in range(rows)])
+        cursor.executemany(
+            "INSERT INTO evaluations (name, predictions, timestamp, result, total_confidence, denied_digits) VALUES (?,?,?,?,?,?)",
+            [(name, "[]", f"2026-01-01T{i // 60 % 24:02d}:{i % 60:02d}:00", 1000 + i, 0.9, "[]") for i in range(rows)])
+    conn.commit()
+    conn.execute("ANALYZE")
+
+
+def problems_of(label, plan):
+    problems = []
+    for detail in plan:
+        words = detail.split()
+        if words[0] == "SCAN" and words[1] in LARGE_TABLES:
+            problems.append(detail)
+        if "USE TEMP B-TREE" in detail and label not in ALLOWED_TEMP_BTREE:
+            problems.append(detail)
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--meters", type=int, default=5, help="meters in the scratch database")
+    parser.add_argument("--rows", type=int, default=500, help="history entries and evaluations per meter")
+    parser.add_argument("--verbose", action="store_true", help="print every query plan")
+    args = parser.parse_args()
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "plans.sqlite")
+        create_tables(db_file)
+        run_migrations(db_file)
+
+        with closing(sqlite3.connect(db_file)) as conn:
+            fill(conn, args.meters, args.rows)
+            print()
+            for label, query in HOT_QUERIES:
+                placeholders = query.count("?")
+                params = (["meter0"] + [1] * (placeholders - 1)) if placeholders else []
+                plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+                problems = problems_of(label, plan)
+                print(f"{'FAIL' if problems else 'ok':4}  {label}")
+                if problems or args.verbose:
+                    for detail in plan:
+                        print(f"        {detail}")
+                failed += 1 if problems else 0
+
+    print(f"\n{len(HOT_QUERIES) - failed}/{len(HOT_QUERIES)} queries use indexes")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
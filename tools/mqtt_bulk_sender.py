@@ -1,123 +1,318 @@
-import os
-import re
-import time
-import json
-import base64
-from PIL import Image
-import paho.mqtt.client as mqtt
-import numpy as np
-
-# MQTT Configuration
-#MQTT_BROKER = "192.168.178.24"  # Change this to your MQTT broker
-MQTT_BROKER = "192.168.122.177"  # Change this to your MQTT broker
-MQTT_PORT = 1883
-MQTT_USERNAME = "esp"  # Set your MQTT username
-MQTT_PASSWORD = "esp"  # Set your MQTT password
-MQTT_TOPIC = "MeterMonitor/upload"
+"""
+MQTT load generator: simulates many virtual meters and measures publish-to-value latency.
 
-# Image Filename Patterns
-ISO_TIMESTAMP_REGEX = r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}"  # Matches "2024-11-02T18:54:48"
-UNIX_TIMESTAMP_REGEX = r"^pic_\d{10}"  # Matches "pic_1737507953" (10-digit Unix timestamp)
-# match "20250307_131230" (8-digit date + 6-digit time) as TIMESTAMP_REGEX
-TIMESTAMP_REGEX = r"^\d{8}_\d{6}"
+Every virtual meter (<prefix>_0 ... <prefix>_<N-1>) sends one of the pictures of --images, always
+the same one, so its reading never changes and every evaluated frame publishes a value. A JPEG
+comment segment with the meter, sequence number and send time is inserted into each picture:
+the payload differs on every send, so the server's duplicate detection does not drop it.
 
-MAX_IMAGES = 200  # Maximum number of images to send
+The tool subscribes to the value topics (publish_to from settings.json) and matches each value
+to the oldest unanswered frame of that meter. Frames without a value within --timeout count as lost
+(queue overflow, rejected correction, ...).
 
+Values are only published for meters that are set up. With --http the virtual meters are set up
+through the API before the measurement: one frame is sent, its reading is taken from the evaluation
+and used as the initial value. Meters that are already set up (from a previous run) are skipped.
 
-def get_image_files():
-    """List image files in the current directory that match timestamp patterns."""
-    files = os.listdir(".")
-    image_files = [file for file in files if
-                   re.match(ISO_TIMESTAMP_REGEX, file) or re.match(UNIX_TIMESTAMP_REGEX, file) or re.match(TIMESTAMP_REGEX, file)]
-    return sorted(image_files)  # Sort to ensure correct order
+The rate steps (--rates) are run one after another for --duration seconds each. The saturation point
+is the first step that loses more than --max-loss of the frames or whose p95 latency exceeds
+--max-latency. The sustained throughput is the highest value rate before it.
 
+Usage: python tools/mqtt_bulk_sender.py --images collected_images --meters 1000 --rates 5 10 20 50
+           [--distribution uniform|poisson|burst] [--duration 60] [--http http://localhost:8070 --secret change_me]
+           [--broker localhost] [--out load.json]
+"""
+import argparse
+import base64
+import glob
+import json
+import os
+import random
+import re
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict, deque
+from datetime import datetime
 
-def encode_image_to_base64(image_path):
-    """Reads an image and returns its base64-encoded data and file length."""
-    with open(image_path, "rb") as f:
-        data = f.read()
-    return base64.b64encode(data).decode('utf-8'), len(data)
-
+import numpy as np
+import paho.mqtt.client as mqtt
+from PIL import Image
 
-def get_image_dimensions(image_path):
-    """Gets the width and height of an image using Pillow."""
-    with Image.open(image_path) as img:
-        return img.width, img.height
+PICTURE_PATTERNS = ("*.jpg", "*.jpeg")
 
 
-def extract_timestamp(file_name):
-    """Extracts a timestamp from the filename."""
-    if re.match(ISO_TIMESTAMP_REGEX, file_name):
-        return os.path.splitext(file_name)[0]  # Use the filename as timestamp
-    elif re.match(UNIX_TIMESTAMP_REGEX, file_name):
-        return file_name.split("_")[1].split(".")[0]  # Extract the Unix timestamp after 'pic_'
-    elif re.match(TIMESTAMP_REGEX, file_name):
-        return file_name.split(".")[0]
-    return "unknown"
+def load_pictures(folder):
+    pictures = []
+    for pattern in PICTURE_PATTERNS:
+        for path in sorted(glob.glob(os.path.join(folder, pattern))):
+            with open(path, "rb") as f:
+                data = f.read()
+            with Image.open(path) as img:
+                pictures.append((data, img.width, img.height))
+    return pictures
 
 
-def build_message(file_path, picture_number):
-    """Creates a JSON message for an image."""
-    timestamp = extract_timestamp(os.path.basename(file_path))
-    encoded_data, length = encode_image_to_base64(file_path)
-    width, height = get_image_dimensions(file_path)
+def tag_jpeg(data: bytes, comment: str) -> bytes:
+    """Insert a COM segment right after the SOI marker (ignored by decoders)."""
+    payload = comment.encode("ascii")
+    return data[:2] + b"\xff\xfe" + struct.pack(">H", len(payload) + 2) + payload + data[2:]
 
-    # If timestamp isn't in ISO format, convert it
-    if not re.match(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}", timestamp):
-        if re.match(r"^\d{8}_\d{6}", timestamp):
-            timestamp = f"{timestamp[:4]}-{timestamp[4:6]}-{timestamp[6:8]}T{timestamp[9:11]}:{timestamp[11:13]}:{timestamp[13:15]}"
-        else: timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(int(timestamp)))
 
+def build_message(name, picture_number, picture, sent_at):
+    data, width, height = picture
+    tagged = tag_jpeg(data, f"loadgen {name} {picture_number} {sent_at:.6f}")
     return {
-        "name": "Eval_8",
+        "name": name,
         "picture_number": picture_number,
         "WiFi-RSSI": -57,
+        "sent_at": sent_at,
         "picture": {
             "format": "jpeg",
-            "timestamp": timestamp,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
             "width": width,
             "height": height,
-            "length": length,
-            "data": encoded_data
+            "length": len(tagged),
+            "data": base64.b64encode(tagged).decode("ascii")
         }
     }
 
 
+def value_topic_pattern(publish_to):
+    """Subscription with a wildcard for the {device} level and a regex that extracts the meter name."""
+    levels = (publish_to + "value").split("/")
+    subscription = "/".join("+" if "{device}" in level else level for level in levels)
+    regex = re.escape(publish_to + "value").replace(re.escape("{device}"), "(?P<device>[^/]+)")
+    return subscription, re.compile(f"^{regex}$")
+
+
+class LatencyTracker:
+    """Send times of unanswered frames per meter and the measured latencies."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._pending = defaultdict(deque)
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.lost = 0
+
+    def sent(self, name, sent_at):
+        with self._lock:
+            self._pending[name].append(sent_at)
+
+    def received(self, name, received_at):
+        with self._lock:
+            pending = self._pending.get(name)
+            # values of frames from before the measurement (retained messages) have no pending entry
+            if pending:
+                self.latencies.append(received_at - pending.popleft())
+
+    def expire(self, now):
+        with self._lock:
+            for pending in self._pending.values():
+                while pending and now - pending[0] > self.timeout:
+                    pending.popleft()
+                    self.lost += 1
+
+    def take(self):
+        """Latencies and losses since the last call."""
+        with self._lock:
+            latencies, lost = self.latencies, self.lost
+            self.latencies, self.lost = [], 0
+            return latencies, lost
+
+    def outstanding(self):
+        with self._lock:
+            return sum(len(pending) for pending in self._pending.values())
+
+
+def inter_arrival(distribution, rate, burst_size):
+    if distribution == "poisson":
+        return lambda: random.expovariate(rate)
+    if distribution == "burst":
+        # burst_size frames back to back, then a pause keeping the average rate
+        state = {"i": 0}
+
+        def burst():
+            state["i"] += 1
+            return burst_size / rate if state["i"] % burst_size == 0 else 0.0
+        return burst
+    return lambda: 1.0 / rate
+
+
+def http_request(base, method, path, secret, body=None):
+    request = urllib.request.Request(base.rstrip("/") + path, method=method,
+                                     data=json.dumps(body).encode() if body is not None else None,
+                                     headers={"Content-Type": "application/json", "secret": secret or ""})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read() or b"null")
+
+
+def setup_meters(args, client, names, pictures):
+    """Send one frame per meter that is not set up yet and finish its setup with the reading of that frame."""
+    # only meters that are set up are listed, as (name, timestamp, rssi, value, digits)
+    ready = {row[0] for row in http_request(args.http, "GET", "/api/watermeters", args.secret)["watermeters"]}
+    todo = [name for name in names if name not in ready]
+    print(f"[LoadGen] Setting up {len(todo)} of {len(names)} virtual meters")
+    for i, name in enumerate(todo):
+        client.publish(args.topic, json.dumps(build_message(name, 0, pictures[int(name.rsplit("_", 1)[1]) % len(pictures)], time.time())))
+        if i % 50 == 49:
+            time.sleep(1.0)  # do not overflow the pipeline queue during the setup
+
+    for name in todo:
+        deadline = time.time() + args.timeout
+        while True:
+            try:
+                evals = http_request(args.http, "GET", f"/api/watermeters/{name}/evals?amount=1", args.secret)["evals"]
+            except urllib.error.HTTPError as e:
+                if e.code != 404:  # 404 until the first frame is stored
+                    raise
+                evals = []
+            if evals and evals[0].get("predictions"):
+                # top prediction per digit, rotating digits ('r') count as 0
+                reading = "".join(p[0][0] if p and p[0][0] != "r" else "0" for p in evals[0]["predictions"])
+                http_request(args.http, "POST", f"/api/setup/{name}/finish", args.secret,
+                             {"value": int(reading), "timestamp": datetime.now().isoformat(timespec="seconds")})
+                break
+            if time.time() > deadline:
+                print(f"[LoadGen] No evaluation for {name}, it will not publish values")
+                break
+            time.sleep(0.5)
+
+
+def run_step(args, client, tracker, names, pictures, rate, sequence):
+    next_gap = inter_arrival(args.distribution, rate, args.burst_size)
+    sent = 0
+    start = time.perf_counter()
+    next_send = start
+    end = start + args.duration
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if now < next_send:
+            time.sleep(min(next_send - now, 0.05))
+            continue
+        index = sequence % len(names)
+        name = names[index]
+        sequence += 1
+        sent_at = time.time()
+        tracker.sent(name, sent_at)
+        client.publish(args.topic, json.dumps(build_message(name, sequence, pictures[index % len(pictures)], sent_at)))
+        sent += 1
+        next_send += next_gap()
+        if sent % 100 == 0:
+            tracker.expire(time.time())
+
+    # collect the answers of the last frames
+    drain_end = time.time() + args.timeout
+    while tracker.outstanding() and time.time() < drain_end:
+        time.sleep(0.2)
+        tracker.expire(time.time())
+    tracker.expire(float("inf"))
+    latencies, lost = tracker.take()
+
+    result = {
+        "target_rate": rate,
+        "sent": sent,
+        "send_rate": round(sent / args.duration, 2),
+        "values": len(latencies),
+        "value_rate": round(len(latencies) / args.duration, 2),
+        "lost": lost,
+        "loss": round(lost / sent, 4) if sent else 0.0,
+    }
+    if latencies:
+        ms = np.array(latencies) * 1000.0
+        result.update({
+            "latency_p50_ms": round(float(np.percentile(ms, 50)), 1),
+            "latency_p95_ms": round(float(np.percentile(ms, 95)), 1),
+            "latency_p99_ms": round(float(np.percentile(ms, 99)), 1),
+        })
+    return result, sequence
+
+
 def main():
-    # Get images from the current folder
-    images = get_image_files()
-    if not images:
-        print("No images matching the pattern were found.")
-        return
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=".", help="folder with JPEG pictures of meters")
+    parser.add_argument("--meters", type=int, default=1000, help="number of virtual meters")
+    parser.add_argument("--prefix", default="loadgen", help="name prefix of the virtual meters")
+    parser.add_argument("--rates", type=float, nargs="+", default=[5, 10, 20, 50], help="total frames per second, one step each")
+    parser.add_argument("--duration", type=float, default=60, help="seconds per rate step")
+    parser.add_argument("--distribution", choices=["uniform", "poisson", "burst"], default="uniform")
+    parser.add_argument("--burst-size", type=int, default=20, help="frames per burst (burst distribution)")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds after which a frame without value counts as lost")
+    parser.add_argument("--max-latency", type=float, default=5.0, help="p95 latency in seconds above which a step is saturated")
+    parser.add_argument("--max-loss", type=float, default=0.05, help="fraction of lost frames above which a step is saturated")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--username", default="esp")
+    parser.add_argument("--password", default="esp")
+    parser.add_argument("--topic", default="MeterMonitor/upload")
+    parser.add_argument("--publish-to", default="homeassistant/sensor/watermeter_{device}/", help="publish_to of the server")
+    parser.add_argument("--http", help="URL of the server, sets up the virtual meters through the API")
+    parser.add_argument("--secret", default=None, help="secret_key of the server (if auth is enabled)")
+    parser.add_argument("--out", default="load.json", help="result file")
+    args = parser.parse_args()
 
-    total_images = len(images)
-    print(f"Found {total_images} images.")
+    pictures = load_pictures(args.images)
+    if not pictures:
+        parser.error(f"no JPEG pictures found in {args.images}")
+    names = [f"{args.prefix}_{i}" for i in range(args.meters)]
 
-    if total_images > MAX_IMAGES:
-        indices = np.linspace(0, total_images - 1, MAX_IMAGES, dtype=int)  # Select evenly spaced images
-        images = [images[i] for i in indices]
-        print(f"Selecting {MAX_IMAGES} evenly spaced images from {total_images}.")
+    tracker = LatencyTracker(args.timeout)
+    subscription, topic_regex = value_topic_pattern(args.publish_to)
 
-    # Set up MQTT client with authentication
+    def on_message(client, userdata, msg):
+        match = topic_regex.match(msg.topic)
+        if match:
+            tracker.received(match.group("device"), time.time())
 
-    client = mqtt.Client()
-    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)  # Set MQTT credentials
-    client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.username_pw_set(args.username, args.password)
+    client.on_message = on_message
+    client.max_queued_messages_set(0)
+    client.connect(args.broker, args.port, 60)
+    client.subscribe(subscription)
+    client.loop_start()
 
-    print(f"Sending first image immediately: {images[0]}")
-    msg = build_message(images[0], picture_number=1)
-    client.publish(MQTT_TOPIC, json.dumps(msg))
-    print(f"Sent image 1: {images[0]}")
+    try:
+        if args.http:
+            setup_meters(args, client, names, pictures)
+        else:
+            print("[LoadGen] No --http given, only meters that are already set up publish values")
 
-    input("Press Enter to send the remaining images...")
+        steps = []
+        saturation = None
+        sequence = 0
+        for rate in args.rates:
+            print(f"[LoadGen] {rate} frames/s over {args.meters} meters for {args.duration:.0f}s ({args.distribution})...")
+            result, sequence = run_step(args, client, tracker, names, pictures, rate, sequence)
+            steps.append(result)
+            print(f"[LoadGen] {result}")
+            saturated = result["loss"] > args.max_loss or result.get("latency_p95_ms", float("inf")) > args.max_latency * 1000.0
+            if saturated and saturation is None:
+                saturation = rate
+                print(f"[LoadGen] Saturated at {rate} frames/s")
+                break
+    finally:
+        client.loop_stop()
+        client.disconnect()
 
-    for idx, image_file in enumerate(images[1:], start=2):
-        time.sleep(0.5)
-        msg = build_message(image_file, picture_number=idx)
-        client.publish(MQTT_TOPIC, json.dumps(msg))
-        print(f"Sent image {idx}/{len(images)}: {image_file}")
+    healthy = [step for step in steps if saturation is None or step["target_rate"] < saturation]
+    sustained = max((step["value_rate"] for step in healthy), default=0.0)
+    print(f"[LoadGen] Sustained throughput: {sustained} values/s, saturation point: {saturation if saturation is not None else 'not reached'}")
 
-    print("All images have been sent.")
+    with open(args.out, "w") as f:
+        json.dump({
+            "meta": {"timestamp": datetime.now().isoformat(), "meters": args.meters, "distribution": args.distribution,
+                     "duration_s": args.duration, "pictures": len(pictures)},
+            "steps": steps,
+            "sustained_values_per_s": sustained,
+            "saturation_rate": saturation,
+        }, f, indent=2)
+    print(f"[LoadGen] Wrote {args.out}")
 
 
 if __name__ == "__main__":